@@ -4,22 +4,35 @@ Main module for bot handlers and execution
 
 import logging
 import asyncio
+from aiohttp import web
 from aiogram import types, executor
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 
-from loader import dp
+from loader import dp, mark_startup, log_startup_timings
 from handlers.start import start
-from handlers.dialog import model_selection, process_model_dialog, end_dialog
-from handlers.admin import admin_show_analytics
+from handlers.dialog import model_selection, process_model_dialog, end_dialog, in_dialog, ends_dialog, is_allowed
+from handlers.admin import admin_show_analytics, admin_refresh_allow_lists
 from handlers.help import command_help
+from services import user_service
 from services.user_service import (
-    USER_MODEL_CHOICE,
-    ADMINS,
+    STATE,
     update_users_and_admins_periodically
 )
+from services.openai_service import close_session
+from services.history import load_encoding
+from services.analytics_service import flush_analytics, flush_analytics_periodically
+from services.usage_store import usage_store
+from services.webhook_server import create_webhook_app
+from services.worker_pool import run_supervisor
+from services.metrics import MetricsMiddleware, start_metrics_server, stop_metrics_server
+from services.loop_monitor import loop_monitor
+from config import RUN_MODE, WEBAPP_HOST, WEBAPP_PORT, WORKER_PROCESSES, METRICS_PORT, LOOP_MONITOR_ENABLED
 
 logging.basicConfig(level=logging.INFO)
+# Фоновые задачи, запущенные в `on_startup` и останавливаемые в `on_shutdown`
+_background_tasks = []
 dp.middleware.setup(LoggingMiddleware())
+dp.middleware.setup(MetricsMiddleware())
 
 @dp.message_handler(commands=["start"])
 async def on_start(message: types.Message):
@@ -42,7 +55,7 @@ async def on_start(message: types.Message):
     """
     await start(message)
 
-@dp.callback_query_handler(lambda c: c.data in ["gpt3.5", "gpt4"])
+@dp.callback_query_handler(lambda c: c.data in ["gpt3.5", "gpt4"] and is_allowed(c.from_user.id))
 async def on_model_selection(callback_query: types.CallbackQuery):
     """
     Асинхронный обработчик выбора модели по callback-запросу.
@@ -67,7 +80,7 @@ async def on_model_selection(callback_query: types.CallbackQuery):
     await model_selection(callback_query)
 
 
-@dp.message_handler(lambda message: message.from_user.id in USER_MODEL_CHOICE and message.text != '❌ Завершить диалог')
+@dp.message_handler(in_dialog)
 async def on_process_model_dialog(message: types.Message):
     """
     Асинхронный обработчик для продолжения диалога модели.
@@ -86,13 +99,13 @@ async def on_process_model_dialog(message: types.Message):
 
     Notes
     -----
-    Этот обработчик активируется для пользователей, которые находятся в списке USER_MODEL_CHOICE
+    Этот обработчик активируется для пользователей, у которых есть сессия в хранилище STATE,
     и отправляют сообщение, не равное '❌ Завершить диалог'. После получения сообщения 
     вызывается функция `process_model_dialog` для обработки диалога с выбранной моделью.
     """
     await process_model_dialog(message)
 
-@dp.message_handler(lambda message: message.text == '❌ Завершить диалог' and message.from_user.id in USER_MODEL_CHOICE)
+@dp.message_handler(ends_dialog)
 async def on_end_dialog(message: types.Message):
     """
     Асинхронный обработчик для завершения диалога модели.
@@ -111,14 +124,14 @@ async def on_end_dialog(message: types.Message):
 
     Notes
     -----
-    Этот обработчик активируется для пользователей, которые находятся в списке USER_MODEL_CHOICE
+    Этот обработчик активируется для пользователей, у которых есть сессия в хранилище STATE,
     и отправляют сообщение '❌ Завершить диалог'. После получения сообщения вызывается 
     функция `end_dialog` для завершения текущего диалога с выбранной моделью.
     """
     await end_dialog(message)
 
 
-@dp.callback_query_handler(lambda c: c.data == "show_analytics" and c.from_user.id in ADMINS)
+@dp.callback_query_handler(lambda c: c.data == "show_analytics" and c.from_user.id in user_service.ADMINS)
 async def on_admin_show_analytics(callback_query: types.CallbackQuery):
     """
     Асинхронный обработчик для показа аналитики администраторам.
@@ -144,6 +157,28 @@ async def on_admin_show_analytics(callback_query: types.CallbackQuery):
     await admin_show_analytics(callback_query)
 
 
+@dp.callback_query_handler(lambda c: c.data == "refresh_allow_lists" and c.from_user.id in user_service.ADMINS)
+async def on_admin_refresh_allow_lists(callback_query: types.CallbackQuery):
+    """
+    Асинхронный обработчик для обновления списков пользователей и администраторов по запросу администратора.
+
+    Parameters
+    ----------
+    callback_query : types.CallbackQuery
+        Callback-запрос от администратора с данными "refresh_allow_lists".
+
+    Returns
+    -------
+    Any
+
+    Notes
+    -----
+    Этот обработчик активируется только для пользователей, которые находятся в множестве ADMINS.
+    После получения запроса вызывается функция `admin_refresh_allow_lists`.
+    """
+    await admin_refresh_allow_lists(callback_query)
+
+
 @dp.callback_query_handler(lambda c: c.data == "help")
 async def on_help(callback_query: types.CallbackQuery):
     """
@@ -170,12 +205,82 @@ async def on_help(callback_query: types.CallbackQuery):
     await command_help(callback_query)
 
 
+async def on_startup(dispatcher):
+    """
+    Подготавливает ресурсы перед началом приема обновлений.
+
+    Parameters
+    ----------
+    dispatcher : Dispatcher
+        Диспетчер бота.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    Открывает хранилище состояния: локальное хранилище сессий (истории загружаются с диска
+    при первом обращении) или общее хранилище реплик, заданное `STATE_BACKEND_URL`.
+    Открывает локальное хранилище событий использования для отчетов администраторам.
+    В режиме опроса запускает сервер метрик на порту `METRICS_PORT` (в режиме вебхука
+    метрики отдает сервер вебхука, в процессах-обработчиках сервер запускает `run_supervisor`).
+    При `LOOP_MONITOR_ENABLED` запускает сторож зависаний цикла событий.
+    В режиме одного процесса запускает периодическое обновление пользователей и администраторов
+    и запись аналитики в Google Sheets (при нескольких процессах это делает главный процесс).
+    Задачи создаются здесь, в работающем цикле событий: `web.run_app` создает собственный цикл.
+    Токенизатор загружается в фоне в пуле потоков: возможное скачивание кодировки не задерживает
+    начало приема обновлений, а до его окончания токены оцениваются по длине текста.
+    Затем логирует разбивку времени запуска по этапам.
+    """
+    loop = asyncio.get_event_loop()
+    _background_tasks.append(loop.run_in_executor(None, load_encoding))
+    await STATE.open()
+    usage_store.open()
+    _background_tasks.append(loop.create_task(usage_store.flush_periodically()))
+    if WORKER_PROCESSES == 1:
+        _background_tasks.append(loop.create_task(update_users_and_admins_periodically()))
+        _background_tasks.append(loop.create_task(flush_analytics_periodically()))
+    if RUN_MODE != 'webhook' and WORKER_PROCESSES == 1:
+        await start_metrics_server(METRICS_PORT)
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    mark_startup("state")
+    log_startup_timings()
+
+
+async def on_shutdown(dispatcher):
+    """
+    Освобождает ресурсы при остановке бота.
+
+    Parameters
+    ----------
+    dispatcher : Dispatcher
+        Диспетчер бота.
+
+    Returns
+    -------
+    None
+    """
+    loop_monitor.stop()
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    await usage_store.flush()
+    usage_store.close()
+    await flush_analytics()
+    await STATE.close()
+    await close_session()
+    await stop_metrics_server()
+
+
 def main():
     """
     Главная функция для запуска бота.
 
-    Инициализирует асинхронный цикл и задачу для периодического обновления пользователей и администраторов.
-    Затем начинает опрос с использованием `executor.start_polling`.
+    Начинает прием обновлений: опрос с использованием `executor.start_polling`
+    или, при `RUN_MODE=webhook`, встроенный aiohttp-сервер вебхука на порту `WEBAPP_PORT`.
+    При `WORKER_PROCESSES` больше 1 обновления обрабатываются в нескольких процессах (см. `run_supervisor`).
 
     Returns
     -------
@@ -185,9 +290,15 @@ def main():
     -----
     Использует глобальные переменные, такие как `dp` и `executor`, для работы с ботом.
     """
-    loop = asyncio.get_event_loop()
-    loop.create_task(update_users_and_admins_periodically())
-    executor.start_polling(dp, skip_updates=True)
+    mark_startup("handlers")
+    if WORKER_PROCESSES > 1:
+        run_supervisor(WORKER_PROCESSES, on_startup, on_shutdown)
+        return
+
+    if RUN_MODE == 'webhook':
+        web.run_app(create_webhook_app(dp, on_startup, on_shutdown), host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 if __name__ == '__main__':
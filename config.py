@@ -8,5 +8,120 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-TOKEN = os.environ('TOKEN')
-OPENAI_API_KEY = os.environ('OPENAI_API_KEY')
+TOKEN = os.environ['TOKEN']
+OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
+
+# Streaming of model answers into the Telegram reply
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Shared HTTP connection pool for OpenAI requests
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '100'))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv('OPENAI_REQUEST_TIMEOUT', '120'))
+# Max silence between chunks of a streamed answer, seconds
+OPENAI_STREAM_READ_TIMEOUT = float(os.getenv('OPENAI_STREAM_READ_TIMEOUT', '30'))
+
+# Resilience of OpenAI requests: per-model deadlines, retries, hedging and GPT-4 fallback
+OPENAI_DEADLINES = {
+    "gpt-3.5-turbo-16k": float(os.getenv('OPENAI_DEADLINE_GPT35', '60')),
+    "gpt-4": float(os.getenv('OPENAI_DEADLINE_GPT4', '90'))
+}
+OPENAI_RETRIES = int(os.getenv('OPENAI_RETRIES', '3'))
+OPENAI_BACKOFF = float(os.getenv('OPENAI_BACKOFF', '1'))
+OPENAI_HEDGE = os.getenv('OPENAI_HEDGE', '0') == '1'
+OPENAI_FALLBACK = os.getenv('OPENAI_FALLBACK', '1') == '1'
+OPENAI_FALLBACK_RESERVE = float(os.getenv('OPENAI_FALLBACK_RESERVE', '30'))
+
+# Write-behind buffer for the analytics worksheet
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '60'))
+ANALYTICS_FLUSH_SIZE = int(os.getenv('ANALYTICS_FLUSH_SIZE', '50'))
+ANALYTICS_INDEX_TTL = float(os.getenv('ANALYTICS_INDEX_TTL', '3600'))
+ANALYTICS_SHEETS_EXPORT = os.getenv('ANALYTICS_SHEETS_EXPORT', '1') == '1'
+
+# Local usage-event store with daily rollups, source of the admin reports
+USAGE_DB_PATH = os.getenv('USAGE_DB_PATH', '/data/usage.db')
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '5'))
+USAGE_EVENTS_RETENTION_DAYS = int(os.getenv('USAGE_EVENTS_RETENTION_DAYS', '30'))
+
+# Persistent dialog sessions on the persistence mount
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', '/data/sessions.db')
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '2'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '3600'))
+# Days of per-user token counters kept in memory
+USAGE_WINDOW_DAYS = int(os.getenv('USAGE_WINDOW_DAYS', '7'))
+
+# Typing indicator
+CHAT_ACTION_INTERVAL = float(os.getenv('CHAT_ACTION_INTERVAL', '4.5'))
+TYPING_PLACEHOLDER = os.getenv('TYPING_PLACEHOLDER', '0') == '1'
+
+# Outbound Telegram rate limits (messages per second)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+
+# Concurrency and rate budgets for model calls, per model tier
+MODEL_LIMITS = {
+    "GPT-3.5 Turbo": {
+        "concurrency": int(os.getenv('GPT35_CONCURRENCY', '20')),
+        "rpm": int(os.getenv('GPT35_RPM', '3500')),
+        "tpm": int(os.getenv('GPT35_TPM', '180000')),
+        "completion_reserve": int(os.getenv('GPT35_COMPLETION_RESERVE', '1000'))
+    },
+    "GPT-4": {
+        "concurrency": int(os.getenv('GPT4_CONCURRENCY', '5')),
+        "rpm": int(os.getenv('GPT4_RPM', '200')),
+        "tpm": int(os.getenv('GPT4_TPM', '40000')),
+        "completion_reserve": int(os.getenv('GPT4_COMPLETION_RESERVE', '1000'))
+    }
+}
+
+# Background summarization of older turns once history passes a share of its token limit
+SUMMARY_ENABLED = os.getenv('SUMMARY_ENABLED', '0') == '1'
+SUMMARY_THRESHOLD = float(os.getenv('SUMMARY_THRESHOLD', '0.5'))
+SUMMARY_KEEP_TURNS = int(os.getenv('SUMMARY_KEEP_TURNS', '4'))
+
+# Messages from one user arriving within this window are merged into one prompt
+MESSAGE_COALESCE_WINDOW = float(os.getenv('MESSAGE_COALESCE_WINDOW', '0.7'))
+
+# Exact-match cache of model answers
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '0') == '1'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+RESPONSE_CACHE_FIRST_TURN_ONLY = os.getenv('RESPONSE_CACHE_FIRST_TURN_ONLY', '1') == '1'
+
+# Run mode: "polling" or "webhook" (embedded aiohttp server on containerPort)
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '80'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '16'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# Shared state for several replicas: Redis-compatible URL, empty keeps state in process memory
+STATE_BACKEND_URL = os.getenv('STATE_BACKEND_URL', '')
+
+# Number of worker processes; more than 1 runs a supervisor that shards updates by user
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))
+
+# Google Sheets calls: dedicated thread pool, per-call timeout and retries with backoff
+SHEETS_WORKERS = int(os.getenv('SHEETS_WORKERS', '1'))
+SHEETS_TIMEOUT = float(os.getenv('SHEETS_TIMEOUT', '30'))
+SHEETS_RETRIES = int(os.getenv('SHEETS_RETRIES', '3'))
+SHEETS_BACKOFF = float(os.getenv('SHEETS_BACKOFF', '1'))
+
+# Interval between checks of the users and admins sheets for changes, in seconds
+ALLOW_LIST_REFRESH_INTERVAL = float(os.getenv('ALLOW_LIST_REFRESH_INTERVAL', '600'))
+
+# Last good users/admins lists, loaded at startup before the live refresh from Google Sheets
+ALLOW_LIST_SNAPSHOT_PATH = os.getenv('ALLOW_LIST_SNAPSHOT_PATH', '/data/allow_lists.json')
+
+# Prometheus-style metrics: served on the webhook server, or on METRICS_PORT when there is none
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+# Event-loop stall diagnostics (opt-in): lag sampling, asyncio debug mode and stack capture
+LOOP_MONITOR_ENABLED = os.getenv('LOOP_MONITOR_ENABLED', '0') == '1'
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.25'))
+LOOP_SAMPLE_INTERVAL = float(os.getenv('LOOP_SAMPLE_INTERVAL', '0.1'))
@@ -1,23 +1,81 @@
 """
-Admin handlers for interacting with administrative functionalities, such as viewing analytics.
+Admin handlers for interacting with administrative functionalities, such as viewing analytics
+and refreshing the user and admin lists.
 """
 
+import io
 from aiogram import types
-from services.user_service import ADMINS
+from services import user_service
+from services.user_service import refresh_allow_lists
+from services.response_cache import response_cache
+from services.memory_report import memory_report
+from services.openai_service import openai_stats
+from services.usage_store import usage_store
 from loader import dp
 
-@dp.callback_query_handler(lambda c: c.data == "show_analytics" and c.from_user.id in ADMINS)
+@dp.callback_query_handler(lambda c: c.data == "show_analytics" and c.from_user.id in user_service.ADMINS)
 async def admin_show_analytics(callback_query: types.CallbackQuery):
     """
     Обрабатывает запрос администратора на просмотр аналитики пользователей.
     
-    Отправляет ссылку на документ Google Sheets, содержащий аналитику пользователей.
+    Отправляет отчет об использовании моделей за неделю с графиками расходов, самых активных
+    пользователей и p95 времени ответа, ссылку на выгрузку в Google Sheets, статистику кэша
+    ответов, если он включен, и оценку памяти бота по компонентам.
     
     Параметры:
     ----------
     callback_query : types.CallbackQuery
         Запрос обратного вызова, содержащий запрос администратора.
     """
+    await dp.bot.answer_callback_query(callback_query.id)
+    text, image = await usage_store.report()
+    if image is not None:
+        await dp.bot.send_photo(
+            callback_query.from_user.id, types.InputFile(io.BytesIO(image), "report.png"), caption=text
+        )
     link = 'https://docs.google.com/spreadsheets/d/19ngGFqHcVOjPZk7Zklj3nEShjG3uk7rSq6xVCi9_Kxs'
-    response = f"Аналитика по пользователям:\n\nНаходится по ссылке:\n{link}"
-    await dp.bot.send_message(callback_query.from_user.id, response) 
\ No newline at end of file
+    response = f"{text}\n\n" if image is None else ""
+    response += f"Выгрузка в Google Sheets:\n{link}"
+    if response_cache.enabled:
+        response += (
+            f"\n\nКэш ответов: {response_cache.hit_ratio:.0%} попаданий "
+            f"({response_cache.hits} из {response_cache.hits + response_cache.misses}), "
+            f"{response_cache.size_bytes / 1024:.0f} КБ"
+        )
+    if openai_stats.outcomes:
+        response += "\n\nЗапросы к OpenAI:" + "".join(
+            f"\n{model_name} {outcome}: {count}" for (model_name, outcome), count in sorted(openai_stats.outcomes.items())
+        )
+    response += "\n\nПамять:" + "".join(
+        f"\n{component}: {count} шт., {size / 1024:.0f} КБ" for component, (count, size) in memory_report().items()
+    )
+    await dp.bot.send_message(callback_query.from_user.id, response)
+
+@dp.callback_query_handler(lambda c: c.data == "refresh_allow_lists" and c.from_user.id in user_service.ADMINS)
+async def admin_refresh_allow_lists(callback_query: types.CallbackQuery):
+    """
+    Обрабатывает запрос администратора на немедленное обновление списков пользователей и администраторов.
+
+    Таблицы перечитываются, даже если они не изменились, без ожидания периодического обновления.
+    Если одну из таблиц загрузить не удалось, администратор получает сообщение о том, какой список
+    остался прежним.
+
+    Параметры:
+    ----------
+    callback_query : types.CallbackQuery
+        Запрос обратного вызова, содержащий запрос администратора.
+    """
+    await dp.bot.answer_callback_query(callback_query.id)
+    users_loaded, admins_loaded = await refresh_allow_lists(force=True)
+    if users_loaded and admins_loaded:
+        status = "Списки обновлены"
+    elif users_loaded:
+        status = "Список пользователей обновлен, список администраторов загрузить не удалось, используется прежний"
+    elif admins_loaded:
+        status = "Список администраторов обновлен, список пользователей загрузить не удалось, используется прежний"
+    else:
+        status = "Не удалось загрузить списки, используются прежние"
+    await dp.bot.send_message(
+        callback_query.from_user.id,
+        f"{status}: пользователей — {len(user_service.ALLOWED_USERS)}, администраторов — {len(user_service.ADMINS)}."
+    )
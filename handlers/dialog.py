@@ -3,27 +3,92 @@ Handlers for dialogs with a chatbot based on the OpenAI GPT model.
 """
 
 from aiogram import types
-from services.user_service import USER_MODEL_CHOICE, USER_ANALYTICS, ALLOWED_USERS
+from services import user_service
+from services.user_service import STATE
 from datetime import datetime
 from services.markups import end_conversation_markup
-from services.analytics_service import update_or_add_to_gsheets
+from services.usage_store import usage_store
+from services.state_backend import new_session
 from loader import dp
 import logging
-from services.openai_service import ask_openai
+from services.openai_service import ask_openai, ask_openai_stream, OPENAI_ERROR_TEXT
+from services.response_cache import response_cache
+from services.summarizer import maybe_compact
+from services.model_scheduler import model_scheduler
+from services.typing_indicator import TypingIndicator
+from services.telegram_sender import send_priority, PRIORITY_FIRST, PRIORITY_CONTINUATION
+from config import STREAM_RESPONSES, STREAM_EDIT_INTERVAL, TYPING_PLACEHOLDER, MESSAGE_COALESCE_WINDOW
 import asyncio
 
-typing_condition = asyncio.Condition()
-stop_typing = False
 MAX_MESSAGE_LENGTH = 4000
 
+# Почтовые ящики пользователей: сообщения, ожидающие ответа модели
+PENDING_MESSAGES = {}
+_active_users = set()
+# Выполняющиеся генерации ответов: user_id -> asyncio.Task
+ACTIVE_GENERATIONS = {}
 
-@dp.callback_query_handler(lambda c: c.data in ["gpt3.5", "gpt4"])
+def cancel_generation(user_id):
+    """
+    Прерывает генерацию ответа пользователю, если она выполняется.
+
+    Запрос к OpenAI отменяется, слот модели освобождается сразу, а в аналитику
+    попадают только уже полученные токены.
+
+    Параметры:
+    ----------
+    user_id : int
+        ID пользователя.
+
+    Возвращает:
+    -------
+    bool
+        True, если генерация была прервана.
+    """
+    task = ACTIVE_GENERATIONS.get(user_id)
+    if task is not None and not task.done():
+        task.cancel()
+        return True
+    return False
+
+# Генерацию, выполняющуюся в другой реплике, прерывает `STATE.cancel_generation`
+STATE.set_cancel_handler(cancel_generation)
+
+def is_allowed(user_id):
+    """
+    Проверяет, что пользователь есть в текущем списке пользователей.
+
+    Сессии хранятся дольше, чем действует доступ: пользователь, удаленный из таблицы,
+    не может продолжить сохраненный диалог.
+    """
+    return user_id in user_service.ALLOWED_USERS
+
+async def in_dialog(message: types.Message):
+    """
+    Фильтр сообщений пользователей, ведущих диалог с моделью (кроме кнопки завершения).
+    """
+    return (
+        message.text != '❌ Завершить диалог' and is_allowed(message.from_user.id)
+        and await STATE.has_session(message.from_user.id)
+    )
+
+async def ends_dialog(message: types.Message):
+    """
+    Фильтр нажатия кнопки завершения диалога пользователем, ведущим диалог.
+    """
+    return (
+        message.text == '❌ Завершить диалог' and is_allowed(message.from_user.id)
+        and await STATE.has_session(message.from_user.id)
+    )
+
+
+@dp.callback_query_handler(lambda c: c.data in ["gpt3.5", "gpt4"] and is_allowed(c.from_user.id))
 async def model_selection(callback_query: types.CallbackQuery):
     """
     Обрабатывает выбор модели пользователем и информирует его о сделанном выборе.
 
     При получении запроса от пользователя о выборе одной из моделей (GPT-3.5 Turbo или GPT-4), 
-    функция сохраняет этот выбор в словаре USER_MODEL_CHOICE и отправляет пользователю сообщение, 
+    функция сохраняет этот выбор в хранилище состояния STATE и отправляет пользователю сообщение, 
     подтверждающее его выбор. 
 
     Параметры
@@ -37,16 +102,19 @@ async def model_selection(callback_query: types.CallbackQuery):
 
     Примечания
     ----------
-    Функция использует глобальную переменную USER_MODEL_CHOICE для сохранения выбора пользователя.
+    Функция использует хранилище состояния STATE для сохранения выбора пользователя.
     """
     logging.info("Entered model_selection handler")
     user_id = callback_query.from_user.id
     model = "GPT-3.5 Turbo" if callback_query.data == "gpt3.5" else "GPT-4"
-    USER_MODEL_CHOICE[user_id] = {"model": model, "history": ""}
+    # Новый диалог отменяет ответ в предыдущем
+    PENDING_MESSAGES.pop(user_id, None)
+    await STATE.cancel_generation(user_id)
+    await STATE.save_session(user_id, new_session(model))
     await dp.bot.answer_callback_query(callback_query.id)
     await dp.bot.send_message(user_id, f"Вы выбрали {model}. Напишите ваше сообщение для начала диалога.")
 
-@dp.message_handler(lambda message: message.from_user.id in USER_MODEL_CHOICE and message.text != '❌ Завершить диалог')
+@dp.message_handler(in_dialog)
 async def process_model_dialog(message: types.Message):
     """
     Обрабатывает сообщения пользователя, взаимодействует с API OpenAI и предоставляет ответ.
@@ -58,41 +126,153 @@ async def process_model_dialog(message: types.Message):
 
     Примечание:
     ----------
-    Для взаимодействия с OpenAI использует глобальную переменную USER_MODEL_CHOICE, 
+    Для взаимодействия с OpenAI использует хранилище состояния STATE,
     чтобы отслеживать текущий выбор модели и историю диалога для каждого пользователя.
+
+    Ходы одного пользователя выполняются строго по очереди, в том числе между репликами
+    (`STATE.user_lock`). Сообщения, пришедшие в течение
+    `MESSAGE_COALESCE_WINDOW` секунд или пока готовится предыдущий ответ, объединяются
+    в один запрос к модели. В потоковом режиме новое сообщение прерывает генерацию
+    текущего ответа.
     """
     user_id = message.from_user.id
-    model_data = USER_MODEL_CHOICE[user_id]
-    model = model_data['model']
+    PENDING_MESSAGES.setdefault(user_id, []).append(message)
+    if user_id in _active_users:
+        # Сообщение будет обработано текущим обработчиком пользователя
+        if STREAM_RESPONSES:
+            cancel_generation(user_id)
+        return
+
+    _active_users.add(user_id)
+    try:
+        if STREAM_RESPONSES:
+            # Ответ на предыдущее сообщение может генерировать другая реплика
+            await STATE.cancel_generation(user_id)
+        await asyncio.sleep(MESSAGE_COALESCE_WINDOW)
+        async with STATE.user_lock(user_id):
+            while PENDING_MESSAGES.get(user_id):
+                batch = PENDING_MESSAGES.pop(user_id)
+                task = asyncio.get_event_loop().create_task(
+                    answer_user(batch[-1], "\n\n".join(pending.text for pending in batch))
+                )
+                ACTIVE_GENERATIONS[user_id] = task
+                try:
+                    await asyncio.wait({task})
+                finally:
+                    ACTIVE_GENERATIONS.pop(user_id, None)
+                    if not task.done():
+                        task.cancel()
+                if not task.cancelled():
+                    task.result()
+    finally:
+        _active_users.discard(user_id)
+        PENDING_MESSAGES.pop(user_id, None)
+
+async def answer_user(message, text):
+    """
+    Отправляет модели один ход пользователя и выводит ответ.
+
+    Параметры:
+    ----------
+    message : types.Message
+        Последнее сообщение пользователя, вошедшее в ход.
+
+    text : str
+        Текст хода (одно или несколько объединенных сообщений).
+    """
+    user_id = message.from_user.id
+    model_data = await STATE.get_session(user_id)
+    if model_data is not None:
+        # Реплики записываются только в свой диалог: он мог быть завершен или заменен новым
+        dialog_id = model_data.dialog_id
+        model_data = await STATE.update_session(
+            user_id, dialog_id, lambda session: session.history.append("user", text)
+        )
+    if model_data is None:
+        # Диалог завершен, пока сообщение ожидало обработки
+        return
+    model = model_data.model
     model_name = "gpt-3.5-turbo-16k" if model == "GPT-3.5 Turbo" else "gpt-4"
-    model_data["history"] += f"User: {message.text}\n"
-    model_data["history"] = truncate_history(model_data["history"])
-    prompt = model_data["history"]
+    history = model_data.history
+    messages = history.to_messages()
 
-    global stop_typing
-    stop_typing = False
-    
-    # Запускаем анимацию
-    typing_task = asyncio.create_task(animate_typing(message))
-    await dp.bot.send_chat_action(message.chat.id, action="typing")
-    response_text, tokens_used = await ask_openai(model_name, prompt) 
-    stop_typing = True
-    await typing_task
-    model_data["history"] += f"Bot: {response_text}\n"
+    # Одинаковые вопросы без контекста обслуживаются из кэша без обращения к модели
+    cacheable = response_cache.is_cacheable(messages)
+    cached_text = response_cache.get(model_name, messages) if cacheable else None
+    if cached_text is not None:
+        await send_message_in_parts(message.chat.id, cached_text, reply_markup=end_conversation_markup)
+        await STATE.update_session(
+            user_id, dialog_id, lambda session: session.history.append("assistant", cached_text)
+        )
+        return
+
+    indicator = TypingIndicator(
+        dp.bot, message.chat.id, placeholder=TYPING_PLACEHOLDER, reply_markup=end_conversation_markup
+    )
+    await indicator.start()
+
+    async def notify_queued(position):
+        await dp.bot.send_message(
+            message.chat.id, f"Сейчас много запросов к {model}. Ваш запрос в очереди, позиция: {position}."
+        )
+
+    reply = {"text": "", "tokens_used": 0}
+    info = {"model_name": model_name}
+    cancelled = False
+    response_text = ""
+    prompt_tokens = history.total_tokens
+    loop = asyncio.get_event_loop()
+    started = None
+    try:
+        async with model_scheduler.slot(model, user_id, prompt_tokens, on_queued=notify_queued) as usage:
+            started = loop.time()
+            if STREAM_RESPONSES:
+                # Ответ показывается по мере генерации, индикатор останавливается на первом фрагменте
+                response_text, tokens_used = await stream_message(
+                    message.chat.id, ask_openai_stream(model_name, messages, info=info),
+                    reply_markup=end_conversation_markup, indicator=indicator, reply=reply
+                )
+            else:
+                response_text, tokens_used = await ask_openai(model_name, messages, info=info)
+            usage["completion_tokens"] = tokens_used
+    except asyncio.CancelledError:
+        # Генерация прервана (см. `cancel_generation`): учитываются только полученные токены
+        cancelled = True
+        response_text, tokens_used = reply["text"], reply["tokens_used"]
+    finally:
+        # Заглушка остается, только если ее есть чем заменить
+        await indicator.stop(delete_placeholder=cancelled or not response_text.strip())
+    latency = loop.time() - started if started is not None and not cancelled else None
+    if not STREAM_RESPONSES and not cancelled:
+        await send_message_in_parts(
+            message.chat.id, response_text, reply_markup=end_conversation_markup,
+            first_message=indicator.placeholder
+        )
+
+    if info["model_name"] != model_name:
+        # Ответ получен от запасной модели и учитывается по ней
+        model = "GPT-3.5 Turbo"
+    elif cacheable and not cancelled and not response_text.endswith(OPENAI_ERROR_TEXT):
+        response_cache.put(model_name, messages, response_text)
+
+    # Сессия могла быть завершена или заменена во время генерации
+    if response_text:
+        session = await STATE.update_session(
+            user_id, dialog_id, lambda session: session.history.append("assistant", response_text)
+        )
+        if session is not None:
+            maybe_compact(user_id, session)
+    if cancelled and not tokens_used:
+        return
     current_date = datetime.now().strftime('%Y-%m-%d')
-    if user_id not in USER_ANALYTICS:
-        USER_ANALYTICS[user_id] = {}
-    if current_date not in USER_ANALYTICS[user_id]:
-        USER_ANALYTICS[user_id][current_date] = {"GPT-3.5 Turbo": 0, "GPT-4": 0}
-    USER_ANALYTICS[user_id][current_date][model] += tokens_used
+    await STATE.incr_usage(user_id, current_date, model, tokens_used)
 
-    user_info = ALLOWED_USERS.get(user_id, {})
+    user_info = user_service.ALLOWED_USERS.get(user_id, {})
     full_name = user_info.get("full_name", "Неизвестный")
     telegram_handle = user_info.get("telegram_handle", "Неизвестный")
-    await send_message_in_parts(message.chat.id,response_text,reply_markup=end_conversation_markup)
-    await update_or_add_to_gsheets(full_name, telegram_handle, model, tokens_used)
+    usage_store.record_event(user_id, full_name, telegram_handle, model, prompt_tokens, tokens_used, latency)
 
-@dp.message_handler(lambda message: message.text == '❌ Завершить диалог' and message.from_user.id in USER_MODEL_CHOICE)
+@dp.message_handler(ends_dialog)
 async def end_dialog(message: types.Message):
     """
     Обрабатывает завершение диалога с чат-ботом.
@@ -103,36 +283,11 @@ async def end_dialog(message: types.Message):
         Входящее сообщение от пользователя.
     """
     user_id = message.from_user.id
-    if user_id in USER_MODEL_CHOICE:
-        del USER_MODEL_CHOICE[user_id]
+    PENDING_MESSAGES.pop(user_id, None)
+    await STATE.cancel_generation(user_id)
+    await STATE.delete_session(user_id)
     await message.answer("Диалог завершен. Хотите начать снова? Нажмите /start.", reply_markup=types.ReplyKeyboardRemove())
 
-def truncate_history(history, max_tokens=15500): 
-    """
-    Усекает историю диалога, чтобы соответствовать указанному лимиту токенов.
-    
-    Параметры:
-    ----------
-    history : str
-        Текущая история диалога в виде строки.
-    
-    max_tokens : int, необязательно
-        Максимальное количество токенов для усечения.
-
-    Возвращает:
-    -------
-    str
-        Усеченная история диалога.
-    """
-    # Разбиваем историю на строки
-    lines = history.split("\n")
-    
-    while len(history) > max_tokens:
-        # Удаляем старые строки из истории
-        lines.pop(0)
-        history = "\n".join(lines)
-    return history
-
 @dp.message_handler(content_types=types.ContentTypes.TEXT)
 async def unknown_input(message: types.Message):
     """
@@ -148,28 +303,7 @@ async def unknown_input(message: types.Message):
     )
     await dp.bot.send_message(message.chat.id, response_text)
 
-async def animate_typing(message: types.Message):
-    """
-    Имитирует анимацию печати бота для обратной связи с пользователем.
-    
-    Параметры:
-    ----------
-    message : types.Message
-        Входящее сообщение от пользователя.
-    """
-    global stop_typing
-    animation = ["Бот печатает.", "Бот печатает..", "Бот печатает..."]
-    idx = 0
-    sent_message = await message.answer(animation[idx])
-    
-    while not stop_typing:
-        idx = (idx + 1) % 3
-        await sent_message.edit_text(animation[idx])
-        await asyncio.sleep(1)
-        
-    await sent_message.delete()
-
-async def send_message_in_parts(chat_id, text, reply_markup, delay=1):
+async def send_message_in_parts(chat_id, text, reply_markup, first_message=None):
     """
     Отправляет длинные сообщения частями, если они превышают максимально допустимую длину сообщения.
     
@@ -184,12 +318,102 @@ async def send_message_in_parts(chat_id, text, reply_markup, delay=1):
     reply_markup : тип ReplyMarkup, необязательно
         Ответная разметка для сообщения.
 
-    delay : int, необязательно
-        Задержка между отправкой нескольких частей сообщения.
+    first_message : types.Message, необязательно
+        Уже отправленное сообщение (например, заглушка индикатора печати), которое
+        редактируется в первую часть ответа вместо отправки нового сообщения.
     """
     parts = [text[i:i+MAX_MESSAGE_LENGTH] for i in range(0, len(text), MAX_MESSAGE_LENGTH)]
     
-    for part in parts:
-        await dp.bot.send_message(chat_id, part, reply_markup=reply_markup)
-        if len(parts) > 1:
-            await asyncio.sleep(delay)
+    for index, part in enumerate(parts):
+        # Темп отправки задает планировщик `telegram_sender`; продолжения уступают первым частям других ответов
+        with send_priority(PRIORITY_CONTINUATION if index > 0 else PRIORITY_FIRST):
+            if index == 0 and first_message is not None:
+                await first_message.edit_text(part)
+            else:
+                await dp.bot.send_message(chat_id, part, reply_markup=reply_markup)
+
+
+async def stream_message(chat_id, chunks, reply_markup, indicator=None, reply=None):
+    """
+    Показывает ответ модели по мере его генерации, постепенно редактируя сообщение.
+
+    Редактирование выполняется не чаще, чем раз в `STREAM_EDIT_INTERVAL` секунд, чтобы не превышать
+    лимиты Telegram. Когда текст превышает `MAX_MESSAGE_LENGTH`, текущее сообщение фиксируется
+    и продолжение выводится в новом сообщении.
+
+    Параметры:
+    ----------
+    chat_id : int
+        ID чата, куда нужно отправить ответ.
+
+    chunks : AsyncIterator[str]
+        Фрагменты ответа модели (например, из `ask_openai_stream`).
+
+    reply_markup : тип ReplyMarkup, необязательно
+        Ответная разметка, прикрепляемая к каждому новому сообщению.
+
+    indicator : TypingIndicator, необязательно
+        Индикатор печати, который останавливается при получении первого фрагмента.
+        Его сообщение-заглушка, если есть, редактируется в первую часть ответа.
+
+    reply : dict, необязательно
+        Если генерация прервана, в ключи "text" и "tokens_used" записывается уже полученная часть ответа.
+
+    Возвращает:
+    -------
+    str
+        Полный текст ответа.
+    int
+        Количество полученных фрагментов (токенов) ответа.
+    """
+    loop = asyncio.get_event_loop()
+    parts = []
+    current = ""
+    sent_message = None
+    shown = ""
+    last_edit = 0.0
+    tokens_used = 0
+
+    async def show(text):
+        nonlocal sent_message, shown, last_edit, indicator
+        if not text.strip() or text == shown:
+            return
+        if indicator is not None:
+            await indicator.stop()
+            sent_message, indicator.placeholder = indicator.placeholder, None
+            indicator = None
+        if sent_message is None:
+            with send_priority(PRIORITY_CONTINUATION if parts else None):
+                sent_message = await dp.bot.send_message(chat_id, text, reply_markup=reply_markup)
+        else:
+            await sent_message.edit_text(text)
+        shown = text
+        last_edit = loop.time()
+
+    try:
+        async for delta in chunks:
+            tokens_used += 1
+            current += delta
+            while len(current) > MAX_MESSAGE_LENGTH:
+                # Фиксируем заполненное сообщение и продолжаем в новом
+                await show(current[:MAX_MESSAGE_LENGTH])
+                parts.append(current[:MAX_MESSAGE_LENGTH])
+                current = current[MAX_MESSAGE_LENGTH:]
+                sent_message, shown = None, ""
+            if loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                await show(current)
+    except asyncio.CancelledError:
+        if reply is not None:
+            reply["text"] = "".join(parts) + current
+            reply["tokens_used"] = tokens_used
+        raise
+    finally:
+        # Закрывает поток ответа OpenAI, в том числе при отмене
+        await chunks.aclose()
+
+    await show(current)
+    if indicator is not None:
+        # Ответ оказался пустым
+        await indicator.stop(delete_placeholder=True)
+    parts.append(current)
+    return "".join(parts), tokens_used
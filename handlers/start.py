@@ -5,7 +5,7 @@ Handles the /start command in the Telegram bot.
 
 from aiogram import types
 from services.markups import get_model_choice_markup
-from services.user_service import ALLOWED_USERS
+from services import user_service
 from loader import dp
 
 ADMIN_HANDLE = "@Shadekss"
@@ -33,8 +33,8 @@ async def start(message: types.Message):
     Также функция использует глобальную переменную `ADMIN_HANDLE` для вывода контактов администратора при отказе в доступе.
     """
     user_id = message.from_user.id
-    if user_id in ALLOWED_USERS:
-        user_info = ALLOWED_USERS[user_id]
+    user_info = user_service.ALLOWED_USERS.get(user_id)
+    if user_info is not None:
         full_name = user_info.get("full_name", "Неизвестный")
 
         markup = get_model_choice_markup(user_id)
@@ -1,21 +1,53 @@
 """
 Loader module for initializing the bot and loading necessary data.
 """
-import asyncio
-from aiogram import Bot, Dispatcher
+import logging
+import time
+from aiogram import Dispatcher
 import openai
 from config import TOKEN, OPENAI_API_KEY
-from services.user_service import (
-    load_users_from_google_sheets,
-    load_admins_from_google_sheets
-)
+from services.telegram_sender import ScheduledBot
+from services.user_service import load_allow_list_snapshot
+
+# Длительность этапов запуска, в секундах: этап -> время
+STARTUP_TIMINGS = {}
+_startup_mark = time.monotonic()
+
+def mark_startup(phase):
+    """
+    Фиксирует длительность этапа запуска с момента предыдущей отметки.
+
+    Параметры
+    ----------
+    phase : str
+        Название этапа.
+
+    Возвращает
+    -------
+    None
+    """
+    global _startup_mark
+    now = time.monotonic()
+    STARTUP_TIMINGS[phase] = now - _startup_mark
+    _startup_mark = now
+
+def log_startup_timings():
+    """
+    Логирует разбивку времени запуска по этапам.
+
+    Возвращает
+    -------
+    None
+    """
+    breakdown = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in STARTUP_TIMINGS.items())
+    logging.info(f"Startup finished in {sum(STARTUP_TIMINGS.values()):.3f}s: {breakdown}")
 
 # Initialize the bot, dispatcher, and OpenAI API key
-bot = Bot(token=TOKEN)
+bot = ScheduledBot(token=TOKEN)
 dp = Dispatcher(bot)
 openai.api_key = OPENAI_API_KEY
+mark_startup("bot")
 
-# Load users and admins before the bot starts.
-loop = asyncio.get_event_loop()
-loop.run_until_complete(load_users_from_google_sheets('dppcommands-7a27921d2259.json', 'Верификация GPT ITC'))
-loop.run_until_complete(load_admins_from_google_sheets('dppcommands-7a27921d2259.json', 'Админы GPT ITC'))
+# Users and admins come from the last saved snapshot; the live refresh from Google Sheets runs in the background
+load_allow_list_snapshot()
+mark_startup("allow_list_snapshot")
@@ -3,31 +3,83 @@ Analytics Service module.
 Handles operations related to analytics data updates in Google Sheets.
 """
 
+import asyncio
+import logging
+import time
 from datetime import datetime
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from services.sheets_client import get_worksheet, invalidate_worksheet, call_sheets
+from services.user_service import STATE
+from config import ANALYTICS_FLUSH_INTERVAL, ANALYTICS_FLUSH_SIZE, ANALYTICS_INDEX_TTL
 
 # Constants
-SCOPE = [
-    "https://spreadsheets.google.com/feeds",
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-]
-JSON_FILE_PATH = 'dppcommands-7a27921d2259.json'
 SHEET_NAME = 'Аналитика GPT ITC'
+# Цена токена запроса и токена ответа, $
 TOKEN_COSTS = {
-    "GPT-3.5 Turbo": 0.004/1000,
-    "GPT-4": 0.012/1000
+    "GPT-3.5 Turbo": {"prompt": 0.003/1000, "completion": 0.004/1000},
+    "GPT-4": {"prompt": 0.03/1000, "completion": 0.06/1000}
 }
 
-async def update_or_add_to_gsheets(full_name, telegram_handle, model, tokens_used):
+# Накопленные, но еще не записанные в таблицу токены и стоимость:
+# (full_name, telegram_handle, date, model, "tokens" или "cost") -> value
+_pending = {}
+_flush_lock = asyncio.Lock()
+
+# Индекс строк таблицы аналитики: (full_name, date) -> [row_num, tokens_gpt35, tokens_gpt4, cost]
+_row_index = {}
+_last_row = 0
+_index_loaded_at = None
+# Писала ли эта реплика таблицу при прошлой записи (см. `StateBackend.share_usage`)
+_was_writer = False
+
+# Получатель записей об использовании вместо локального буфера (см. `set_usage_sink`)
+_usage_sink = None
+
+def set_usage_sink(sink):
+    """
+    Перенаправляет записи `record_usage` в другой процесс.
+
+    В режиме нескольких процессов-обработчиков таблицу аналитики пишет только главный процесс,
+    чтобы процессы не добавляли новые строки в одни и те же позиции таблицы.
+
+    Параметры
+    ----------
+    sink : Callable[[str, str, str, float], None] or None
+        Функция, получающая аргументы `record_usage`. None — запись в локальный буфер.
+
+    Возвращает
+    -------
+    None
+    """
+    global _usage_sink
+    _usage_sink = sink
+
+def usage_cost(model, prompt_tokens, completion_tokens):
+    """
+    Рассчитывает стоимость запроса к модели по ценам `TOKEN_COSTS`.
+
+    Параметры
+    ----------
+    model : str
+        Модель ("GPT-3.5 Turbo" или "GPT-4").
+    prompt_tokens : int
+        Количество токенов запроса.
+    completion_tokens : int
+        Количество токенов ответа.
+
+    Возвращает
+    -------
+    float
+        Стоимость запроса, $.
     """
-    Обновление или добавление данных аналитики в Google Таблицы.
+    costs = TOKEN_COSTS[model]
+    return prompt_tokens * costs["prompt"] + completion_tokens * costs["completion"]
 
-    Функция обновляет или добавляет данные пользователя в Google Таблицы. Если пользователь с такими данными
-    и датой уже существует, обновляются данные этого пользователя. В противном случае данные добавляются в
-    новую строку.
+def record_usage(full_name, telegram_handle, model, prompt_tokens, completion_tokens):
+    """
+    Учитывает использование модели в буфере аналитики.
+
+    Функция только увеличивает счетчики токенов и стоимости в памяти; запись в Google Таблицы выполняется
+    пакетно функцией `flush_analytics` по таймеру или при заполнении буфера.
 
     Параметры
     ----------
@@ -37,8 +89,10 @@ async def update_or_add_to_gsheets(full_name, telegram_handle, model, tokens_use
         Идентификатор пользователя в Telegram.
     model : str
         Имя модели, которую использовал пользователь ("GPT-3.5 Turbo" или другая).
-    tokens_used : float
-        Количество использованных токенов при запросе к модели.
+    prompt_tokens : int
+        Количество токенов запроса.
+    completion_tokens : int
+        Количество токенов ответа.
 
     Возвращает
     -------
@@ -46,37 +100,207 @@ async def update_or_add_to_gsheets(full_name, telegram_handle, model, tokens_use
 
     Примечания
     ----------
-    Для доступа к Google Таблицам функция использует глобальные переменные `JSON_FILE_PATH`, `SCOPE` и `SHEET_NAME`.
-    Также функция использует глобальный словарь `TOKEN_COSTS` для расчета стоимости использованных токенов.
+    Если в буфере накопилось `ANALYTICS_FLUSH_SIZE` записей, запускается внеочередная запись в таблицу.
     """
-    # Setup Google Sheet client
-    creds = ServiceAccountCredentials.from_json_keyfile_name(JSON_FILE_PATH, SCOPE)
-    client = gspread.authorize(creds)
-    worksheet = client.open(SHEET_NAME).get_worksheet(0)
+    if _usage_sink is not None:
+        _usage_sink(full_name, telegram_handle, model, prompt_tokens, completion_tokens)
+        return
 
-    # Current date
     current_date = datetime.now().strftime('%Y-%m-%d')
+    for field, value in (("tokens", prompt_tokens + completion_tokens),
+                         ("cost", usage_cost(model, prompt_tokens, completion_tokens))):
+        key = (full_name, telegram_handle, current_date, model, field)
+        _pending[key] = _pending.get(key, 0) + value
 
-    # Find the row with matching user details
-    cell_list = [cell.strip() for cell in worksheet.col_values(1)]
-    for index, cell_value in enumerate(cell_list, start=1):
-        if cell_value == full_name.strip() and worksheet.cell(index, 3).value == current_date:
-            row_num = index
-            break
-    else:
-        row_num = cell_list.index('') if '' in cell_list else len(cell_list) + 1
+    if len(_pending) >= ANALYTICS_FLUSH_SIZE and not _flush_lock.locked():
+        asyncio.get_event_loop().create_task(flush_analytics())
 
-    # Update or set data
-    worksheet.update(f"A{row_num}:C{row_num}", [[full_name, telegram_handle, current_date]])
+async def flush_analytics():
+    """
+    Записывает накопленную аналитику в Google Таблицы одним пакетным запросом.
+
+    Запрос выполняется в пуле потоков Google Таблиц (см. `call_sheets`), поэтому обработка
+    сообщений во время записи не останавливается. При нескольких репликах аналитика сначала
+    передается в общее хранилище, и таблицу пишет только одна из реплик (см. `StateBackend.share_usage`),
+    поэтому реплики не перезаписывают строки и итоги друг друга.
+
+    Возвращает
+    -------
+    None
+
+    Исключения
+    ----------
+    Exception
+        При ошибке записи сообщение об ошибке логируется, а данные возвращаются в буфер
+        для следующей попытки.
+    """
+    global _pending, _was_writer
+    async with _flush_lock:
+        batch, _pending = _pending, {}
+        try:
+            shared = await STATE.share_usage(batch)
+        except Exception as exc:
+            logging.error(f"Error sharing analytics with other replicas: {exc}")
+            for key, value in batch.items():
+                _pending[key] = _pending.get(key, 0) + value
+            return
+        if shared is not None and not _was_writer:
+            # Пока таблицу писала другая реплика, индекс строк устарел
+            invalidate_row_index()
+        _was_writer = shared is not None
+        batch = shared
+        if not batch:
+            return
+        try:
+            # Запись добавляет токены к значениям индекса, поэтому не повторяется по таймауту:
+            # при ошибке пакет возвращается в буфер и индекс перечитывается
+            await call_sheets(_write_batch, batch, timeout=None, retries=0)
+        except Exception as exc:
+            logging.error(f"Error flushing analytics to Google Sheets: {exc}")
+            # Таблица могла измениться: индекс строк перечитывается при следующей записи
+            invalidate_row_index()
+            invalidate_worksheet(SHEET_NAME)
+            for key, value in batch.items():
+                _pending[key] = _pending.get(key, 0) + value
+
+async def flush_analytics_periodically():
+    """
+    Периодически записывает буфер аналитики в Google Таблицы с интервалом `ANALYTICS_FLUSH_INTERVAL`.
+
+    Возвращает
+    -------
+    None
+    """
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+        await flush_analytics()
+
+def _parse_number(row, index):
+    """
+    Читает число из ячейки строки таблицы, учитывая десятичную запятую.
+
+    Параметры
+    ----------
+    row : list[str]
+        Значения строки таблицы.
+    index : int
+        Индекс столбца (с нуля).
+
+    Возвращает
+    -------
+    float
+        Значение ячейки или 0, если ячейка пуста или не является числом.
+    """
+    try:
+        return float(row[index].replace(',', '.'))
+    except (IndexError, ValueError):
+        return 0.0
+
+def invalidate_row_index():
+    """
+    Помечает индекс строк таблицы аналитики устаревшим, чтобы он был перечитан при следующей записи.
+
+    Возвращает
+    -------
+    None
+    """
+    global _index_loaded_at
+    _index_loaded_at = None
+
+def _load_row_index(worksheet):
+    """
+    Загружает индекс строк таблицы аналитики одним вызовом `get_all_values`.
+
+    Параметры
+    ----------
+    worksheet : gspread.Worksheet
+        Лист таблицы аналитики.
+
+    Возвращает
+    -------
+    None
 
-    tokens_gpt35 = float(worksheet.cell(row_num, 4).value.replace(',', '.')) or 0
-    tokens_gpt4 = float(worksheet.cell(row_num, 5).value.replace(',', '.')) or 0
+    Примечания
+    ----------
+    Функция обновляет глобальные переменные `_row_index`, `_last_row` и `_index_loaded_at`.
+    Если для пользователя и даты есть несколько строк, используется первая из них.
+    """
+    global _row_index, _last_row, _index_loaded_at
+    values = worksheet.get_all_values()
+    row_index = {}
+    for index, row in enumerate(values, start=1):
+        if len(row) >= 3:
+            row_index.setdefault(
+                (row[0].strip(), row[2]),
+                [index, _parse_number(row, 3), _parse_number(row, 4), _parse_number(row, 5)]
+            )
+    _row_index = row_index
+    _last_row = len(values)
+    _index_loaded_at = time.monotonic()
+
+def _write_batch(batch):
+    """
+    Обновление или добавление строк аналитики в Google Таблицы.
+
+    Для каждого пользователя и даты из пакета по индексу строк находится существующая строка
+    (или выделяется новая), к ее значениям добавляются накопленные токены и стоимость.
+    Все строки записываются одним вызовом `batch_update`, без чтения таблицы.
+
+    Параметры
+    ----------
+    batch : dict
+        Накопленные токены и стоимость в формате (full_name, telegram_handle, date, model, field) -> value,
+        где field — "tokens" или "cost".
+
+    Возвращает
+    -------
+    None
+
+    Примечания
+    ----------
+    Для доступа к Google Таблицам функция использует общий клиент `sheets_client` и глобальную переменную `SHEET_NAME`.
+    Стоимость рассчитывается при учете запроса (см. `usage_cost`): токены запроса и ответа имеют разную цену,
+    поэтому ее нельзя восстановить по сумме токенов в таблице.
+    Индекс строк перечитывается, если он старше `ANALYTICS_INDEX_TTL` секунд или был сброшен после ошибки.
+    """
+    global _last_row
+    worksheet = get_worksheet(SHEET_NAME)
+
+    if _index_loaded_at is None or time.monotonic() - _index_loaded_at > ANALYTICS_INDEX_TTL:
+        _load_row_index(worksheet)
+
+    # Find the rows with matching user details
+    last_row = _last_row
+    rows = {}
+    for (full_name, telegram_handle, date, model, field), value in batch.items():
+        key = (full_name.strip(), date)
+        if key not in rows:
+            entry = _row_index.get(key)
+            if entry is None:
+                last_row += 1
+                entry = [last_row, 0.0, 0.0, 0.0]
+            rows[key] = [entry[0], full_name, telegram_handle, date, entry[1], entry[2], entry[3]]
+
+        if field == "cost":
+            rows[key][6] += value
+        elif model == "GPT-3.5 Turbo":
+            rows[key][4] += value
+        else:
+            rows[key][5] += value
+
+    # Update or set data
+    data = []
+    for row_num, full_name, telegram_handle, date, tokens_gpt35, tokens_gpt4, cost in rows.values():
+        data.append({
+            "range": f"A{row_num}:F{row_num}",
+            "values": [[full_name, telegram_handle, date, tokens_gpt35, tokens_gpt4, cost]]
+        })
 
-    if model == "GPT-3.5 Turbo":
-        tokens_gpt35 += tokens_used
-    else:
-        tokens_gpt4 += tokens_used
+    if last_row > worksheet.row_count:
+        worksheet.add_rows(last_row - worksheet.row_count)
+    worksheet.batch_update(data)
 
-    cost = (tokens_gpt35 * TOKEN_COSTS["GPT-3.5 Turbo"]) + (tokens_gpt4 * TOKEN_COSTS["GPT-4"])
-    
-    worksheet.update(f"D{row_num}:F{row_num}", [[tokens_gpt35, tokens_gpt4, cost]])
+    # Индекс обновляется только после успешной записи
+    for key, (row_num, _, _, _, tokens_gpt35, tokens_gpt4, cost) in rows.items():
+        _row_index[key] = [row_num, tokens_gpt35, tokens_gpt4, cost]
+    _last_row = last_row
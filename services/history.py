@@ -0,0 +1,202 @@
+"""
+History module.
+Keeps the dialog history as a sequence of turns with cached token counts.
+"""
+
+import logging
+from collections import deque
+import tiktoken
+
+# Лимит токенов истории для каждой модели (с запасом под ответ модели)
+HISTORY_TOKEN_LIMITS = {
+    "GPT-3.5 Turbo": 12000,
+    "GPT-4": 6000
+}
+# Служебные токены, которые OpenAI добавляет к каждому сообщению
+TOKENS_PER_MESSAGE = 4
+ENCODING_NAME = 'cl100k_base'
+
+_encoding = None
+
+def load_encoding():
+    """
+    Загружает кодировку токенизатора.
+
+    Возвращает
+    -------
+    bool
+        True, если кодировка загружена.
+
+    Примечания
+    ----------
+    При первом запуске tiktoken скачивает файл кодировки (его можно заранее положить в каталог
+    `TIKTOKEN_CACHE_DIR`), поэтому функция блокирующая: вызывайте ее при запуске в пуле потоков.
+    Если загрузить кодировку не удалось, `count_tokens` использует оценку по длине текста.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding(ENCODING_NAME)
+        except Exception as exc:
+            logging.error(f"Error loading tokenizer, falling back to estimate: {exc}")
+            _encoding = False
+    return _encoding is not False
+
+def count_tokens(text):
+    """
+    Подсчитывает количество токенов в тексте локальным токенизатором.
+
+    Параметры
+    ----------
+    text : str
+        Текст для подсчета.
+
+    Возвращает
+    -------
+    int
+        Количество токенов.
+
+    Примечания
+    ----------
+    Используется кодировка `cl100k_base`, общая для GPT-3.5 Turbo и GPT-4, загруженная
+    `load_encoding`. Пока кодировка не загружена или если она недоступна, количество токенов
+    оценивается по длине текста в байтах: функция никогда не загружает кодировку сама.
+    """
+    if not _encoding:
+        return len(text.encode('utf-8')) // 3 + 1
+    return len(_encoding.encode(text))
+
+class DialogHistory:
+    """
+    История диалога в виде очереди реплик с заранее подсчитанным количеством токенов.
+
+    Каждая реплика хранится как кортеж (role, content, tokens). Общее количество токенов
+    поддерживается инкрементально, поэтому удаление старых реплик при превышении лимита
+    выполняется за амортизированное O(1) на реплику.
+
+    Параметры
+    ----------
+    max_tokens : int
+        Максимальное количество токенов в истории.
+    """
+
+    __slots__ = ("max_tokens", "turns", "total_tokens")
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.turns = deque()
+        self.total_tokens = 0
+
+    @classmethod
+    def from_turns(cls, max_tokens, turns):
+        """
+        Восстанавливает историю из сохраненных реплик без повторного подсчета токенов.
+
+        Параметры
+        ----------
+        max_tokens : int
+            Максимальное количество токенов в истории.
+        turns : list
+            Реплики в формате [role, content, tokens] (см. `to_turns`).
+
+        Возвращает
+        -------
+        DialogHistory
+            Восстановленная история.
+        """
+        history = cls(max_tokens)
+        for role, content, tokens in turns:
+            history.turns.append((role, content, tokens))
+            history.total_tokens += tokens
+        history.truncate()
+        return history
+
+    def to_turns(self):
+        """
+        Возвращает реплики истории в сериализуемом виде.
+
+        Возвращает
+        -------
+        list[list]
+            Реплики в формате [role, content, tokens].
+        """
+        return [list(turn) for turn in self.turns]
+
+    def append(self, role, content):
+        """
+        Добавляет реплику в историю и усекает историю до лимита токенов.
+
+        Параметры
+        ----------
+        role : str
+            Роль автора реплики ("user" или "assistant").
+        content : str
+            Текст реплики.
+
+        Возвращает
+        -------
+        None
+        """
+        tokens = count_tokens(content) + TOKENS_PER_MESSAGE
+        self.turns.append((role, content, tokens))
+        self.total_tokens += tokens
+        self.truncate()
+
+    def truncate(self):
+        """
+        Удаляет самые старые реплики, пока история превышает лимит токенов.
+
+        Последняя реплика сохраняется всегда, даже если сама превышает лимит.
+
+        Возвращает
+        -------
+        None
+        """
+        while self.total_tokens > self.max_tokens and len(self.turns) > 1:
+            _, _, tokens = self.turns.popleft()
+            self.total_tokens -= tokens
+
+    def replace_prefix(self, old_turns, content, role="system"):
+        """
+        Заменяет самые старые реплики одной репликой, например кратким содержанием.
+
+        Параметры
+        ----------
+        old_turns : list[tuple]
+            Заменяемые реплики в формате (role, content, tokens), как они были в начале истории.
+        content : str
+            Текст новой реплики.
+        role : str, необязательно
+            Роль новой реплики (по умолчанию "system").
+
+        Возвращает
+        -------
+        bool
+            True, если реплики заменены; False, если начало истории успело измениться
+            (например, реплики были удалены при усечении).
+        """
+        if len(self.turns) <= len(old_turns) or any(
+            self.turns[index] != turn for index, turn in enumerate(old_turns)
+        ):
+            return False
+        for _ in old_turns:
+            _, _, tokens = self.turns.popleft()
+            self.total_tokens -= tokens
+        tokens = count_tokens(content) + TOKENS_PER_MESSAGE
+        self.turns.appendleft((role, content, tokens))
+        self.total_tokens += tokens
+        return True
+
+    def to_messages(self):
+        """
+        Возвращает историю в формате списка сообщений Chat Completions API.
+
+        Возвращает
+        -------
+        list[dict]
+            Сообщения вида {"role": ..., "content": ...}.
+        """
+        return [{'role': role, 'content': content} for role, content, _ in self.turns]
+
+    def __len__(self):
+        return len(self.turns)
@@ -0,0 +1,141 @@
+"""
+Loop monitor module.
+Opt-in diagnostics for event-loop stalls: samples loop lag, enables asyncio slow-callback
+warnings and captures the stack of the bot code that blocked the loop.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from services.metrics import Counter, Histogram
+from config import LOOP_STALL_THRESHOLD, LOOP_SAMPLE_INTERVAL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Каталоги, по которым определяется место блокировки в коде бота
+CODE_DIRS = tuple(os.path.join(ROOT, name) + os.sep for name in ("handlers", "services"))
+
+LOOP_LAG_SECONDS = Histogram(
+    "chatitc_event_loop_lag_seconds", "Event loop scheduling lag, seconds",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+LOOP_STALLS = Counter("chatitc_event_loop_stalls_total", "Event loop stalls over the threshold", ("location",))
+
+def locate(frame):
+    """
+    Находит в стеке места в коде бота (`handlers/` и `services/`).
+
+    Параметры
+    ----------
+    frame : types.FrameType
+        Самый внутренний кадр стека.
+
+    Возвращает
+    -------
+    list[str]
+        Места в формате "services/sheets_client.py:read_rows", начиная с самого внутреннего.
+    """
+    locations = []
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(CODE_DIRS) and filename != os.path.abspath(__file__):
+            locations.append(f"{os.path.relpath(filename, ROOT)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return locations
+
+class LoopMonitor:
+    """
+    Сторож цикла событий.
+
+    Задача в цикле событий каждые `interval` секунд отмечается и измеряет задержку своего
+    пробуждения. Отдельный поток проверяет отметки: если цикл не отвечает дольше `threshold`
+    секунд, поток снимает стек потока цикла событий, пока блокирующий код еще выполняется.
+    Когда цикл освобождается, блокировка логируется с длительностью, местом в коде бота и стеком.
+    Дополнительно включается отладочный режим asyncio, который предупреждает о каждом
+    обратном вызове, выполнявшемся дольше `threshold`.
+
+    Параметры
+    ----------
+    threshold : float
+        Длительность блокировки цикла, после которой она считается зависанием, в секундах.
+    interval : float
+        Интервал замеров задержки, в секундах.
+    """
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self._heartbeat = None
+        self._stall = None
+        self._thread_id = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Запускает замеры в текущем цикле событий и поток-сторож.
+
+        Возвращает
+        -------
+        None
+        """
+        loop = asyncio.get_event_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.threshold
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = loop.create_task(self._sample())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        logging.info(f"Event loop monitor started: threshold {self.threshold}s")
+
+    def stop(self):
+        """
+        Останавливает замеры и поток-сторож.
+
+        Возвращает
+        -------
+        None
+        """
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self):
+        while True:
+            heartbeat = self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - heartbeat - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag < self.threshold:
+                continue
+            stall, self._stall = self._stall, None
+            if stall is None or stall[0] != heartbeat:
+                # Сторож не успел снять стек: блокировка была короче интервала проверки
+                LOOP_STALLS.inc("unknown")
+                logging.warning(f"Event loop blocked for {lag:.2f}s")
+                continue
+            _, locations, stack = stall
+            location = locations[0] if locations else "unknown"
+            LOOP_STALLS.inc(location)
+            logging.warning(
+                f"Event loop blocked for {lag:.2f}s at {location} ({' <- '.join(locations)})\n{stack}"
+            )
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            if time.monotonic() - heartbeat < self.interval + self.threshold:
+                continue
+            if self._stall is not None and self._stall[0] == heartbeat:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            self._stall = (heartbeat, locate(frame), "".join(traceback.format_stack(frame)))
+
+loop_monitor = LoopMonitor(LOOP_STALL_THRESHOLD, LOOP_SAMPLE_INTERVAL)
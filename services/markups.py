@@ -4,13 +4,14 @@ Contains keyboard markup utilities for the bot's user interface.
 """
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from services.user_service import ADMINS
+from services import user_service
 
 def get_model_choice_markup(user_id):
     """
     Создаёт и возвращает клавиатуру выбора модели на основе прав пользователя.
     
-    Пользователям с административными правами добавляется дополнительная кнопка для аналитики.
+    Пользователям с административными правами добавляются дополнительные кнопки для аналитики
+    и обновления списков пользователей.
 
     Параметры
     ----------
@@ -32,8 +33,9 @@ def get_model_choice_markup(user_id):
         InlineKeyboardButton("❓ Помощь", callback_data="help")
     )
     # Добавить кнопку аналитики для админов
-    if user_id in ADMINS:
+    if user_id in user_service.ADMINS:
         markup.add(InlineKeyboardButton("📊 Аналитика", callback_data="show_analytics"))
+        markup.add(InlineKeyboardButton("🔄 Обновить списки", callback_data="refresh_allow_lists"))
     
     return markup
     
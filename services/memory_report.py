@@ -0,0 +1,70 @@
+"""
+Memory report module.
+Estimates how much memory the bot's in-process state takes, per component.
+"""
+
+import sys
+from collections import deque
+from services import user_service
+from services import analytics_service
+from services.response_cache import response_cache
+from services.telegram_sender import scheduler
+
+def deep_sizeof(obj, seen=None):
+    """
+    Оценивает размер объекта в памяти вместе со вложенными объектами.
+
+    Параметры
+    ----------
+    obj : Any
+        Объект.
+    seen : set, необязательно
+        ID уже учтенных объектов (общие объекты учитываются один раз).
+
+    Возвращает
+    -------
+    int
+        Размер в байтах.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+def memory_report():
+    """
+    Собирает оценку памяти по компонентам бота.
+
+    Возвращает
+    -------
+    dict
+        Компонент -> (количество записей, размер в байтах).
+
+    Примечания
+    ----------
+    Учитываются только сессии, загруженные в память; выгруженные сессии хранятся на диске.
+    Обход всех объектов занимает время, поэтому отчет строится только по запросу.
+    """
+    sessions = dict(user_service.USER_MODEL_CHOICE.items())
+    return {
+        "Сессии в памяти": (len(sessions), deep_sizeof(sessions)),
+        "Счетчики токенов": (len(user_service.USER_ANALYTICS), deep_sizeof(user_service.USER_ANALYTICS)),
+        "Списки доступа": (
+            len(user_service.ALLOWED_USERS) + len(user_service.ADMINS),
+            deep_sizeof(user_service.ALLOWED_USERS) + deep_sizeof(user_service.ADMINS)
+        ),
+        "Буфер аналитики": (len(analytics_service._pending), deep_sizeof(analytics_service._pending)),
+        "Кэш ответов": (len(response_cache._cache), response_cache.size_bytes),
+        "Очередь Telegram": (len(scheduler), deep_sizeof(scheduler._queue))
+    }
@@ -0,0 +1,292 @@
+"""
+Metrics module.
+Minimal in-process metrics registry (counters, gauges and histograms) rendered in the
+Prometheus text format and served over HTTP, plus a middleware timing bot handlers.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from config import METRICS_ENABLED, METRICS_PATH, WEBAPP_HOST
+
+# Границы корзин гистограмм времени по умолчанию, в секундах
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+_runner = None
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    """
+    Базовый класс метрики: имя, описание, имена меток и значения по наборам меток.
+
+    Метрика регистрируется при создании. Изменение значения берет блокировку, поэтому
+    метрики можно обновлять и из потоков (например, из пула потоков Google Таблиц).
+
+    Параметры
+    ----------
+    name : str
+        Имя метрики.
+    documentation : str
+        Описание метрики.
+    labels : tuple[str], необязательно
+        Имена меток.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self):
+        """
+        Возвращает строки метрики в текстовом формате Prometheus.
+        """
+        with self._lock:
+            items = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples(items))
+        return lines
+
+    def _samples(self, items):
+        for labels, value in items:
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+class Counter(Metric):
+    """
+    Монотонно растущий счетчик.
+    """
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        """
+        Увеличивает счетчик для набора меток `labels` на `amount`.
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """
+    Текущее значение. Если задана функция `function`, значение вычисляется при каждом
+    чтении метрик: функция возвращает число, словарь {метки: число} или None (нет данных).
+
+    Параметры
+    ----------
+    name : str
+        Имя метрики.
+    documentation : str
+        Описание метрики.
+    labels : tuple[str], необязательно
+        Имена меток.
+    function : Callable[[], Any], необязательно
+        Функция, вычисляющая значение.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = None
+            if value is None:
+                return []
+            with self._lock:
+                self._values = value if isinstance(value, dict) else {(): value}
+        return super().render()
+
+class Histogram(Metric):
+    """
+    Распределение значений по корзинам с суммой и количеством наблюдений.
+
+    Параметры
+    ----------
+    name : str
+        Имя метрики.
+    documentation : str
+        Описание метрики.
+    labels : tuple[str], необязательно
+        Имена меток.
+    buckets : tuple[float], необязательно
+        Верхние границы корзин по возрастанию (по умолчанию `LATENCY_BUCKETS`).
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        Учитывает наблюдение `value` для набора меток `labels`.
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """
+        Учитывает длительность блока `with`, в секундах.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, *labels)
+
+    def _samples(self, items):
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labels, labels, 'le="' + le + '"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {count}"
+
+def render():
+    """
+    Возвращает все зарегистрированные метрики в текстовом формате Prometheus.
+
+    Возвращает
+    -------
+    str
+        Текст для ответа на запрос `METRICS_PATH`.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+HANDLER_SECONDS = Histogram("chatitc_handler_seconds", "Handler processing time, seconds", ("handler",))
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Middleware, учитывающий время обработки сообщений и callback-запросов по обработчикам.
+
+    Имя обработчика берется из функции, выбранной диспетчером (префикс `on_` обработчиков
+    из `app.py` отбрасывается), например `process_model_dialog` или `model_selection`.
+    """
+
+    @staticmethod
+    def _start(data):
+        handler = current_handler.get(None)
+        name = getattr(handler, "__name__", "unknown")
+        data["metrics_handler"] = (name[3:] if name.startswith("on_") else name, time.monotonic())
+
+    @staticmethod
+    def _finish(data):
+        started = data.pop("metrics_handler", None)
+        if started is not None:
+            HANDLER_SECONDS.observe(time.monotonic() - started[1], started[0])
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish(data)
+
+async def handle_metrics(request):
+    """
+    Отвечает на запрос метрик текущего процесса.
+    """
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+def add_metrics_route(app):
+    """
+    Добавляет маршрут `METRICS_PATH` в aiohttp-приложение (например, сервер вебхука), если метрики включены.
+
+    Параметры
+    ----------
+    app : aiohttp.web.Application
+        Приложение.
+
+    Возвращает
+    -------
+    None
+    """
+    if METRICS_ENABLED:
+        app.router.add_get(METRICS_PATH, handle_metrics)
+
+async def start_metrics_server(port):
+    """
+    Запускает отдельный HTTP-сервер метрик, если метрики включены.
+
+    Используется, когда сервера вебхука нет (режим опроса) или в процессах-обработчиках.
+
+    Параметры
+    ----------
+    port : int
+        Порт сервера.
+
+    Возвращает
+    -------
+    None
+    """
+    global _runner
+    if not METRICS_ENABLED or _runner is not None:
+        return
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, port).start()
+    _runner = runner
+
+async def stop_metrics_server():
+    """
+    Останавливает HTTP-сервер метрик, запущенный `start_metrics_server`.
+    """
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,243 @@
+"""
+Model scheduler module.
+Limits concurrent model calls and their request/token rate per model tier and
+queues waiting requests fairly across users.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict, deque
+from services.rate_limit import TokenBucket
+from services.metrics import Gauge
+from config import MODEL_LIMITS
+
+class ModelTier:
+    """
+    Очередь запросов к одной модели с ограничением параллельности и бюджетом запросов и токенов в минуту.
+
+    Ожидающие запросы группируются по пользователям и обслуживаются по кругу (round-robin):
+    после каждого запроса пользователь перемещается в конец очереди, поэтому один активный
+    пользователь не может занять модель целиком.
+
+    Параметры
+    ----------
+    concurrency : int
+        Максимальное количество одновременных запросов к модели.
+    rpm : int
+        Максимальное количество запросов в минуту.
+    tpm : int
+        Максимальное количество токенов в минуту.
+    completion_reserve : int, необязательно
+        Сколько токенов ответа резервируется при запуске запроса. OpenAI учитывает в лимите токенов
+        и запрос, и ответ; после ответа резерв заменяется фактическим количеством токенов (см. `release`).
+    """
+
+    def __init__(self, concurrency, rpm, tpm, completion_reserve=0):
+        self.concurrency = concurrency
+        self.completion_reserve = completion_reserve
+        self.active = 0
+        self._requests = TokenBucket(rpm / 60, rpm)
+        self._tokens = TokenBucket(tpm / 60, tpm)
+        self._waiting = OrderedDict()
+        self._timer = None
+
+    def queue_length(self):
+        """
+        Возвращает количество ожидающих запросов.
+        """
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    def position(self, user_id):
+        """
+        Возвращает позицию пользователя в очереди (начиная с 1) или 0, если он не ждет.
+        """
+        for index, waiting_user in enumerate(self._waiting, start=1):
+            if waiting_user == user_id:
+                return index
+        return 0
+
+    def _wait_time(self, tokens):
+        now = time.monotonic()
+        return max(self._requests.delay(now), self._tokens.delay(now, tokens + self.completion_reserve))
+
+    def _start(self, tokens):
+        now = time.monotonic()
+        self._requests.consume(now)
+        self._tokens.consume(now, tokens + self.completion_reserve)
+        self.active += 1
+
+    async def acquire(self, user_id, tokens, on_queued=None):
+        """
+        Ожидает свободного слота для запроса пользователя.
+
+        Параметры
+        ----------
+        user_id : int
+            ID пользователя.
+        tokens : int
+            Оценка количества токенов запроса.
+        on_queued : Callable[[int], Awaitable], необязательно
+            Вызывается с позицией в очереди, если запрос не может быть выполнен сразу.
+            Ошибка уведомления логируется и не прерывает ожидание слота.
+
+        Возвращает
+        -------
+        None
+        """
+        if not self._waiting and self.active < self.concurrency and self._wait_time(tokens) == 0:
+            self._start(tokens)
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append((future, tokens))
+        self._dispatch()
+        try:
+            if not future.done() and on_queued is not None:
+                try:
+                    await on_queued(self.position(user_id))
+                except Exception as exc:
+                    logging.error(f"Error notifying user {user_id} about queue position: {exc}")
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # Слот уже был выделен, но запрос отменен или завершился ошибкой
+                self.release()
+            else:
+                self._discard(user_id, future)
+            raise
+
+    def release(self, completion_tokens=None):
+        """
+        Освобождает слот и запускает следующие запросы из очереди.
+
+        Параметры
+        ----------
+        completion_tokens : int, необязательно
+            Фактическое количество токенов ответа. Разница с резервом возвращается в лимит
+            (или доплачивается); если количество неизвестно, резерв остается потраченным.
+
+        Возвращает
+        -------
+        None
+        """
+        if completion_tokens is not None:
+            self._tokens.refund(time.monotonic(), self.completion_reserve - completion_tokens)
+        self.active -= 1
+        self._dispatch()
+
+    def _discard(self, user_id, future):
+        waiters = self._waiting.get(user_id)
+        if waiters is None:
+            return
+        for waiter in waiters:
+            if waiter[0] is future:
+                waiters.remove(waiter)
+                break
+        if not waiters:
+            del self._waiting[user_id]
+
+    def _dispatch(self):
+        while self._waiting and self.active < self.concurrency:
+            user_id, waiters = next(iter(self._waiting.items()))
+            future, tokens = waiters[0]
+            wait = self._wait_time(tokens)
+            if wait > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_event_loop().call_later(wait, self._on_timer)
+                return
+
+            waiters.popleft()
+            del self._waiting[user_id]
+            if waiters:
+                # Пользователь уходит в конец круга
+                self._waiting[user_id] = waiters
+            if not future.done():
+                self._start(tokens)
+                future.set_result(None)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+class ModelScheduler:
+    """
+    Планировщик запросов к моделям: отдельная очередь `ModelTier` для каждой модели.
+
+    Параметры
+    ----------
+    limits : dict
+        Лимиты по моделям: {model: {"concurrency": ..., "rpm": ..., "tpm": ..., "completion_reserve": ...}}.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.tiers = {model: ModelTier(**tier_limits) for model, tier_limits in limits.items()}
+
+    def split(self, parts):
+        """
+        Оставляет этому процессу долю `1 / parts` лимитов каждой модели.
+
+        Используется в режиме нескольких процессов-обработчиков, чтобы суммарная нагрузка
+        на OpenAI не превышала общих лимитов. Вызывается до первого запроса к модели.
+
+        Параметры
+        ----------
+        parts : int
+            Количество процессов, делящих лимиты.
+
+        Возвращает
+        -------
+        None
+        """
+        self.tiers = {
+            model: ModelTier(
+                max(1, tier_limits["concurrency"] // parts),
+                tier_limits["rpm"] / parts,
+                tier_limits["tpm"] / parts,
+                tier_limits.get("completion_reserve", 0)
+            )
+            for model, tier_limits in self.limits.items()
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model, user_id, tokens, on_queued=None):
+        """
+        Контекстный менеджер, удерживающий слот модели на время запроса.
+
+        Параметры
+        ----------
+        model : str
+            Модель ("GPT-3.5 Turbo" или "GPT-4").
+        user_id : int
+            ID пользователя.
+        tokens : int
+            Оценка количества токенов запроса.
+        on_queued : Callable[[int], Awaitable], необязательно
+            Вызывается с позицией в очереди, если запрос ставится в очередь.
+
+        Возвращает
+        -------
+        dict
+            Словарь, в ключ "completion_tokens" которого следует записать фактическое
+            количество токенов ответа, чтобы уточнить резерв в лимите токенов.
+        """
+        tier = self.tiers[model]
+        await tier.acquire(user_id, tokens, on_queued)
+        usage = {"completion_tokens": None}
+        try:
+            yield usage
+        finally:
+            tier.release(usage["completion_tokens"])
+
+model_scheduler = ModelScheduler(MODEL_LIMITS)
+
+Gauge(
+    "chatitc_model_queue_length", "Requests waiting for a model slot", ("model",),
+    lambda: {(model,): tier.queue_length() for model, tier in model_scheduler.tiers.items()}
+)
+Gauge(
+    "chatitc_model_active_requests", "Requests holding a model slot", ("model",),
+    lambda: {(model,): tier.active for model, tier in model_scheduler.tiers.items()}
+)
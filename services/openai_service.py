@@ -1,24 +1,256 @@
 """
 OpenAI service module.
-Handles operations related to OpenAI requests.
+Handles operations related to OpenAI requests: per-model deadlines, retries with backoff,
+hedged requests, fallback from GPT-4 to GPT-3.5 Turbo and request statistics.
 """
 
-import openai
 import asyncio
+import logging
+import random
+from collections import Counter, defaultdict, deque
+import aiohttp
+import openai
+from services.metrics import Counter as MetricCounter, Histogram
+from config import (
+    OPENAI_POOL_SIZE,
+    OPENAI_REQUEST_TIMEOUT,
+    OPENAI_STREAM_READ_TIMEOUT,
+    OPENAI_DEADLINES,
+    OPENAI_RETRIES,
+    OPENAI_BACKOFF,
+    OPENAI_HEDGE,
+    OPENAI_FALLBACK,
+    OPENAI_FALLBACK_RESERVE
+)
+
+# Ответ, который возвращается пользователю при ошибке запроса к OpenAI
+OPENAI_ERROR_TEXT = "Ошибка OpenAI"
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    asyncio.TimeoutError,
+    aiohttp.ClientError
+)
+# Модель, на которую переключается запрос, если основная не успевает ответить
+FALLBACK_MODELS = {"gpt-4": "gpt-3.5-turbo-16k"}
+# Минимальное количество замеров для оценки p95 задержки
+MIN_LATENCY_SAMPLES = 20
+
+OPENAI_REQUESTS = MetricCounter("chatitc_openai_requests_total", "OpenAI request outcomes and events", ("model", "outcome"))
+OPENAI_REQUEST_SECONDS = Histogram(
+    "chatitc_openai_request_seconds", "Successful OpenAI request attempt time, seconds", ("model",)
+)
+ASK_OPENAI_SECONDS = Histogram(
+    "chatitc_ask_openai_seconds", "Answer time including retries and fallback, seconds", ("model",)
+)
+OPENAI_TOKENS = MetricCounter("chatitc_openai_tokens_total", "OpenAI tokens used", ("model", "kind"))
+
+class OpenAIStats:
+    """
+    Статистика запросов к OpenAI: исходы по моделям и окно последних задержек.
+
+    Параметры
+    ----------
+    window : int
+        Количество последних успешных запросов, по которым оценивается задержка.
+    """
+
+    def __init__(self, window=200):
+        self.outcomes = Counter()
+        self._latencies = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, model_name, outcome, latency=None):
+        """
+        Учитывает исход запроса.
+
+        Параметры
+        ----------
+        model_name : str
+            Имя модели OpenAI.
+        outcome : str
+            "ok", имя класса ошибки или событие ("retry", "hedge", "fallback").
+        latency : float, необязательно
+            Длительность успешного запроса, в секундах.
+
+        Возвращает
+        -------
+        None
+        """
+        self.outcomes[(model_name, outcome)] += 1
+        OPENAI_REQUESTS.inc(model_name, outcome)
+        if latency is not None:
+            self._latencies[model_name].append(latency)
+            OPENAI_REQUEST_SECONDS.observe(latency, model_name)
+
+    def p95(self, model_name):
+        """
+        Возвращает 95-й перцентиль задержки успешных запросов или None, если замеров мало.
+        """
+        latencies = sorted(self._latencies[model_name])
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+openai_stats = OpenAIStats()
+
+# Общая HTTP-сессия для всех запросов к OpenAI (keep-alive соединения)
+_session = None
+
+def get_session():
+    """
+    Возвращает общую HTTP-сессию для запросов к OpenAI, создавая ее при первом обращении.
+
+    Сессия переиспользует keep-alive соединения; размер пула ограничен `OPENAI_POOL_SIZE`.
+
+    Возвращает
+    -------
+    aiohttp.ClientSession
+        Общая HTTP-сессия.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=OPENAI_POOL_SIZE)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+async def close_session():
+    """
+    Закрывает общую HTTP-сессию OpenAI. Вызывается при остановке бота.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def _create(model_name, messages, timeout, stream=False):
+    """
+    Один запрос к OpenAI, ограниченный таймаутом; исход и задержка учитываются в `openai_stats`.
+
+    Для потокового запроса таймаут ограничивает только ожидание начала ответа: aiohttp получает
+    таймаут подключения без общего таймаута, иначе длинный ответ обрывался бы на середине.
+    Паузы между фрагментами ограничивает `ask_openai_stream`.
+    """
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    try:
+        response = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(
+                model=model_name,
+                messages=messages,
+                stream=stream,
+                request_timeout=(OPENAI_REQUEST_TIMEOUT, None) if stream else min(OPENAI_REQUEST_TIMEOUT, timeout)
+            ),
+            timeout
+        )
+    except Exception as exc:
+        openai_stats.record(model_name, type(exc).__name__)
+        raise
+    openai_stats.record(model_name, "ok", loop.time() - started)
+    return response
+
+async def _hedged(model_name, messages, timeout):
+    """
+    Запрос к OpenAI с дублированием: если ответа нет дольше p95 задержки модели,
+    отправляется второй такой же запрос, и используется ответ, пришедший первым.
+    """
+    delay = openai_stats.p95(model_name) if OPENAI_HEDGE else None
+    loop = asyncio.get_event_loop()
+    first = loop.create_task(_create(model_name, messages, timeout))
+    if delay is None or delay >= timeout:
+        return await first
 
-async def ask_openai(model_name, prompt):
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            openai_stats.record(model_name, "hedge")
+            tasks.add(loop.create_task(_create(model_name, messages, timeout - delay)))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def _call_with_retries(model_name, messages, deadline, stream=False):
+    """
+    Запрос к модели с повторами до момента `deadline` (по часам цикла событий).
+
+    При временных ошибках (`RETRYABLE_ERRORS`) запрос повторяется до `OPENAI_RETRIES` раз
+    с экспоненциальной задержкой со случайным разбросом (full jitter).
+    """
+    loop = asyncio.get_event_loop()
+    attempt = 0
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        try:
+            if stream:
+                return await _create(model_name, messages, remaining, stream=True)
+            return await _hedged(model_name, messages, remaining)
+        except RETRYABLE_ERRORS as exc:
+            attempt += 1
+            delay = random.uniform(0, OPENAI_BACKOFF * 2 ** attempt)
+            if attempt > OPENAI_RETRIES or loop.time() + delay >= deadline:
+                raise
+            openai_stats.record(model_name, "retry")
+            logging.warning(f"OpenAI request to {model_name} failed ({exc!r}), retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def _request(model_name, messages, stream=False):
     """
-    Запрос к модели OpenAI с заданным запросом (prompt).
+    Запрос к OpenAI с дедлайном модели (`OPENAI_DEADLINES`) и переключением на запасную модель.
+
+    Если для модели есть запасная (`FALLBACK_MODELS`) и основная не ответила за время дедлайна
+    за вычетом `OPENAI_FALLBACK_RESERVE`, оставшееся время используется для запроса к запасной модели.
 
-    Функция асинхронно запрашивает модель OpenAI с помощью заданного запроса и возвращает ответ от модели,
+    Возвращает
+    -------
+    str
+        Имя модели, которая ответила.
+    Any
+        Ответ OpenAI.
+    """
+    deadline = asyncio.get_event_loop().time() + OPENAI_DEADLINES.get(model_name, OPENAI_REQUEST_TIMEOUT)
+    fallback = FALLBACK_MODELS.get(model_name) if OPENAI_FALLBACK else None
+    if fallback is not None:
+        try:
+            return model_name, await _call_with_retries(
+                model_name, messages, deadline - OPENAI_FALLBACK_RESERVE, stream
+            )
+        except RETRYABLE_ERRORS as exc:
+            openai_stats.record(model_name, "fallback")
+            logging.warning(f"OpenAI request to {model_name} failed ({exc!r}), falling back to {fallback}")
+            model_name = fallback
+    return model_name, await _call_with_retries(model_name, messages, deadline, stream)
+
+async def ask_openai(model_name, messages, info=None):
+    """
+    Запрос к модели OpenAI с заданной историей сообщений.
+
+    Функция асинхронно запрашивает модель OpenAI с помощью заданных сообщений и возвращает ответ от модели,
     а также количество использованных токенов.
 
     Параметры
     ----------
     model_name : str
         Имя модели OpenAI, к которой следует обратиться.
-    prompt : str
-        Запрос, который будет передан модели.
+    messages : list[dict]
+        Сообщения диалога в формате Chat Completions API (например, из `DialogHistory.to_messages`).
+    info : dict, необязательно
+        В ключ "model_name" записывается имя модели, которая ответила (с учетом переключения на запасную).
 
     Возвращает
     -------
@@ -34,18 +266,77 @@ async def ask_openai(model_name, prompt):
 
     Примечания
     ----------
-    Функция использует синхронный запрос к OpenAI, выполняемый в асинхронном режиме с помощью asyncio.
+    Запрос выполняется асинхронным клиентом OpenAI через общую HTTP-сессию (`get_session`)
+    с дедлайном модели, повторами, дублированием и переключением на запасную модель (см. `_request`).
+    Исходы и задержки запросов учитываются в `openai_stats`.
     """
-    loop = asyncio.get_event_loop()
-    
-    def synchronous_request():
+    openai.aiosession.set(get_session())
+    with ASK_OPENAI_SECONDS.time(model_name):
         try:
-            response = openai.ChatCompletion.create(
-                model=model_name,
-                messages=[{'role': 'user', 'content': prompt}]
-            )
-            return response.choices[0]['message']['content'], response['usage']['completion_tokens']
-        except:
-            return "Ошибка OpenAI", 0
+            model_name, response = await _request(model_name, messages)
+            if info is not None:
+                info["model_name"] = model_name
+            usage = response['usage']
+            OPENAI_TOKENS.inc(model_name, "prompt", amount=usage['prompt_tokens'])
+            OPENAI_TOKENS.inc(model_name, "completion", amount=usage['completion_tokens'])
+            return response.choices[0]['message']['content'], usage['completion_tokens']
+        except Exception as exc:
+            logging.error(f"Error during OpenAI request: {exc}")
+            return OPENAI_ERROR_TEXT, 0
+
+async def ask_openai_stream(model_name, messages, info=None):
+    """
+    Потоковый запрос к модели OpenAI с заданной историей сообщений.
+
+    Асинхронный генератор, который отдает текст ответа по мере его генерации моделью,
+    не дожидаясь окончания всего ответа.
+
+    Параметры
+    ----------
+    model_name : str
+        Имя модели OpenAI, к которой следует обратиться.
+    messages : list[dict]
+        Сообщения диалога в формате Chat Completions API (например, из `DialogHistory.to_messages`).
+    info : dict, необязательно
+        В ключ "model_name" записывается имя модели, которая отвечает.
 
-    return await loop.run_in_executor(None, synchronous_request)
+    Возвращает
+    -------
+    AsyncIterator[str]
+        Фрагменты (дельты) ответа модели. Каждый фрагмент соответствует примерно одному токену.
+
+    Исключения
+    ----------
+    Exception
+        В случае ошибки при запросе к OpenAI генератор отдает сообщение "Ошибка OpenAI" и завершается.
+
+    Примечания
+    ----------
+    Повторы и переключение на запасную модель возможны только до начала ответа. Длительность
+    всего ответа не ограничена, но пауза между фрагментами не может превышать `OPENAI_STREAM_READ_TIMEOUT`.
+    """
+    openai.aiosession.set(get_session())
+    requested_model = model_name
+    chunks = 0
+    try:
+        with ASK_OPENAI_SECONDS.time(requested_model):
+            model_name, response = await _request(model_name, messages, stream=True)
+            if info is not None:
+                info["model_name"] = model_name
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(response.__anext__(), OPENAI_STREAM_READ_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    delta = chunk.choices[0]['delta'].get('content')
+                    if delta:
+                        chunks += 1
+                        yield delta
+            finally:
+                # При досрочном закрытии генератора соединение с OpenAI закрывается, генерация прерывается
+                await response.aclose()
+                OPENAI_TOKENS.inc(model_name, "completion", amount=chunks)
+    except Exception as exc:
+        logging.error(f"Error during OpenAI streaming request: {exc}")
+        yield OPENAI_ERROR_TEXT
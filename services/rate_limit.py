@@ -0,0 +1,68 @@
+"""
+Rate limit module.
+Token bucket primitive shared by the Telegram send scheduler and the model call scheduler.
+"""
+
+import time
+
+class TokenBucket:
+    """
+    Ведро токенов для ограничения частоты запросов.
+
+    Параметры
+    ----------
+    rate : float
+        Количество токенов, добавляемых в секунду.
+    capacity : float
+        Максимальное количество накопленных токенов (допустимый всплеск).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now, amount=1):
+        """
+        Возвращает время ожидания до появления `amount` свободных токенов, в секундах.
+
+        Запрос больше емкости ведра ожидает полного ведра.
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, now, amount=1):
+        """
+        Забирает `amount` токенов.
+        """
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, now, amount):
+        """
+        Возвращает `amount` токенов, забранных с запасом; отрицательное `amount` забирает недостающие.
+        """
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def block(self, until):
+        """
+        Запрещает выдачу токенов до момента `until` (например, после ответа 429 от Telegram).
+        """
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
@@ -0,0 +1,138 @@
+"""
+Response cache module.
+Caches model answers for repeated prompts with LRU eviction, TTL and a memory cap.
+"""
+
+import hashlib
+import json
+from cachetools import TTLCache
+from config import (
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_FIRST_TURN_ONLY
+)
+
+# Примерные накладные расходы на одну запись кэша, в байтах
+ENTRY_OVERHEAD = 200
+
+class ResponseCache:
+    """
+    Кэш ответов модели по точному совпадению запроса.
+
+    Ключ — модель и хеш нормализованного списка сообщений. Записи вытесняются по LRU,
+    живут не дольше `ttl` секунд, а суммарный размер ответов ограничен `max_bytes`.
+
+    Параметры
+    ----------
+    enabled : bool
+        Включен ли кэш.
+    ttl : float
+        Время жизни записи, в секундах.
+    max_bytes : int
+        Максимальный суммарный размер закэшированных ответов, в байтах.
+    first_turn_only : bool
+        Кэшировать только первые ходы диалога (без контекста).
+    """
+
+    def __init__(self, enabled, ttl, max_bytes, first_turn_only):
+        self.enabled = enabled
+        self.first_turn_only = first_turn_only
+        self.hits = 0
+        self.misses = 0
+        self._cache = TTLCache(
+            maxsize=max_bytes, ttl=ttl,
+            getsizeof=lambda text: len(text.encode('utf-8')) + ENTRY_OVERHEAD
+        )
+
+    @staticmethod
+    def make_key(model_name, messages):
+        """
+        Строит ключ кэша: модель и SHA-256 сообщений с нормализованными пробелами.
+
+        Параметры
+        ----------
+        model_name : str
+            Имя модели OpenAI.
+        messages : list[dict]
+            Сообщения диалога.
+
+        Возвращает
+        -------
+        tuple
+            Ключ кэша.
+        """
+        normalized = [[message['role'], " ".join(message['content'].split())] for message in messages]
+        digest = hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return model_name, digest
+
+    def is_cacheable(self, messages):
+        """
+        Проверяет, можно ли использовать кэш для данного запроса.
+        """
+        return self.enabled and (not self.first_turn_only or len(messages) == 1)
+
+    def get(self, model_name, messages):
+        """
+        Возвращает закэшированный ответ или None.
+
+        Параметры
+        ----------
+        model_name : str
+            Имя модели OpenAI.
+        messages : list[dict]
+            Сообщения диалога.
+
+        Возвращает
+        -------
+        str or None
+            Ответ модели из кэша.
+        """
+        text = self._cache.get(self.make_key(model_name, messages))
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    def put(self, model_name, messages, text):
+        """
+        Сохраняет ответ модели в кэш.
+
+        Параметры
+        ----------
+        model_name : str
+            Имя модели OpenAI.
+        messages : list[dict]
+            Сообщения диалога.
+        text : str
+            Ответ модели.
+
+        Возвращает
+        -------
+        None
+        """
+        try:
+            self._cache[self.make_key(model_name, messages)] = text
+        except ValueError:
+            # Ответ больше всего кэша
+            pass
+
+    @property
+    def hit_ratio(self):
+        """
+        Доля запросов, обслуженных из кэша.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def size_bytes(self):
+        """
+        Текущий размер закэшированных ответов, в байтах.
+        """
+        return self._cache.currsize
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_FIRST_TURN_ONLY
+)
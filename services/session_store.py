@@ -0,0 +1,301 @@
+"""
+Session store module.
+Keeps dialog sessions (model choice and history) in memory and persists them to SQLite
+on the persistence mount, so dialogs survive restarts and deploys. Idle sessions are
+evicted from memory and reloaded from disk on the next message.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from services.history import DialogHistory, HISTORY_TOKEN_LIMITS
+
+class Session:
+    """
+    Сессия диалога: выбранная модель и история.
+
+    Параметры
+    ----------
+    model : str
+        Модель ("GPT-3.5 Turbo" или "GPT-4").
+    history : DialogHistory
+        История диалога.
+    dialog_id : str, необязательно
+        Идентификатор диалога, отличающий новый диалог от предыдущего с той же моделью.
+    """
+
+    __slots__ = ("model", "history", "dialog_id")
+
+    def __init__(self, model, history, dialog_id=None):
+        self.model = model
+        self.history = history
+        self.dialog_id = dialog_id or uuid.uuid4().hex
+
+class SessionStore(dict):
+    """
+    Словарь сессий диалога `user_id -> Session` с сохранением на диск.
+
+    При запуске из базы читается только список пользователей с сохраненными сессиями;
+    сама сессия загружается с диска при первом обращении к ней. Изменения не пишутся
+    сразу, а накапливаются и сохраняются пакетно функцией `flush` в одной транзакции.
+    Сессии, к которым давно не обращались, выгружаются из памяти функцией `evict_idle`.
+
+    Параметры
+    ----------
+    path : str
+        Путь к файлу базы SQLite. Если путь пустой или его каталог не существует,
+        сессии хранятся только в памяти.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._stored_ids = set()
+        self._dirty = set()
+        self._last_used = {}
+
+    def open(self):
+        """
+        Открывает базу сессий в режиме WAL и читает список сохраненных сессий.
+
+        Возвращает
+        -------
+        None
+
+        Примечания
+        ----------
+        Истории диалогов на этом этапе не читаются, поэтому открытие занимает миллисекунды
+        и не задерживает запуск бота.
+        """
+        if not self.path or not os.path.isdir(os.path.dirname(self.path) or '.'):
+            logging.info("Session persistence is disabled")
+            return
+        started = time.monotonic()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, model TEXT NOT NULL, history TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "dialog_id TEXT)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "dialog_id" not in columns:
+            # База, созданная до сохранения идентификатора диалога
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN dialog_id TEXT")
+        self._stored_ids = {row[0] for row in self._conn.execute("SELECT user_id FROM sessions")}
+        logging.info(
+            f"Session store opened: {len(self._stored_ids)} sessions in {time.monotonic() - started:.3f}s"
+        )
+
+    def close(self):
+        """
+        Закрывает базу сессий. Перед закрытием следует вызвать `flush`.
+
+        Возвращает
+        -------
+        None
+        """
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def touch(self, user_id):
+        """
+        Помечает сессию пользователя измененной, чтобы она была сохранена при следующем `flush`.
+
+        Параметры
+        ----------
+        user_id : int
+            ID пользователя.
+
+        Возвращает
+        -------
+        None
+        """
+        self._dirty.add(user_id)
+        self._last_used[user_id] = time.monotonic()
+
+    @property
+    def persistent(self):
+        """
+        Сохраняются ли сессии на диск.
+        """
+        return self._conn is not None
+
+    def __contains__(self, user_id):
+        return dict.__contains__(self, user_id) or user_id in self._stored_ids
+
+    def __missing__(self, user_id):
+        session = self._load(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        dict.__setitem__(self, user_id, session)
+        self._last_used[user_id] = time.monotonic()
+        return session
+
+    def __setitem__(self, user_id, session):
+        dict.__setitem__(self, user_id, session)
+        self._dirty.add(user_id)
+        self._last_used[user_id] = time.monotonic()
+
+    def __delitem__(self, user_id):
+        if not dict.__contains__(self, user_id) and user_id not in self._stored_ids:
+            raise KeyError(user_id)
+        dict.pop(self, user_id, None)
+        self._stored_ids.discard(user_id)
+        self._dirty.add(user_id)
+        self._last_used.pop(user_id, None)
+
+    def get(self, user_id, default=None):
+        try:
+            return self[user_id]
+        except KeyError:
+            return default
+
+    def _load(self, user_id):
+        """
+        Загружает сессию пользователя из базы.
+
+        Параметры
+        ----------
+        user_id : int
+            ID пользователя.
+
+        Возвращает
+        -------
+        Session or None
+            Сессия пользователя или None, если сессия не сохранена.
+        """
+        if self._conn is None or user_id not in self._stored_ids:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT model, history, dialog_id FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            self._stored_ids.discard(user_id)
+            return None
+        model, turns = row[0], json.loads(row[1])
+        return Session(model, DialogHistory.from_turns(HISTORY_TOKEN_LIMITS[model], turns), row[2])
+
+    def _write(self, upserts, deletes):
+        """
+        Записывает измененные и удаленные сессии в базу одной транзакцией.
+
+        Параметры
+        ----------
+        upserts : list[tuple]
+            Строки (user_id, model, history_json, updated_at, dialog_id) для вставки или обновления.
+        deletes : list[tuple]
+            Кортежи (user_id,) удаленных сессий.
+
+        Возвращает
+        -------
+        None
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO sessions (user_id, model, history, updated_at, dialog_id) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET model = excluded.model, "
+                "history = excluded.history, updated_at = excluded.updated_at, dialog_id = excluded.dialog_id",
+                upserts
+            )
+            self._conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+
+    async def flush(self):
+        """
+        Сохраняет накопленные изменения сессий на диск.
+
+        Сериализация выполняется в цикле событий, а запись в базу — в отдельном потоке,
+        чтобы не блокировать обработку сообщений.
+
+        Возвращает
+        -------
+        None
+
+        Исключения
+        ----------
+        Exception
+            При ошибке записи сообщение об ошибке логируется, а сессии остаются помеченными
+            измененными до следующей попытки.
+        """
+        if self._conn is None or not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts, deletes = [], []
+        for user_id in dirty:
+            session = dict.get(self, user_id)
+            if session is None:
+                deletes.append((user_id,))
+            else:
+                history = json.dumps(session.history.to_turns(), ensure_ascii=False)
+                upserts.append((user_id, session.model, history, now, session.dialog_id))
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._write, upserts, deletes)
+            # Сессия, завершенная во время записи, уже удалена из памяти и помечена для удаления с диска
+            self._stored_ids.update(row[0] for row in upserts if dict.__contains__(self, row[0]))
+        except Exception as exc:
+            logging.error(f"Error saving sessions: {exc}")
+            self._dirty |= dirty
+
+    def evict_idle(self, idle_ttl):
+        """
+        Выгружает из памяти сессии, к которым не обращались дольше `idle_ttl` секунд.
+
+        Сохраненные на диск сессии загружаются снова при следующем сообщении пользователя.
+        Если сохранение на диск отключено, выгруженная сессия завершается.
+
+        Параметры
+        ----------
+        idle_ttl : float
+            Время бездействия, после которого сессия выгружается, в секундах.
+
+        Возвращает
+        -------
+        int
+            Количество выгруженных сессий.
+        """
+        deadline = time.monotonic() - idle_ttl
+        idle = [
+            user_id for user_id, last_used in self._last_used.items()
+            if last_used < deadline and user_id not in self._dirty
+        ]
+        for user_id in idle:
+            dict.pop(self, user_id, None)
+            del self._last_used[user_id]
+            if self._conn is None:
+                self._stored_ids.discard(user_id)
+        if idle:
+            logging.info(f"Evicted {len(idle)} idle sessions, {dict.__len__(self)} left in memory")
+        return len(idle)
+
+    async def flush_periodically(self, interval, idle_ttl=None):
+        """
+        Периодически сохраняет изменения сессий на диск и выгружает неактивные сессии из памяти.
+
+        Параметры
+        ----------
+        interval : float
+            Интервал между сохранениями, в секундах.
+        idle_ttl : float, необязательно
+            Время бездействия, после которого сессия выгружается из памяти (см. `evict_idle`).
+
+        Возвращает
+        -------
+        None
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+            if idle_ttl:
+                self.evict_idle(idle_ttl)
@@ -0,0 +1,192 @@
+"""
+Google Sheets client module.
+Holds a single authorized gspread client and cached worksheet handles shared by all services,
+and runs all blocking Sheets calls in a dedicated thread pool with timeouts and retries.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+import gspread
+from services.metrics import Counter, Gauge, Histogram
+from config import SHEETS_WORKERS, SHEETS_TIMEOUT, SHEETS_RETRIES, SHEETS_BACKOFF
+
+# Constants
+SCOPE = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+]
+JSON_FILE_PATH = 'dppcommands-7a27921d2259.json'
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files/'
+
+_client = None
+_worksheets = {}
+# Отдельный пул потоков для запросов к Google Таблицам со своей очередью
+_executor = ThreadPoolExecutor(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+
+SHEETS_CALLS = Counter("chatitc_sheets_calls_total", "Google Sheets call attempts", ("call", "outcome"))
+SHEETS_CALL_SECONDS = Histogram("chatitc_sheets_call_seconds", "Google Sheets call attempt time, seconds", ("call",))
+SHEETS_EXECUTOR_BUSY = Gauge("chatitc_sheets_executor_busy", "Google Sheets threads running a call")
+Gauge("chatitc_sheets_executor_workers", "Google Sheets thread pool size", function=lambda: SHEETS_WORKERS)
+
+def get_client():
+    """
+    Возвращает общий авторизованный клиент Google Таблиц, создавая его при первом обращении.
+
+    Возвращает
+    -------
+    gspread.Client
+        Авторизованный клиент.
+
+    Примечания
+    ----------
+    Файл ключа служебной учетной записи `JSON_FILE_PATH` читается один раз. Клиент использует
+    одну HTTP-сессию с keep-alive соединениями и обновляет токен доступа только по истечении его срока.
+    """
+    global _client
+    if _client is None:
+        _client = gspread.service_account(filename=JSON_FILE_PATH, scopes=SCOPE)
+        _client.set_timeout(SHEETS_TIMEOUT)
+    return _client
+
+def get_worksheet(sheet_name, index=0):
+    """
+    Возвращает лист Google Таблицы по имени таблицы, используя кэш открытых листов.
+
+    Параметры
+    ----------
+    sheet_name : str
+        Имя Google Таблицы.
+    index : int, необязательно
+        Номер листа в таблице (по умолчанию первый).
+
+    Возвращает
+    -------
+    gspread.Worksheet
+        Лист таблицы.
+
+    Примечания
+    ----------
+    Поиск таблицы по имени через Drive выполняется только при первом обращении
+    или после сброса кэша функцией `invalidate_worksheet`.
+    """
+    key = (sheet_name, index)
+    if key not in _worksheets:
+        _worksheets[key] = get_client().open(sheet_name).get_worksheet(index)
+    return _worksheets[key]
+
+def invalidate_worksheet(sheet_name):
+    """
+    Сбрасывает кэшированные листы таблицы, например после ошибки доступа.
+
+    Параметры
+    ----------
+    sheet_name : str
+        Имя Google Таблицы.
+
+    Возвращает
+    -------
+    None
+    """
+    for key in [key for key in _worksheets if key[0] == sheet_name]:
+        del _worksheets[key]
+
+def read_rows(sheet_name):
+    """
+    Читает все строки листа таблицы, кроме заголовка. Блокирующая функция для `call_sheets`.
+
+    Параметры
+    ----------
+    sheet_name : str
+        Имя Google Таблицы.
+
+    Возвращает
+    -------
+    list[list[str]]
+        Значения строк.
+    """
+    return get_worksheet(sheet_name).get_all_values()[1:]
+
+def get_modified_time(sheet_name):
+    """
+    Возвращает время последнего изменения таблицы по данным Google Drive. Блокирующая функция для `call_sheets`.
+
+    Параметры
+    ----------
+    sheet_name : str
+        Имя Google Таблицы.
+
+    Возвращает
+    -------
+    str
+        Время изменения `modifiedTime` в формате RFC 3339.
+    """
+    spreadsheet = get_worksheet(sheet_name).spreadsheet
+    response = get_client().request(
+        "get", DRIVE_FILES_URL + spreadsheet.id,
+        params={"fields": "modifiedTime", "supportsAllDrives": True}
+    )
+    return response.json()["modifiedTime"]
+
+def _run(func, args):
+    # Занятость потоков считается в самом потоке: вызов, прерванный таймаутом, продолжает его занимать
+    SHEETS_EXECUTOR_BUSY.inc()
+    try:
+        return func(*args)
+    finally:
+        SHEETS_EXECUTOR_BUSY.dec()
+
+async def call_sheets(func, *args, sheet_name=None, timeout=SHEETS_TIMEOUT, retries=SHEETS_RETRIES):
+    """
+    Выполняет блокирующий вызов gspread в пуле потоков Google Таблиц, не блокируя цикл событий.
+
+    Вызов ограничен таймаутом и при ошибке повторяется с экспоненциальной задержкой
+    со случайным разбросом (начиная с `SHEETS_BACKOFF` секунд).
+
+    Параметры
+    ----------
+    func : Callable
+        Блокирующая функция, обращающаяся к Google Таблицам.
+    *args
+        Аргументы функции.
+    sheet_name : str, необязательно
+        Имя таблицы, кэш листов которой сбрасывается перед повтором.
+    timeout : float or None, необязательно
+        Таймаут ожидания вызова, в секундах (по умолчанию `SHEETS_TIMEOUT`). Поток с вызовом
+        по таймауту не прерывается, поэтому для неидемпотентных записей следует передавать None
+        и полагаться на таймаут HTTP-клиента.
+    retries : int, необязательно
+        Количество повторов (по умолчанию `SHEETS_RETRIES`).
+
+    Возвращает
+    -------
+    Any
+        Результат функции.
+
+    Исключения
+    ----------
+    Exception
+        Ошибка последней попытки.
+    """
+    loop = asyncio.get_event_loop()
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(loop.run_in_executor(_executor, _run, func, args), timeout)
+            SHEETS_CALLS.inc(func.__name__, "ok")
+            SHEETS_CALL_SECONDS.observe(time.monotonic() - started, func.__name__)
+            return result
+        except Exception as exc:
+            SHEETS_CALLS.inc(func.__name__, type(exc).__name__)
+            SHEETS_CALL_SECONDS.observe(time.monotonic() - started, func.__name__)
+            if attempt == retries:
+                raise
+            if sheet_name is not None:
+                invalidate_worksheet(sheet_name)
+            delay = SHEETS_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+            logging.warning(f"Google Sheets call {func.__name__} failed ({exc!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
@@ -0,0 +1,492 @@
+"""
+State backend module.
+Stores dialog sessions, allow-lists and usage counters either in process memory (single replica)
+or in a Redis-compatible key-value store shared by several bot replicas, and coordinates
+replicas: per-user turn locks, generation cancellation and a single analytics writer.
+"""
+
+import abc
+import asyncio
+import contextlib
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+from services.history import DialogHistory, HISTORY_TOKEN_LIMITS
+from services.session_store import Session
+from config import ANALYTICS_FLUSH_INTERVAL
+
+# Время жизни сессии и счетчиков в общем хранилище, в секундах
+SESSION_TTL = 30 * 24 * 3600
+USAGE_TTL = 40 * 24 * 3600
+# Время, после которого блокировка хода пользователя снимается, если реплика упала, в секундах.
+# Пока ход выполняется, блокировка продлевается каждые USER_LOCK_RENEW_INTERVAL секунд
+USER_LOCK_TTL = 30
+USER_LOCK_RENEW_INTERVAL = USER_LOCK_TTL / 3
+USER_LOCK_POLL_INTERVAL = 0.1
+# Время, в течение которого реплика остается единственной, кто пишет аналитику, в секундах
+ANALYTICS_WRITER_TTL = max(1, int(ANALYTICS_FLUSH_INTERVAL * 3))
+
+def new_session(model):
+    """
+    Создает новую сессию диалога.
+
+    Параметры
+    ----------
+    model : str
+        Модель ("GPT-3.5 Turbo" или "GPT-4").
+
+    Возвращает
+    -------
+    Session
+        Сессия с пустой историей и новым `dialog_id`.
+    """
+    return Session(model, DialogHistory(HISTORY_TOKEN_LIMITS[model]))
+
+class StateBackend(abc.ABC):
+    """
+    Интерфейс хранилища состояния бота: сессий диалогов, списков пользователей и счетчиков токенов.
+
+    Методы работы с сессиями и счетчиками абстрактные, поэтому хранилище, в котором какой-то
+    из них не реализован, нельзя создать.
+    """
+
+    _cancel_handler = None
+
+    async def open(self):
+        """
+        Подключается к хранилищу. Вызывается при запуске бота.
+        """
+
+    async def close(self):
+        """
+        Сохраняет несохраненные изменения и закрывает хранилище.
+        """
+
+    @abc.abstractmethod
+    async def has_session(self, user_id):
+        """
+        Проверяет, ведет ли пользователь диалог.
+        """
+
+    @abc.abstractmethod
+    async def get_session(self, user_id):
+        """
+        Возвращает сессию пользователя или None.
+        """
+
+    @abc.abstractmethod
+    async def save_session(self, user_id, session):
+        """
+        Сохраняет новую сессию пользователя, заменяя предыдущую.
+        """
+
+    @abc.abstractmethod
+    async def update_session(self, user_id, dialog_id, update):
+        """
+        Атомарно изменяет сессию пользователя, если она принадлежит диалогу `dialog_id`.
+
+        Параметры
+        ----------
+        user_id : int
+            ID пользователя.
+        dialog_id : str
+            Идентификатор диалога, который изменяется.
+        update : Callable[[Session], Any]
+            Изменяет переданную сессию. Если возвращает False, сессия не сохраняется.
+            Может быть вызвана повторно со свежей копией сессии при одновременной записи.
+
+        Возвращает
+        -------
+        Session or None
+            Сохраненная сессия или None, если диалог завершен, заменен новым или `update` вернула False.
+        """
+
+    @abc.abstractmethod
+    async def delete_session(self, user_id):
+        """
+        Удаляет сессию пользователя.
+        """
+
+    @abc.abstractmethod
+    async def incr_usage(self, user_id, date, model, tokens):
+        """
+        Атомарно увеличивает счетчик токенов пользователя за день и возвращает новое значение.
+        """
+
+    async def publish_allow_lists(self, users, admins):
+        """
+        Публикует списки пользователей и администраторов для других реплик.
+        """
+
+    async def fetch_allow_lists(self):
+        """
+        Возвращает опубликованные списки (users, admins) или None.
+        """
+        return None
+
+    def set_cancel_handler(self, handler):
+        """
+        Задает функцию, прерывающую генерацию ответа пользователю в этом процессе.
+        """
+        self._cancel_handler = handler
+
+    async def cancel_generation(self, user_id):
+        """
+        Прерывает генерацию ответа пользователю во всех репликах.
+        """
+        if self._cancel_handler is not None:
+            self._cancel_handler(user_id)
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        """
+        Блокировка хода пользователя между репликами: ходы одного пользователя выполняются по очереди.
+
+        В одном процессе очередность обеспечивают обработчики диалога, поэтому по умолчанию блокировки нет.
+        """
+        yield
+
+    async def share_usage(self, batch):
+        """
+        Передает накопленную аналитику единственной реплике, которая пишет таблицу.
+
+        Параметры
+        ----------
+        batch : dict
+            Накопленные токены: (full_name, telegram_handle, date, model) -> tokens.
+
+        Возвращает
+        -------
+        dict or None
+            Аналитика всех реплик для записи в таблицу или None, если таблицу пишет другая реплика.
+        """
+        return batch
+
+class MemoryBackend(StateBackend):
+    """
+    Хранилище состояния в памяти процесса; сессии сохраняются на диск через `SessionStore`.
+
+    Параметры
+    ----------
+    sessions : SessionStore
+        Словарь сессий диалогов.
+    analytics : dict
+        Счетчики токенов `user_id -> {date: {model: tokens}}`.
+    flush_interval : float
+        Интервал пакетного сохранения сессий на диск, в секундах.
+    idle_ttl : float
+        Время бездействия, после которого сессия выгружается из памяти, в секундах.
+    usage_window_days : int
+        Сколько последних дней счетчиков токенов хранится в памяти.
+    """
+
+    def __init__(self, sessions, analytics, flush_interval, idle_ttl, usage_window_days):
+        self.sessions = sessions
+        self.analytics = analytics
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self.usage_window_days = usage_window_days
+        self._flush_task = None
+        self._usage_date = None
+
+    async def open(self):
+        self.sessions.open()
+        self._flush_task = asyncio.get_event_loop().create_task(
+            self.sessions.flush_periodically(self.flush_interval, self.idle_ttl)
+        )
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.sessions.flush()
+        self.sessions.close()
+
+    async def has_session(self, user_id):
+        return user_id in self.sessions
+
+    async def get_session(self, user_id):
+        return self.sessions.get(user_id)
+
+    async def save_session(self, user_id, session):
+        self.sessions[user_id] = session
+
+    async def update_session(self, user_id, dialog_id, update):
+        session = self.sessions.get(user_id)
+        if session is None or session.dialog_id != dialog_id or update(session) is False:
+            return None
+        self.sessions[user_id] = session
+        return session
+
+    async def delete_session(self, user_id):
+        if user_id in self.sessions:
+            del self.sessions[user_id]
+
+    def _prune_usage(self, date):
+        """
+        Удаляет из памяти счетчики токенов старше `usage_window_days` дней.
+        """
+        cutoff = (datetime.strptime(date, '%Y-%m-%d') - timedelta(days=self.usage_window_days)).strftime('%Y-%m-%d')
+        for user_id in list(self.analytics):
+            days = self.analytics[user_id]
+            for day in [day for day in days if day <= cutoff]:
+                del days[day]
+            if not days:
+                del self.analytics[user_id]
+
+    async def incr_usage(self, user_id, date, model, tokens):
+        if date != self._usage_date:
+            # Окно счетчиков сдвигается один раз в день
+            self._usage_date = date
+            self._prune_usage(date)
+        daily = self.analytics.setdefault(user_id, {}).setdefault(date, {"GPT-3.5 Turbo": 0, "GPT-4": 0})
+        daily[model] += tokens
+        return daily[model]
+
+class RedisBackend(StateBackend):
+    """
+    Хранилище состояния в Redis (или совместимом сервере), общее для нескольких реплик бота.
+
+    Сессия хранится в хеше `<prefix>:session:<user_id>` с полями model, dialog_id и turns
+    и изменяется транзакцией с WATCH, поэтому одновременные записи реплик (или ответа и
+    сжатия истории) не теряют друг друга. Счетчики токенов хранятся в хеше `<prefix>:usage:<date>`
+    с полями `<user_id>:<model>` и увеличиваются атомарно командой HINCRBY.
+
+    Отмена генерации рассылается репликам через канал `<prefix>:cancel`, ход пользователя
+    защищен блокировкой `<prefix>:lock:<user_id>`, а аналитику собирает в хеше
+    `<prefix>:analytics_pending` и пишет в таблицу одна реплика, владеющая ключом `<prefix>:analytics_writer`.
+
+    Параметры
+    ----------
+    url : str
+        Адрес сервера, например `redis://localhost:6379/0`.
+    prefix : str
+        Префикс ключей.
+    client : redis.asyncio.Redis, необязательно
+        Готовый клиент (например, для тестов) вместо подключения по `url`.
+    """
+
+    def __init__(self, url, prefix="chatitc", client=None):
+        self.url = url
+        self.prefix = prefix
+        self._redis = client
+        self._token = uuid.uuid4().hex
+        self._listener = None
+
+    def _key(self, *parts):
+        return ":".join((self.prefix,) + tuple(str(part) for part in parts))
+
+    async def open(self):
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.url, decode_responses=True)
+        await self._redis.ping()
+        if self._listener is None:
+            self._listener = asyncio.get_event_loop().create_task(self._listen_cancellations())
+        logging.info("Connected to shared state backend")
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    async def has_session(self, user_id):
+        return bool(await self._redis.exists(self._key("session", user_id)))
+
+    @staticmethod
+    def _decode_session(data):
+        model = data["model"]
+        history = DialogHistory.from_turns(HISTORY_TOKEN_LIMITS[model], json.loads(data["turns"]))
+        return Session(model, history, data["dialog_id"])
+
+    @staticmethod
+    def _encode_session(session):
+        return {
+            "model": session.model,
+            "dialog_id": session.dialog_id,
+            "turns": json.dumps(session.history.to_turns(), ensure_ascii=False)
+        }
+
+    async def get_session(self, user_id):
+        data = await self._redis.hgetall(self._key("session", user_id))
+        if not data:
+            return None
+        return self._decode_session(data)
+
+    async def save_session(self, user_id, session):
+        key = self._key("session", user_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=self._encode_session(session))
+            pipe.expire(key, SESSION_TTL)
+            await pipe.execute()
+
+    async def update_session(self, user_id, dialog_id, update):
+        key = self._key("session", user_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    data = await pipe.hgetall(key)
+                    if not data or data["dialog_id"] != dialog_id:
+                        return None
+                    session = self._decode_session(data)
+                    if update(session) is False:
+                        return None
+                    pipe.multi()
+                    pipe.hset(key, mapping=self._encode_session(session))
+                    pipe.expire(key, SESSION_TTL)
+                    await pipe.execute()
+                    return session
+                except WatchError:
+                    # Сессию изменила другая реплика или задача: изменение применяется к свежей копии
+                    continue
+
+    async def delete_session(self, user_id):
+        await self._redis.delete(self._key("session", user_id))
+
+    async def incr_usage(self, user_id, date, model, tokens):
+        key = self._key("usage", date)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby(key, f"{user_id}:{model}", tokens)
+            pipe.expire(key, USAGE_TTL)
+            total, _ = await pipe.execute()
+        return total
+
+    async def publish_allow_lists(self, users, admins):
+        await self._redis.mset({
+            self._key("allowed_users"): json.dumps(users, ensure_ascii=False),
+            self._key("admins"): json.dumps(list(admins))
+        })
+
+    async def fetch_allow_lists(self):
+        users, admins = await self._redis.mget(self._key("allowed_users"), self._key("admins"))
+        if users is None or admins is None:
+            return None
+        return {int(user_id): info for user_id, info in json.loads(users).items()}, json.loads(admins)
+
+    async def cancel_generation(self, user_id):
+        await super().cancel_generation(user_id)
+        await self._redis.publish(self._key("cancel"), f"{user_id}:{self._token}")
+
+    async def _listen_cancellations(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self._key("cancel"))
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    user_id, origin = message["data"].split(":", 1)
+                    # Своя генерация уже прервана в `cancel_generation`
+                    if origin != self._token and self._cancel_handler is not None:
+                        self._cancel_handler(int(user_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logging.error(f"Error listening for generation cancellations: {exc}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, user_id):
+        key = self._key("lock", user_id)
+        token = uuid.uuid4().hex
+        while not await self._redis.set(key, token, nx=True, px=int(USER_LOCK_TTL * 1000)):
+            await asyncio.sleep(USER_LOCK_POLL_INTERVAL)
+        # Ход может ждать в очереди модели и получать длинный ответ дольше USER_LOCK_TTL
+        renewal = asyncio.get_event_loop().create_task(self._renew_user_lock(key, token))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            # Снимается только своя блокировка: чужая могла появиться после истечения USER_LOCK_TTL
+            await self._if_owner(key, token, lambda pipe: pipe.delete(key))
+
+    async def _renew_user_lock(self, key, token):
+        while True:
+            await asyncio.sleep(USER_LOCK_RENEW_INTERVAL)
+            try:
+                renewed = await self._if_owner(key, token, lambda pipe: pipe.pexpire(key, int(USER_LOCK_TTL * 1000)))
+            except Exception as exc:
+                logging.error(f"Error renewing user lock {key}: {exc}")
+                continue
+            if not renewed:
+                logging.warning(f"User lock {key} expired while the turn was running")
+                return
+
+    async def _if_owner(self, key, token, action):
+        """
+        Выполняет `action` над ключом в транзакции, только если ключ все еще хранит `token`.
+        """
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != token:
+                    return False
+                pipe.multi()
+                action(pipe)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def _acquire_analytics_writer(self):
+        key = self._key("analytics_writer")
+        if await self._redis.set(key, self._token, nx=True, ex=ANALYTICS_WRITER_TTL):
+            return True
+        if await self._redis.get(key) == self._token:
+            await self._redis.expire(key, ANALYTICS_WRITER_TTL)
+            return True
+        return False
+
+    async def share_usage(self, batch):
+        key = self._key("analytics_pending")
+        if batch:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                for usage_key, tokens in batch.items():
+                    pipe.hincrbyfloat(key, json.dumps(list(usage_key), ensure_ascii=False), tokens)
+                await pipe.execute()
+        if not await self._acquire_analytics_writer():
+            return None
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(key)
+            pipe.delete(key)
+            data, _ = await pipe.execute()
+        shared = {}
+        for field, tokens in data.items():
+            tokens = float(tokens)
+            shared[tuple(json.loads(field))] = int(tokens) if tokens.is_integer() else tokens
+        return shared
+
+def create_backend(url, sessions, analytics, flush_interval, idle_ttl, usage_window_days):
+    """
+    Создает хранилище состояния по адресу из настроек.
+
+    Параметры
+    ----------
+    url : str
+        Адрес Redis-совместимого сервера. Пустая строка — хранение в памяти процесса.
+    sessions : SessionStore
+        Словарь сессий для хранения в памяти.
+    analytics : dict
+        Счетчики токенов для хранения в памяти.
+    flush_interval : float
+        Интервал сохранения сессий на диск при хранении в памяти, в секундах.
+    idle_ttl : float
+        Время бездействия, после которого сессия выгружается из памяти, в секундах.
+    usage_window_days : int
+        Сколько последних дней счетчиков токенов хранится в памяти.
+
+    Возвращает
+    -------
+    StateBackend
+        Хранилище состояния.
+    """
+    if url:
+        return RedisBackend(url)
+    return MemoryBackend(sessions, analytics, flush_interval, idle_ttl, usage_window_days)
@@ -0,0 +1,113 @@
+"""
+Summarizer module.
+Compacts long dialogs in the background: older turns are summarized by the cheaper
+GPT-3.5 Turbo tier and replaced by the summary, so prompt size stays roughly constant.
+"""
+
+import asyncio
+import logging
+from services import user_service
+from services.user_service import STATE
+from services.openai_service import ask_openai, OPENAI_ERROR_TEXT
+from services.model_scheduler import model_scheduler
+from services.usage_store import usage_store
+from config import SUMMARY_ENABLED, SUMMARY_THRESHOLD, SUMMARY_KEEP_TURNS
+
+SUMMARY_MODEL = "GPT-3.5 Turbo"
+SUMMARY_MODEL_NAME = "gpt-3.5-turbo-16k"
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+SUMMARY_PROMPT = (
+    "Кратко перескажи диалог пользователя с ассистентом. Сохрани факты, решения, договоренности "
+    "и все, что нужно, чтобы продолжить разговор. Пиши на языке диалога, без вступлений."
+)
+
+# Пользователи, для которых сейчас готовится краткое содержание
+_compacting = set()
+
+def maybe_compact(user_id, session):
+    """
+    Запускает сжатие истории в фоне, если она превысила порог.
+
+    Когда история занимает больше `SUMMARY_THRESHOLD` от своего лимита токенов, все реплики,
+    кроме последних `SUMMARY_KEEP_TURNS`, пересказываются моделью GPT-3.5 Turbo и заменяются
+    одним системным сообщением с кратким содержанием. Ответ пользователю при этом не ждет.
+
+    Параметры
+    ----------
+    user_id : int
+        ID пользователя.
+    session : Session
+        Сессия диалога.
+
+    Возвращает
+    -------
+    None
+    """
+    if not SUMMARY_ENABLED or user_id in _compacting:
+        return
+    history = session.history
+    if history.total_tokens < history.max_tokens * SUMMARY_THRESHOLD:
+        return
+    old_turns = list(history.turns)[:-SUMMARY_KEEP_TURNS]
+    if len(old_turns) < 2:
+        return
+    _compacting.add(user_id)
+    asyncio.get_event_loop().create_task(_compact(user_id, session.dialog_id, old_turns))
+
+async def _compact(user_id, dialog_id, old_turns):
+    """
+    Готовит краткое содержание старых реплик и заменяет ими начало истории.
+
+    Параметры
+    ----------
+    user_id : int
+        ID пользователя.
+    dialog_id : str
+        Идентификатор диалога, для которого запущено сжатие.
+    old_turns : list[tuple]
+        Заменяемые реплики в формате (role, content, tokens).
+
+    Возвращает
+    -------
+    None
+    """
+    try:
+        transcript = "\n\n".join(f"{role}: {content}" for role, content, _ in old_turns)
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ]
+        prompt_tokens = sum(tokens for _, _, tokens in old_turns)
+        loop = asyncio.get_event_loop()
+        async with model_scheduler.slot(SUMMARY_MODEL, user_id, prompt_tokens) as usage:
+            started = loop.time()
+            summary, tokens_used = await ask_openai(SUMMARY_MODEL_NAME, messages)
+            usage["completion_tokens"] = tokens_used
+            latency = loop.time() - started
+        if not summary.strip() or summary.endswith(OPENAI_ERROR_TEXT):
+            return
+
+        user_info = user_service.ALLOWED_USERS.get(user_id, {})
+        usage_store.record_event(
+            user_id, user_info.get("full_name", "Неизвестный"), user_info.get("telegram_handle", "Неизвестный"),
+            SUMMARY_MODEL, prompt_tokens, tokens_used, latency
+        )
+
+        # За время пересказа диалог мог завершиться или продолжиться
+        session = await STATE.get_session(user_id)
+        if session is None or session.dialog_id != dialog_id:
+            return
+        before = session.history.total_tokens
+        session = await STATE.update_session(
+            user_id, dialog_id,
+            lambda current: current.history.replace_prefix(old_turns, SUMMARY_PREFIX + summary)
+        )
+        if session is not None:
+            logging.info(
+                f"Compacted dialog of user {user_id}: {len(old_turns)} turns, "
+                f"{before} -> {session.history.total_tokens} tokens"
+            )
+    except Exception as exc:
+        logging.error(f"Error compacting dialog of user {user_id}: {exc}")
+    finally:
+        _compacting.discard(user_id)
@@ -0,0 +1,212 @@
+"""
+Telegram sender module.
+Routes outgoing Telegram messages and edits through a central scheduler that respects
+global and per-chat rate limits and retries after flood-control errors.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+from services.rate_limit import TokenBucket
+from services.metrics import Counter, Gauge
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE
+
+# Приоритеты отправки: меньшее значение отправляется раньше
+PRIORITY_FIRST = 0
+PRIORITY_CONTINUATION = 1
+PRIORITY_EDIT = 2
+
+# Методы Bot API, на которые распространяются лимиты Telegram на отправку сообщений
+RATE_LIMITED_METHODS = {
+    "sendMessage", "editMessageText", "sendPhoto", "sendDocument",
+    "sendMediaGroup", "copyMessage", "forwardMessage"
+}
+
+TELEGRAM_REQUESTS = Counter("chatitc_telegram_requests_total", "Telegram Bot API requests", ("method",))
+TELEGRAM_FLOOD_WAITS = Counter("chatitc_telegram_flood_waits_total", "Telegram 429 flood-control responses")
+
+_priority = contextvars.ContextVar("send_priority", default=None)
+
+@contextlib.contextmanager
+def send_priority(priority):
+    """
+    Задает приоритет для сообщений, отправляемых внутри блока `with`.
+
+    Параметры
+    ----------
+    priority : int
+        Один из `PRIORITY_FIRST`, `PRIORITY_CONTINUATION`, `PRIORITY_EDIT`.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class SendScheduler:
+    """
+    Планировщик исходящих запросов к Telegram.
+
+    Запросы ставятся в очередь с приоритетом и выполняются, когда свободны и общее ведро токенов
+    (лимит бота), и ведро токенов чата. Среди готовых запросов первым выполняется запрос
+    с наименьшим приоритетом, а при равенстве — поставленный раньше. При ошибке `RetryAfter`
+    чат блокируется на указанное Telegram время, и запрос повторяется.
+
+    Параметры
+    ----------
+    global_rate : float
+        Максимальное количество сообщений в секунду для всего бота.
+    chat_rate : float
+        Максимальное количество сообщений в секунду для одного чата.
+    """
+
+    def __init__(self, global_rate, chat_rate):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def split(self, parts):
+        """
+        Оставляет этому процессу долю `1 / parts` общего лимита бота.
+
+        Параметры
+        ----------
+        parts : int
+            Количество процессов, отправляющих сообщения от имени бота.
+
+        Возвращает
+        -------
+        None
+        """
+        rate = self.global_rate / parts
+        self._global = TokenBucket(rate, max(1.0, rate))
+
+    async def submit(self, chat_id, priority, call):
+        """
+        Ставит запрос в очередь и ожидает его выполнения.
+
+        Параметры
+        ----------
+        chat_id : int or str or None
+            ID чата, к которому относится запрос. None — запрос учитывается только в общем лимите.
+        priority : int
+            Приоритет запроса.
+        call : Callable[[], Awaitable]
+            Функция, выполняющая запрос к Telegram.
+
+        Возвращает
+        -------
+        Any
+            Результат запроса.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._push(priority, next(self._seq), chat_id, call, future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+        return await future
+
+    def _push(self, priority, seq, chat_id, call, future):
+        heapq.heappush(self._queue, (priority, seq, chat_id, call, future))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        if chat_id not in self._chats:
+            if len(self._chats) > 1000:
+                now = time.monotonic()
+                self._chats = {key: bucket for key, bucket in self._chats.items() if not bucket.is_idle(now)}
+            self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        return self._chats[chat_id]
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = self._global.delay(now)
+            chosen = None
+            if wait == 0:
+                wait = float('inf')
+                for item in sorted(self._queue):
+                    bucket = self._chat_bucket(item[2])
+                    item_delay = bucket.delay(now) if bucket is not None else 0.0
+                    if item_delay == 0:
+                        chosen = item
+                        break
+                    wait = min(wait, item_delay)
+
+            if chosen is None:
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                continue
+
+            self._queue.remove(chosen)
+            heapq.heapify(self._queue)
+            self._global.consume(now)
+            bucket = self._chat_bucket(chosen[2])
+            if bucket is not None:
+                bucket.consume(now)
+            asyncio.get_event_loop().create_task(self._execute(chosen))
+
+    async def _execute(self, item):
+        priority, seq, chat_id, call, future = item
+        if future.cancelled():
+            return
+        try:
+            result = await call()
+        except RetryAfter as exc:
+            TELEGRAM_FLOOD_WAITS.inc()
+            logging.warning(f"Telegram flood control for chat {chat_id}: retry in {exc.timeout}s")
+            bucket = self._chat_bucket(chat_id) or self._global
+            bucket.block(time.monotonic() + exc.timeout)
+            self._push(priority, seq, chat_id, call, future)
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+        else:
+            if not future.done():
+                future.set_result(result)
+
+scheduler = SendScheduler(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE)
+Gauge("chatitc_telegram_send_queue_length", "Telegram requests waiting in the send scheduler", function=lambda: len(scheduler))
+
+class ScheduledBot(Bot):
+    """
+    Бот, отправляющий сообщения и их редактирования через общий планировщик `scheduler`.
+
+    Новые сообщения по умолчанию отправляются с приоритетом `PRIORITY_FIRST`, редактирования —
+    с `PRIORITY_EDIT`; приоритет можно переопределить блоком `with send_priority(...)`.
+    Остальные методы Bot API выполняются без очереди.
+    """
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        TELEGRAM_REQUESTS.inc(method)
+        if method not in RATE_LIMITED_METHODS:
+            return await Bot.request(self, method, data, files, **kwargs)
+
+        priority = _priority.get()
+        if priority is None:
+            priority = PRIORITY_EDIT if method.startswith("edit") else PRIORITY_FIRST
+        chat_id = (data or {}).get("chat_id")
+        return await scheduler.submit(
+            chat_id, priority, lambda: Bot.request(self, method, data, files, **kwargs)
+        )
@@ -0,0 +1,92 @@
+"""
+Typing indicator module.
+Shows a per-request "typing" status in the chat while the model generates an answer.
+"""
+
+import asyncio
+import contextlib
+import logging
+from aiogram import types
+from config import CHAT_ACTION_INTERVAL
+
+PLACEHOLDER_TEXT = "Бот печатает..."
+
+class TypingIndicator:
+    """
+    Индикатор печати для одного запроса пользователя.
+
+    Индикатор периодически обновляет статус "печатает" через `send_chat_action` (Telegram
+    показывает его около 5 секунд). Дополнительно может отправить одно сообщение-заглушку,
+    которое затем заменяется первой частью ответа, а не удаляется.
+
+    Параметры
+    ----------
+    bot : aiogram.Bot
+        Экземпляр бота.
+    chat_id : int
+        ID чата, в котором показывается индикатор.
+    placeholder : bool, необязательно
+        Отправлять ли сообщение-заглушку "Бот печатает...".
+    reply_markup : тип ReplyMarkup, необязательно
+        Ответная разметка для сообщения-заглушки.
+    """
+
+    def __init__(self, bot, chat_id, placeholder=False, reply_markup=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.use_placeholder = placeholder
+        self.reply_markup = reply_markup
+        self.placeholder = None
+        self._task = None
+
+    async def start(self):
+        """
+        Показывает индикатор и запускает его периодическое обновление.
+
+        Возвращает
+        -------
+        None
+        """
+        if self.use_placeholder:
+            self.placeholder = await self.bot.send_message(
+                self.chat_id, PLACEHOLDER_TEXT, reply_markup=self.reply_markup
+            )
+        self._task = asyncio.create_task(self._renew())
+
+    async def _renew(self):
+        """
+        Обновляет статус "печатает" каждые `CHAT_ACTION_INTERVAL` секунд до остановки индикатора.
+
+        Возвращает
+        -------
+        None
+        """
+        while True:
+            try:
+                await self.bot.send_chat_action(self.chat_id, types.ChatActions.TYPING)
+            except Exception as exc:
+                logging.warning(f"Error sending chat action: {exc}")
+            await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+    async def stop(self, delete_placeholder=False):
+        """
+        Останавливает обновление индикатора.
+
+        Параметры
+        ----------
+        delete_placeholder : bool, необязательно
+            Удалить ли сообщение-заглушку. По умолчанию заглушка сохраняется, чтобы
+            ее можно было отредактировать в первую часть ответа.
+
+        Возвращает
+        -------
+        None
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if delete_placeholder and self.placeholder is not None:
+            await self.placeholder.delete()
+            self.placeholder = None
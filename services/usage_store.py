@@ -0,0 +1,269 @@
+"""
+Usage store module.
+Records per-request usage events in SQLite on the persistence mount, keeps daily rollups
+and renders aggregated reports for admins. Google Sheets is only an export target.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from services.analytics_service import record_usage, usage_cost
+from config import USAGE_DB_PATH, USAGE_FLUSH_INTERVAL, USAGE_EVENTS_RETENTION_DAYS, ANALYTICS_SHEETS_EXPORT
+
+# Количество пользователей в рейтинге отчета
+TOP_USERS = 10
+
+class UsageStore:
+    """
+    Хранилище событий использования моделей в SQLite.
+
+    Каждое событие (пользователь, модель, токены запроса и ответа, задержка, стоимость) сначала
+    попадает в буфер в памяти и записывается в базу пакетно функцией `flush` вместе с дневными
+    агрегатами в таблице `daily`. Отчеты строятся по базе и кэшируются до появления новых данных.
+
+    Параметры
+    ----------
+    path : str
+        Путь к файлу базы SQLite. Если каталог не существует, база хранится в памяти.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._version = 0
+        self._report_cache = {}
+        self._pruned_on = None
+
+    def open(self):
+        """
+        Открывает базу событий в режиме WAL и создает таблицы.
+
+        Возвращает
+        -------
+        None
+        """
+        path = self.path
+        if not path or not os.path.isdir(os.path.dirname(path) or '.'):
+            logging.info("Usage store is not persisted, keeping events in memory")
+            path = ':memory:'
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "ts REAL NOT NULL, date TEXT NOT NULL, user_id INTEGER NOT NULL, full_name TEXT NOT NULL, "
+            "model TEXT NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+            "latency REAL, cost REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_date ON events (date)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS daily ("
+            "date TEXT NOT NULL, user_id INTEGER NOT NULL, model TEXT NOT NULL, full_name TEXT NOT NULL, "
+            "requests INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+            "cost REAL NOT NULL, PRIMARY KEY (date, user_id, model))"
+        )
+
+    def close(self):
+        """
+        Закрывает базу событий. Перед закрытием следует вызвать `flush`.
+
+        Возвращает
+        -------
+        None
+        """
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def record_event(self, user_id, full_name, telegram_handle, model, prompt_tokens, completion_tokens, latency=None):
+        """
+        Учитывает один запрос к модели.
+
+        Событие добавляется в буфер в памяти, а токены ответа передаются для выгрузки
+        в Google Таблицы (`record_usage`), если она включена.
+
+        Параметры
+        ----------
+        user_id : int
+            ID пользователя.
+        full_name : str
+            Полное имя пользователя.
+        telegram_handle : str
+            Идентификатор пользователя в Telegram.
+        model : str
+            Модель ("GPT-3.5 Turbo" или "GPT-4").
+        prompt_tokens : int
+            Оценка количества токенов запроса.
+        completion_tokens : int
+            Количество токенов ответа.
+        latency : float, необязательно
+            Время получения ответа, в секундах.
+
+        Возвращает
+        -------
+        None
+
+        Примечания
+        ----------
+        Токены запроса и ответа оцениваются по своим ценам (`usage_cost`), как и в выгрузке
+        в Google Таблицы, поэтому расходы в отчете и в таблице совпадают.
+        """
+        now = time.time()
+        cost = usage_cost(model, prompt_tokens, completion_tokens)
+        self._pending.append((
+            now, datetime.fromtimestamp(now).strftime('%Y-%m-%d'), user_id, full_name,
+            model, prompt_tokens, completion_tokens, latency, cost
+        ))
+        if ANALYTICS_SHEETS_EXPORT:
+            record_usage(full_name, telegram_handle, model, prompt_tokens, completion_tokens)
+
+    def _write(self, events):
+        """
+        Записывает события и обновляет дневные агрегаты одной транзакцией.
+        """
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", events)
+            self._conn.executemany(
+                "INSERT INTO daily VALUES (?, ?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT(date, user_id, model) DO UPDATE SET full_name = excluded.full_name, "
+                "requests = requests + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, cost = cost + excluded.cost",
+                [(date, user_id, model, full_name, prompt, completion, cost)
+                 for _, date, user_id, full_name, model, prompt, completion, _, cost in events]
+            )
+            today = events[-1][1]
+            if today != self._pruned_on:
+                # Отдельные события нужны только для задержек, агрегаты хранятся бессрочно
+                cutoff = (datetime.now() - timedelta(days=USAGE_EVENTS_RETENTION_DAYS)).strftime('%Y-%m-%d')
+                self._conn.execute("DELETE FROM events WHERE date < ?", (cutoff,))
+                self._pruned_on = today
+
+    async def flush(self):
+        """
+        Записывает накопленные события в базу в отдельном потоке.
+
+        Возвращает
+        -------
+        None
+
+        Исключения
+        ----------
+        Exception
+            При ошибке записи сообщение об ошибке логируется, а события возвращаются в буфер.
+        """
+        if self._conn is None or not self._pending:
+            return
+        events, self._pending = self._pending, []
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._write, events)
+            self._version += 1
+        except Exception as exc:
+            logging.error(f"Error saving usage events: {exc}")
+            self._pending[:0] = events
+
+    async def flush_periodically(self):
+        """
+        Периодически записывает события в базу с интервалом `USAGE_FLUSH_INTERVAL`.
+
+        Возвращает
+        -------
+        None
+        """
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            await self.flush()
+
+    def _data_version(self):
+        """
+        Версия данных: меняется при каждой записи этим или другим процессом.
+        """
+        with self._lock:
+            return self._version, self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _render_report(self, days):
+        """
+        Строит отчет за последние `days` дней: текст и изображение PNG.
+
+        pandas и matplotlib импортируются здесь, а не при запуске бота. График рисуется на
+        отдельной фигуре без глобального состояния pyplot, поэтому отчеты можно строить
+        в нескольких потоках одновременно.
+        """
+        import pandas as pd
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        with self._lock:
+            daily = pd.read_sql_query("SELECT * FROM daily WHERE date >= ?", self._conn, params=(since,))
+            events = pd.read_sql_query(
+                "SELECT date, model, latency FROM events WHERE date >= ? AND latency IS NOT NULL",
+                self._conn, params=(since,)
+            )
+        if daily.empty:
+            return f"Нет запросов за последние {days} дн.", None
+
+        spend = daily.pivot_table(index="date", columns="model", values="cost", aggfunc="sum", fill_value=0)
+        top_users = daily.groupby("full_name")["cost"].sum().nlargest(TOP_USERS).sort_values()
+        p95 = events.groupby(["date", "model"])["latency"].quantile(0.95).unstack()
+
+        figure = Figure(figsize=(8, 11))
+        FigureCanvasAgg(figure)
+        spend_axis, users_axis, latency_axis = figure.subplots(3, 1)
+        spend.plot(kind="bar", stacked=True, ax=spend_axis)
+        spend_axis.set_title("Расходы по дням, $")
+        spend_axis.set_xlabel("")
+        top_users.plot(kind="barh", ax=users_axis)
+        users_axis.set_title(f"Топ-{TOP_USERS} пользователей по расходам, $")
+        users_axis.set_ylabel("")
+        if not p95.empty:
+            p95.plot(marker="o", ax=latency_axis)
+        latency_axis.set_title("p95 времени ответа, с")
+        latency_axis.set_xlabel("")
+        figure.tight_layout()
+        image = io.BytesIO()
+        figure.savefig(image, format="png", dpi=100)
+
+        totals = daily.groupby("model").agg({"requests": "sum", "cost": "sum"})
+        lines = [f"Использование за {days} дн.:"]
+        for model, row in totals.iterrows():
+            latencies = events.loc[events["model"] == model, "latency"]
+            latency = f", p95 {latencies.quantile(0.95):.1f} с" if not latencies.empty else ""
+            lines.append(f"{model}: {int(row['requests'])} запросов, ${row['cost']:.2f}{latency}")
+        lines.append(f"Всего: ${daily['cost'].sum():.2f}")
+        return "\n".join(lines), image.getvalue()
+
+    async def report(self, days=7):
+        """
+        Возвращает отчет об использовании за последние `days` дней.
+
+        Отчет строится в отдельном потоке и кэшируется, пока в базе не появятся новые события.
+
+        Параметры
+        ----------
+        days : int, необязательно
+            Количество дней в отчете.
+
+        Возвращает
+        -------
+        str
+            Текстовая сводка: запросы, расходы и p95 времени ответа по моделям.
+        bytes or None
+            Изображение PNG с графиками или None, если данных нет.
+        """
+        await self.flush()
+        loop = asyncio.get_event_loop()
+        version = await loop.run_in_executor(None, self._data_version)
+        key = (days, version)
+        if key not in self._report_cache:
+            self._report_cache = {key: await loop.run_in_executor(None, self._render_report, days)}
+        return self._report_cache[key]
+
+usage_store = UsageStore(USAGE_DB_PATH)
@@ -4,117 +4,307 @@ Handles operations related to users, including loading them from Google Sheets.
 """
 
 import asyncio
+import json
+import logging
+import os
+import time
 from dotenv import load_dotenv
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from services.sheets_client import call_sheets, read_rows, get_modified_time
+from services.session_store import SessionStore
+from services.state_backend import create_backend
+from services.metrics import Gauge
+from config import (
+    SESSION_DB_PATH,
+    SESSION_FLUSH_INTERVAL,
+    SESSION_IDLE_TTL,
+    USAGE_WINDOW_DAYS,
+    STATE_BACKEND_URL,
+    ALLOW_LIST_REFRESH_INTERVAL,
+    ALLOW_LIST_SNAPSHOT_PATH
+)
 
 load_dotenv()
 
+# Списки пользователей и администраторов при обновлении заменяются целиком новыми объектами,
+# поэтому обращаться к ним следует через модуль: `user_service.ALLOWED_USERS`, `user_service.ADMINS`
 ALLOWED_USERS = {}
 USER_ANALYTICS = {}
-USER_MODEL_CHOICE = {}
-ADMINS = []
+USER_MODEL_CHOICE = SessionStore(SESSION_DB_PATH)
+ADMINS = frozenset()
+STATE = create_backend(
+    STATE_BACKEND_URL, USER_MODEL_CHOICE, USER_ANALYTICS, SESSION_FLUSH_INTERVAL, SESSION_IDLE_TTL, USAGE_WINDOW_DAYS
+)
 
-async def load_users_from_google_sheets(json_file_path, sheet_name):
+# В общем хранилище реплик количество сессий не считается
+Gauge(
+    "chatitc_active_sessions", "Dialog sessions loaded in process memory",
+    function=lambda: None if STATE_BACKEND_URL else len(USER_MODEL_CHOICE)
+)
+
+USERS_SHEET_NAME = 'Верификация GPT ITC'
+ADMINS_SHEET_NAME = 'Админы GPT ITC'
+
+# Время последнего изменения загруженных таблиц: sheet_name -> modifiedTime
+_revisions = {}
+# Функция, которой передаются списки, загруженные в процессе-обработчике (см. `set_allow_list_sink`)
+_allow_list_sink = None
+
+def set_allow_list_sink(sink):
+    """
+    Перенаправляет списки, загруженные `refresh_allow_lists`, в функцию `sink` вместо сохранения на диск.
+
+    Используется в процессах-обработчиках: списки сохраняет и рассылает остальным обработчикам
+    главный процесс (см. `run_supervisor`).
+
+    Параметры
+    ----------
+    sink : Callable[[dict, frozenset], None] or None
+        Функция, принимающая списки пользователей и администраторов, или None для сохранения на диск.
+
+    Возвращает
+    -------
+    None
+    """
+    global _allow_list_sink
+    _allow_list_sink = sink
+
+def apply_allow_lists(users, admins):
+    """
+    Заменяет списки пользователей и администраторов списками, загруженными другим процессом или репликой.
+
+    Параметры
+    ----------
+    users : dict
+        Пользователи: user_id -> {"full_name", "telegram_handle"}.
+    admins : Iterable[int]
+        ID администраторов.
+
+    Возвращает
+    -------
+    None
+    """
+    global ALLOWED_USERS, ADMINS
+    ALLOWED_USERS, ADMINS = users, frozenset(admins)
+
+def load_allow_list_snapshot():
+    """
+    Загружает последний успешно полученный снимок списков пользователей и администраторов с диска.
+
+    Вызывается при запуске бота, чтобы пользователи получили доступ сразу, не дожидаясь
+    загрузки из Google Таблиц (и даже если Google Таблицы недоступны).
+
+    Возвращает
+    -------
+    bool
+        True, если снимок загружен.
+
+    Примечания
+    ----------
+    Вместе со списками восстанавливается время изменения таблиц, поэтому первое обновление
+    в фоне не перечитывает таблицы, которые не менялись с момента сохранения снимка.
+    """
+    global ALLOWED_USERS, ADMINS
+    if not os.path.exists(ALLOW_LIST_SNAPSHOT_PATH):
+        return False
+    started = time.monotonic()
+    try:
+        with open(ALLOW_LIST_SNAPSHOT_PATH, encoding='utf-8') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        ALLOWED_USERS = {int(user_id): info for user_id, info in snapshot["users"].items()}
+        ADMINS = frozenset(snapshot["admins"])
+        _revisions.update(snapshot["revisions"])
+    except Exception as exc:
+        logging.error(f"Error loading allow-list snapshot: {exc}")
+        return False
+    logging.info(
+        f"Allow-list snapshot loaded: {len(ALLOWED_USERS)} users, {len(ADMINS)} admins "
+        f"in {time.monotonic() - started:.3f}s"
+    )
+    return True
+
+def _write_allow_list_snapshot(snapshot):
+    """
+    Атомарно записывает снимок списков на диск (через временный файл).
+
+    Имя временного файла включает PID, поэтому реплики с общим каталогом не перезаписывают
+    временные файлы друг друга.
+    """
+    temp_path = f"{ALLOW_LIST_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+        json.dump(snapshot, snapshot_file, ensure_ascii=False)
+    os.replace(temp_path, ALLOW_LIST_SNAPSHOT_PATH)
+
+async def save_allow_list_snapshot():
+    """
+    Сохраняет текущие списки пользователей и администраторов на диск для быстрого запуска.
+
+    Возвращает
+    -------
+    None
+
+    Исключения
+    ----------
+    Exception
+        При ошибке записи сообщение об ошибке логируется.
+    """
+    if not os.path.isdir(os.path.dirname(ALLOW_LIST_SNAPSHOT_PATH) or '.'):
+        return
+    snapshot = {"users": ALLOWED_USERS, "admins": sorted(ADMINS), "revisions": dict(_revisions)}
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, _write_allow_list_snapshot, snapshot)
+    except Exception as exc:
+        logging.error(f"Error saving allow-list snapshot: {exc}")
+
+async def publish_allow_lists():
+    """
+    Сохраняет текущие списки на диск и публикует их для других реплик в общем хранилище `STATE`.
+
+    Возвращает
+    -------
+    None
+    """
+    await save_allow_list_snapshot()
+    await STATE.publish_allow_lists(ALLOWED_USERS, ADMINS)
+
+async def load_users_from_google_sheets(sheet_name, force=False):
     """
     Асинхронная загрузка и обновление пользователей из Google Таблиц.
 
-    Функция считывает данные пользователей из указанной Google Таблицы и обновляет глобальный словарь ALLOWED_USERS.
-    Ожидается, что в таблице три столбца: user_id, full_name и telegram_handle, именно в таком порядке. 
+    Функция считывает данные пользователей из указанной Google Таблицы и заменяет глобальный словарь ALLOWED_USERS
+    новым словарем. Ожидается, что в таблице три столбца: user_id, full_name и telegram_handle, именно в таком порядке.
     Первая строка таблицы, как правило заголовок, пропускается.
 
     Параметры
     ----------
-    json_file_path : str
-        Путь к JSON-файлу с учетными данными служебной учетной записи, необходимыми для доступа к API Google Таблиц.
     sheet_name : str
         Имя Google Таблицы, из которой следует загрузить данные пользователя.
+    force : bool, необязательно
+        Загрузить таблицу, даже если она не изменилась с прошлой загрузки.
 
     Возвращает
     -------
-    None
+    bool or None
+        True, если список пользователей был загружен заново, False, если таблица не изменилась,
+        и None, если загрузить таблицу не удалось.
 
     Исключения
     ----------
     Exception
-        Если при доступе к Google Таблицам или обработке данных возникает какая-либо ошибка, сообщение об ошибке выводится.
+        Если при доступе к Google Таблицам или обработке данных возникает какая-либо ошибка, сообщение об ошибке логируется,
+        а прежний список пользователей сохраняется.
 
     Примечания
     ----------
-    Требуются библиотеки `gspread` и `oauth2client.service_account`.
-    Глобальный словарь `ALLOWED_USERS` обновляется информацией о пользователе, где ключ - это user_id (в виде int),
-    а значение - это словарь, содержащий "full_name" и "telegram_handle".
+    Сначала запрашивается только время изменения таблицы; если оно совпадает с загруженным, таблица не читается.
+    Новый словарь собирается целиком и подменяет старый одним присваиванием, поэтому обработчики
+    никогда не видят частично обновленный список, а удаленные из таблицы пользователи теряют доступ.
+    Ключ словаря - это user_id (в виде int), а значение - это словарь, содержащий "full_name" и "telegram_handle".
     """
+    global ALLOWED_USERS
     try:
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive.file',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_name(json_file_path, scope)
-        client = gspread.authorize(creds)
-        sheet = client.open(sheet_name).sheet1
-        rows = sheet.get_all_values()[1:]
-        
+        revision = await call_sheets(get_modified_time, sheet_name, sheet_name=sheet_name)
+        if not force and revision == _revisions.get(sheet_name):
+            return False
+        rows = await call_sheets(read_rows, sheet_name, sheet_name=sheet_name)
+
+        users = {}
         for row in rows:
             user_id, full_name, telegram_handle = row
-            ALLOWED_USERS[int(user_id)] = {"full_name": full_name, "telegram_handle": telegram_handle}
+            users[int(user_id)] = {"full_name": full_name, "telegram_handle": telegram_handle}
+        ALLOWED_USERS = users
+        _revisions[sheet_name] = revision
+        return True
     except Exception as exc:
-        print(f"Error updating from Google Sheets: {exc}")
+        logging.error(f"Error updating users from Google Sheets: {exc}")
+        return None
 
-async def load_admins_from_google_sheets(json_file_path, sheet_name):
+async def load_admins_from_google_sheets(sheet_name, force=False):
     """
     Асинхронная загрузка и обновление списка администраторов из Google Таблиц.
 
-    Функция считывает данные администраторов из указанной Google Таблицы и обновляет глобальный список ADMINS.
+    Функция считывает данные администраторов из указанной Google Таблицы и заменяет глобальное множество ADMINS.
     Ожидается, что в таблице есть столбец с user_id администраторов. Первая строка, как правило заголовок, пропускается.
 
     Параметры
     ----------
-    json_file_path : str
-        Путь к JSON-файлу с учетными данными служебной учетной записи, необходимыми для доступа к API Google Таблиц.
     sheet_name : str
         Имя Google Таблицы, из которой следует загрузить данные администратора.
+    force : bool, необязательно
+        Загрузить таблицу, даже если она не изменилась с прошлой загрузки.
 
     Возвращает
     -------
-    None
+    bool or None
+        True, если список администраторов был загружен заново, False, если таблица не изменилась,
+        и None, если загрузить таблицу не удалось.
 
     Исключения
     ----------
     Exception
-        При ошибке при доступе к Google Таблицам или обработке данных выводится сообщение об ошибке.
+        При ошибке при доступе к Google Таблицам или обработке данных сообщение об ошибке логируется.
 
     Примечания
     ----------
-    Функция обновляет глобальную переменную `ADMINS`.
+    Функция заменяет глобальную переменную `ADMINS` новым `frozenset`, поэтому проверка `in ADMINS` выполняется за O(1).
     """
     global ADMINS
     try:
-        scope = [
-            'https://spreadsheets.google.com/feeds',
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive.file',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_name(json_file_path, scope)
-        client = gspread.authorize(creds)
-        sheet = client.open(sheet_name).sheet1
-        rows = sheet.get_all_values()[1:]
-        new_admins = [int(row[0]) for row in rows if row[0].isdigit()]
-
-        if set(new_admins) != set(ADMINS):
+        revision = await call_sheets(get_modified_time, sheet_name, sheet_name=sheet_name)
+        if not force and revision == _revisions.get(sheet_name):
+            return False
+        rows = await call_sheets(read_rows, sheet_name, sheet_name=sheet_name)
+        new_admins = frozenset(int(row[0]) for row in rows if row[0].isdigit())
+
+        if new_admins != ADMINS:
             ADMINS = new_admins
-            print("Admin list updated!")
+            logging.info("Admin list updated")
+        _revisions[sheet_name] = revision
+        return True
     except Exception as exc:
-        print(f"Error updating admins from Google Sheets: {exc}")
+        logging.error(f"Error updating admins from Google Sheets: {exc}")
+        return None
+
+async def refresh_allow_lists(force=False):
+    """
+    Обновляет списки пользователей и администраторов из Google Таблиц и синхронизирует их с другими репликами.
+
+    Обе таблицы загружаются одновременно. Обновленные списки сохраняются на диск (см. `load_allow_list_snapshot`)
+    и публикуются в общем хранилище `STATE`. Если загрузить таблицу пользователей не удалось, используются
+    списки, опубликованные другой репликой; пустая таблица считается корректным списком.
+    В процессе-обработчике списки вместо этого передаются в главный процесс (см. `set_allow_list_sink`).
+
+    Параметры
+    ----------
+    force : bool, необязательно
+        Перечитать таблицы, даже если они не изменились (например, по запросу администратора).
+
+    Возвращает
+    -------
+    tuple[bool or None, bool or None]
+        Результаты загрузки таблиц пользователей и администраторов: True, если список загружен заново,
+        False, если таблица не изменилась, и None, если загрузить таблицу не удалось.
+    """
+    users_loaded, admins_loaded = await asyncio.gather(
+        load_users_from_google_sheets(USERS_SHEET_NAME, force),
+        load_admins_from_google_sheets(ADMINS_SHEET_NAME, force)
+    )
+    if users_loaded or admins_loaded:
+        if _allow_list_sink is not None:
+            _allow_list_sink(ALLOWED_USERS, ADMINS)
+        else:
+            await publish_allow_lists()
+    elif users_loaded is None:
+        shared = await STATE.fetch_allow_lists()
+        if shared is not None:
+            apply_allow_lists(*shared)
+    return users_loaded, admins_loaded
 
 async def update_users_and_admins_periodically():
     """
     Периодическое обновление списков пользователей и администраторов из Google Таблиц.
 
-    Функция циклически обновляет списки пользователей и администраторов с интервалом в 10 минут.
+    Функция циклически вызывает `refresh_allow_lists` с интервалом `ALLOW_LIST_REFRESH_INTERVAL`
+    (по умолчанию 10 минут); неизмененные таблицы при этом не перечитываются.
     В случае ошибки интервал между попытками сокращается до 1 минуты.
 
     Возвращает
@@ -124,17 +314,12 @@ async def update_users_and_admins_periodically():
     Исключения
     ----------
     Exception
-        При ошибке во время периодического обновления выводится сообщение об ошибке.
-
-    Примечания
-    ----------
-    Функция использует `load_users_from_google_sheets` и `load_admins_from_google_sheets` для загрузки данных.
+        При ошибке во время периодического обновления сообщение об ошибке логируется.
     """
     while True:
         try:
-            await load_users_from_google_sheets('dppcommands-7a27921d2259.json', 'Верификация GPT ITC')
-            await load_admins_from_google_sheets('dppcommands-7a27921d2259.json', 'Админы GPT ITC')
-            await asyncio.sleep(600)  
+            await refresh_allow_lists()
+            await asyncio.sleep(ALLOW_LIST_REFRESH_INTERVAL)
         except Exception as exc:
-            print(f"Error during periodic update: {exc}")
+            logging.error(f"Error during periodic allow-list update: {exc}")
             await asyncio.sleep(60)
@@ -0,0 +1,156 @@
+"""
+Webhook server module.
+Receives Telegram updates with an embedded aiohttp server, answers Telegram immediately
+and processes updates in the background with a bounded pool of workers.
+"""
+
+import asyncio
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from services.metrics import Gauge, add_metrics_route
+from config import (
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE
+)
+
+# Время, после которого при остановке логируется, что принятые обновления еще обрабатываются, в секундах
+DRAIN_TIMEOUT = 30
+
+WEBHOOK_QUEUE_LENGTH = Gauge("chatitc_webhook_queue_length", "Accepted updates waiting for a worker")
+
+class UpdateQueue:
+    """
+    Очередь входящих обновлений с пулом обработчиков.
+
+    Параметры
+    ----------
+    dispatcher : Dispatcher
+        Диспетчер бота, которому передаются обновления.
+    workers : int
+        Количество одновременно обрабатываемых обновлений.
+    maxsize : int
+        Максимальная длина очереди. При переполнении Telegram получает ошибку
+        и повторит доставку обновления позже.
+
+    Примечания
+    ----------
+    Принятое обновление подтверждается Telegram сразу, до обработки, и повторно доставлено
+    не будет. Поэтому при остановке очередь обрабатывается до конца; обновления теряются,
+    только если процесс завершается принудительно (например, SIGKILL) до окончания обработки.
+    """
+
+    def __init__(self, dispatcher, workers, maxsize):
+        self.dispatcher = dispatcher
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = workers
+        self._tasks = []
+        self._closing = False
+
+    def start(self):
+        """
+        Запускает обработчиков очереди.
+        """
+        loop = asyncio.get_event_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+        Перестает принимать обновления, дожидается обработки всех принятых и останавливает обработчиков.
+
+        Ожидание ограничено размером очереди: новые обновления уже не принимаются.
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(self.queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Webhook queue not drained in {DRAIN_TIMEOUT}s: {self.queue.qsize()} updates left, still waiting"
+            )
+            await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _worker(self):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dispatcher.process_update(update)
+            except Exception as exc:
+                logging.exception(f"Error processing update {update.update_id}: {exc}")
+            finally:
+                self.queue.task_done()
+
+    async def handle(self, request):
+        """
+        Принимает обновление от Telegram и ставит его в очередь, не дожидаясь обработки.
+        """
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        if self._closing:
+            # Бот останавливается: Telegram повторит доставку после перезапуска
+            return web.Response(status=503)
+        update = types.Update(**(await request.json()))
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку, обновление не теряется
+            return web.Response(status=503)
+        return web.Response()
+
+def create_webhook_app(dispatcher, on_startup, on_shutdown):
+    """
+    Создает aiohttp-приложение, принимающее обновления Telegram через вебхук.
+
+    Параметры
+    ----------
+    dispatcher : Dispatcher
+        Диспетчер бота.
+    on_startup : Callable[[Dispatcher], Awaitable]
+        Вызывается при запуске сервера.
+    on_shutdown : Callable[[Dispatcher], Awaitable]
+        Вызывается при остановке сервера после обработки принятых обновлений.
+
+    Возвращает
+    -------
+    aiohttp.web.Application
+        Приложение с маршрутами `WEBHOOK_PATH` и, если метрики включены, `METRICS_PATH`.
+
+    Примечания
+    ----------
+    Вебхук регистрируется без удаления накопленных обновлений и не удаляется при остановке,
+    поэтому обновления, пришедшие во время перезапуска, доставляются после него.
+    """
+    updates = UpdateQueue(dispatcher, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, updates.handle)
+    add_metrics_route(app)
+    app["updates"] = updates
+    WEBHOOK_QUEUE_LENGTH.function = updates.queue.qsize
+
+    async def startup(_):
+        await on_startup(dispatcher)
+        updates.start()
+        await dispatcher.bot.set_webhook(
+            WEBHOOK_HOST + WEBHOOK_PATH,
+            drop_pending_updates=False,
+            secret_token=WEBHOOK_SECRET or None
+        )
+
+    async def shutdown(_):
+        await updates.stop()
+        await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        session = await dispatcher.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
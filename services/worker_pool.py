@@ -0,0 +1,392 @@
+"""
+Worker pool module.
+Runs the bot as a supervisor process that receives updates and shards them by user
+across several worker processes, restarting crashed workers without losing updates.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+from collections import OrderedDict
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from services.metrics import Counter, Gauge, add_metrics_route, start_metrics_server, stop_metrics_server
+from services import user_service
+from services.user_service import (
+    STATE,
+    apply_allow_lists,
+    set_allow_list_sink,
+    publish_allow_lists,
+    update_users_and_admins_periodically
+)
+from services.analytics_service import (
+    record_usage,
+    set_usage_sink,
+    flush_analytics,
+    flush_analytics_periodically
+)
+from config import (
+    TOKEN,
+    RUN_MODE,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    METRICS_PORT,
+    STATE_BACKEND_URL
+)
+
+# Время на обработку принятых обновлений при остановке обработчика, в секундах
+DRAIN_TIMEOUT = 30
+# Интервал проверки, что процессы-обработчики живы, в секундах
+WORKER_CHECK_INTERVAL = 1
+# Таймаут long polling запроса getUpdates, в секундах
+POLL_TIMEOUT = 20
+# Сколько раз обновление передается заново после аварийного завершения обработчика
+MAX_REDELIVERIES = 3
+
+WORKER_RESTARTS = Counter("chatitc_worker_restarts_total", "Worker processes restarted after a crash")
+UPDATES_DROPPED = Counter("chatitc_updates_dropped_total", "Updates dropped after too many redeliveries")
+UPDATES_IN_FLIGHT = Gauge("chatitc_updates_in_flight", "Updates dispatched to a worker and not acknowledged yet", ("worker",))
+
+def shard(update, workers):
+    """
+    Выбирает процесс-обработчик для обновления по ID пользователя.
+
+    Все обновления одного пользователя попадают в один процесс, поэтому сохраняются
+    их порядок и состояние пользователя в памяти процесса.
+
+    Параметры
+    ----------
+    update : dict
+        Обновление Telegram в формате JSON Bot API.
+    workers : int
+        Количество процессов-обработчиков.
+
+    Возвращает
+    -------
+    int
+        Номер процесса-обработчика.
+    """
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat") or {}
+            return sender.get("id", 0) % workers
+    return 0
+
+def _worker_main(index, workers, inbox, outbox, on_startup, on_shutdown):
+    """
+    Точка входа процесса-обработчика.
+
+    Обработчики бота регистрируются при импорте главного модуля `app`, поэтому здесь
+    остается только разделить лимиты между процессами и запустить цикл обработки.
+    Списки пользователей обновляет главный процесс и присылает их через `inbox`; списки,
+    обновленные администратором в обработчике, пересылаются главному процессу через `outbox`.
+    Метрики процесса отдаются на порту `METRICS_PORT + 1 + index`.
+    """
+    from loader import dp
+    from services.telegram_sender import scheduler
+    from services.model_scheduler import model_scheduler
+
+    # Процесс останавливает главный процесс, а не Ctrl+C в терминале
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    scheduler.split(workers)
+    model_scheduler.split(workers)
+    set_usage_sink(lambda *usage: outbox.put(("usage",) + usage))
+    set_allow_list_sink(lambda users, admins: outbox.put(("allow_lists", users, admins)))
+    asyncio.get_event_loop().run_until_complete(
+        _serve_worker(dp, index, inbox, outbox, on_startup, on_shutdown)
+    )
+
+async def _serve_worker(dispatcher, index, inbox, outbox, on_startup, on_shutdown):
+    loop = asyncio.get_event_loop()
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    await start_metrics_server(METRICS_PORT + 1 + index)
+    await on_startup(dispatcher)
+    tasks = set()
+
+    async def process(update):
+        try:
+            await dispatcher.process_update(types.Update(**update))
+        except Exception as exc:
+            logging.exception(f"Error processing update {update['update_id']}: {exc}")
+        finally:
+            outbox.put(("ack", index, update["update_id"]))
+
+    while True:
+        message = await loop.run_in_executor(None, inbox.get)
+        if message is None:
+            break
+        if isinstance(message, tuple):
+            # ("allow_lists", users, admins) от главного процесса
+            apply_allow_lists(*message[1:])
+            continue
+        task = loop.create_task(process(message))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+    await on_shutdown(dispatcher)
+    session = await dispatcher.bot.get_session()
+    await session.close()
+
+class WorkerPool:
+    """
+    Пул процессов-обработчиков обновлений.
+
+    Каждое переданное обработчику обновление хранится до подтверждения его обработки.
+    Если процесс завершился аварийно, он перезапускается, и неподтвержденные обновления
+    передаются ему повторно (обновление может быть обработано дважды). Обновление, которое
+    не подтверждено после `MAX_REDELIVERIES` повторных передач, считается причиной падения
+    и отбрасывается с записью в лог.
+    Записи об использовании моделей обработчики пересылают в главный процесс, который
+    единственный пишет таблицу аналитики. Списки пользователей и администраторов загружает
+    главный процесс и рассылает обработчикам при каждом изменении.
+
+    Параметры
+    ----------
+    workers : int
+        Количество процессов-обработчиков.
+    on_startup : Callable[[Dispatcher], Awaitable]
+        Вызывается в каждом обработчике при запуске. Функция должна быть определена на уровне модуля.
+    on_shutdown : Callable[[Dispatcher], Awaitable]
+        Вызывается в каждом обработчике при остановке.
+    """
+
+    def __init__(self, workers, on_startup, on_shutdown):
+        self.workers = workers
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._inboxes = [None] * workers
+        self._processes = [None] * workers
+        self._in_flight = [OrderedDict() for _ in range(workers)]
+        self._redeliveries = {}
+        self._allow_lists = None
+        self._collector = None
+        self._watcher = None
+        UPDATES_IN_FLIGHT.function = lambda: {(index,): len(updates) for index, updates in enumerate(self._in_flight)}
+
+    def start(self):
+        """
+        Запускает процессы-обработчики и прием подтверждений от них.
+        """
+        self._allow_lists = (user_service.ALLOWED_USERS, user_service.ADMINS)
+        for index in range(self.workers):
+            self._start_worker(index)
+        loop = asyncio.get_event_loop()
+        self._collector = loop.create_task(self._collect())
+        self._watcher = loop.create_task(self._watch())
+
+    def _start_worker(self, index):
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self.workers, inbox, self._outbox, self.on_startup, self.on_shutdown),
+            name=f"bot-worker-{index}"
+        )
+        process.start()
+        self._inboxes[index], self._processes[index] = inbox, process
+        inbox.put(("allow_lists",) + self._allow_lists)
+        in_flight = self._in_flight[index]
+        for update_id in list(in_flight):
+            attempts = self._redeliveries.get(update_id, 0) + 1
+            if attempts > MAX_REDELIVERIES:
+                logging.error(f"Dropping update {update_id}: worker {index} crashed {attempts} times while processing it")
+                UPDATES_DROPPED.inc()
+                del in_flight[update_id]
+                self._redeliveries.pop(update_id, None)
+                continue
+            self._redeliveries[update_id] = attempts
+            inbox.put(in_flight[update_id])
+
+    def _share_allow_lists(self):
+        # Списки заменяются целиком новыми объектами, поэтому изменение видно по идентичности
+        users, admins = self._allow_lists
+        if user_service.ALLOWED_USERS is users and user_service.ADMINS is admins:
+            return
+        allow_lists = (user_service.ALLOWED_USERS, user_service.ADMINS)
+        self._allow_lists = allow_lists
+        for inbox in self._inboxes:
+            inbox.put(("allow_lists",) + allow_lists)
+
+    def dispatch(self, update):
+        """
+        Передает обновление обработчику, выбранному функцией `shard`.
+
+        Параметры
+        ----------
+        update : dict
+            Обновление Telegram в формате JSON Bot API.
+
+        Возвращает
+        -------
+        None
+        """
+        index = shard(update, self.workers)
+        self._in_flight[index][update["update_id"]] = update
+        self._inboxes[index].put(update)
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await loop.run_in_executor(None, self._outbox.get)
+            if message is None:
+                return
+            if message[0] == "ack":
+                self._in_flight[message[1]].pop(message[2], None)
+                self._redeliveries.pop(message[2], None)
+            elif message[0] == "usage":
+                record_usage(*message[1:])
+            elif message[0] == "allow_lists":
+                # Администратор обновил списки в обработчике: сохраняем их и рассылаем остальным
+                apply_allow_lists(*message[1:])
+                await publish_allow_lists()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            self._share_allow_lists()
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logging.error(
+                        f"Worker {index} exited with code {process.exitcode}, restarting with "
+                        f"{len(self._in_flight[index])} unprocessed updates"
+                    )
+                    WORKER_RESTARTS.inc()
+                    self._start_worker(index)
+
+    async def stop(self):
+        """
+        Останавливает обработчиков, дождавшись обработки переданных им обновлений.
+        """
+        self._watcher.cancel()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(None, process.join, DRAIN_TIMEOUT * 2) for process in self._processes
+        ))
+        for index, process in enumerate(self._processes):
+            if process.is_alive():
+                logging.warning(f"Worker {index} did not stop in time, terminating")
+                process.terminate()
+        self._outbox.put(None)
+        await self._collector
+
+async def _poll(bot, pool, stopped):
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    while not stopped.is_set():
+        data = {"timeout": POLL_TIMEOUT}
+        if offset is not None:
+            data["offset"] = offset
+        try:
+            updates = await bot.request("getUpdates", data)
+        except Exception as exc:
+            logging.error(f"Error getting updates: {exc}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            pool.dispatch(update)
+            offset = update["update_id"] + 1
+
+async def _open_shared_state():
+    # Главный процесс пишет аналитику, а при общем хранилище реплик — через него (см. `flush_analytics`)
+    if STATE_BACKEND_URL:
+        await STATE.open()
+
+async def _close_shared_state():
+    if STATE_BACKEND_URL:
+        await STATE.close()
+
+def _create_supervisor_app(bot, pool):
+    app = web.Application()
+
+    async def handle(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        pool.dispatch(await request.json())
+        return web.Response()
+
+    async def startup(_):
+        await _open_shared_state()
+        pool.start()
+        loop = asyncio.get_event_loop()
+        app["flush"] = loop.create_task(flush_analytics_periodically())
+        app["refresh"] = loop.create_task(update_users_and_admins_periodically())
+        await bot.set_webhook(
+            WEBHOOK_HOST + WEBHOOK_PATH,
+            drop_pending_updates=False,
+            secret_token=WEBHOOK_SECRET or None
+        )
+
+    async def shutdown(_):
+        await pool.stop()
+        app["refresh"].cancel()
+        app["flush"].cancel()
+        await flush_analytics()
+        await _close_shared_state()
+        session = await bot.get_session()
+        await session.close()
+
+    app.router.add_post(WEBHOOK_PATH, handle)
+    add_metrics_route(app)
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
+
+def run_supervisor(workers, on_startup, on_shutdown):
+    """
+    Запускает бота в режиме нескольких процессов-обработчиков.
+
+    Главный процесс только принимает обновления (опросом или, при `RUN_MODE=webhook`, через вебхук),
+    распределяет их по обработчикам функцией `shard`, обновляет списки пользователей и администраторов
+    из Google Таблиц и пишет аналитику. Лимиты Telegram и OpenAI
+    делятся между обработчиками поровну. Метрики главного процесса отдаются сервером вебхука
+    или на порту `METRICS_PORT`, метрики обработчиков — на следующих портах.
+
+    Параметры
+    ----------
+    workers : int
+        Количество процессов-обработчиков.
+    on_startup : Callable[[Dispatcher], Awaitable]
+        Вызывается в каждом обработчике при запуске.
+    on_shutdown : Callable[[Dispatcher], Awaitable]
+        Вызывается в каждом обработчике при остановке.
+
+    Возвращает
+    -------
+    None
+    """
+    pool = WorkerPool(workers, on_startup, on_shutdown)
+    bot = Bot(token=TOKEN)
+    if RUN_MODE == 'webhook':
+        web.run_app(_create_supervisor_app(bot, pool), host=WEBAPP_HOST, port=WEBAPP_PORT)
+        return
+
+    loop = asyncio.get_event_loop()
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    loop.run_until_complete(_open_shared_state())
+    pool.start()
+    loop.run_until_complete(start_metrics_server(METRICS_PORT))
+    flush = loop.create_task(flush_analytics_periodically())
+    refresh = loop.create_task(update_users_and_admins_periodically())
+    polling = loop.create_task(_poll(bot, pool, stopped))
+    loop.run_until_complete(stopped.wait())
+    polling.cancel()
+    refresh.cancel()
+    flush.cancel()
+    loop.run_until_complete(pool.stop())
+    loop.run_until_complete(stop_metrics_server())
+    loop.run_until_complete(flush_analytics())
+    loop.run_until_complete(_close_shared_state())
+    session = loop.run_until_complete(bot.get_session())
+    loop.run_until_complete(session.close())
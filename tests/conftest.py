@@ -0,0 +1,15 @@
+"""
+Shared test setup: the bot configuration requires a Telegram token and an OpenAI key at import time.
+"""
+
+import os
+import pathlib
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+@pytest.fixture(autouse=True)
+def bot_env(monkeypatch):
+    monkeypatch.setenv("TOKEN", os.environ.get("TOKEN", "123456:TEST"))
+    monkeypatch.setenv("OPENAI_API_KEY", os.environ.get("OPENAI_API_KEY", "test"))
+    monkeypatch.syspath_prepend(str(ROOT))
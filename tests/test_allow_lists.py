@@ -0,0 +1,73 @@
+"""
+Allow-list tests: shared lists are used only when Google Sheets fails, and revoked users
+cannot continue a saved dialog.
+"""
+
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+for dependency in ("aiogram", "openai", "gspread", "tiktoken", "dotenv"):
+    pytest.importorskip(dependency)
+
+SHARED = ({2: {"full_name": "Петр", "telegram_handle": "@petr"}}, [2])
+
+@pytest.fixture
+def user_service(monkeypatch, tmp_path):
+    from services import user_service
+
+    async def fetch_allow_lists():
+        return SHARED
+
+    async def publish_allow_lists(users, admins):
+        pass
+
+    monkeypatch.setattr(user_service, "ALLOWED_USERS", {1: {"full_name": "Иван", "telegram_handle": "@ivan"}})
+    monkeypatch.setattr(user_service, "ADMINS", frozenset({1}))
+    monkeypatch.setattr(user_service, "ALLOW_LIST_SNAPSHOT_PATH", str(tmp_path / "allow_lists.json"))
+    monkeypatch.setattr(user_service, "_revisions", {})
+    monkeypatch.setattr(user_service.STATE, "fetch_allow_lists", fetch_allow_lists)
+    monkeypatch.setattr(user_service.STATE, "publish_allow_lists", publish_allow_lists)
+    return user_service
+
+def sheets_returning(rows, failing=None):
+    async def call_sheets(function, *args, sheet_name=None):
+        if rows is None or sheet_name == failing:
+            raise ConnectionError("Sheets unavailable")
+        if function.__name__ == "get_modified_time":
+            return "revision"
+        return rows
+    return call_sheets
+
+def test_failed_load_falls_back_to_shared_lists(user_service, monkeypatch):
+    monkeypatch.setattr(user_service, "call_sheets", sheets_returning(None))
+    assert asyncio.run(user_service.refresh_allow_lists()) == (None, None)
+    assert user_service.ALLOWED_USERS == SHARED[0]
+    assert user_service.ADMINS == frozenset(SHARED[1])
+
+def test_empty_sheet_revokes_everyone(user_service, monkeypatch):
+    monkeypatch.setattr(user_service, "call_sheets", sheets_returning([]))
+    assert asyncio.run(user_service.refresh_allow_lists()) == (True, True)
+    assert user_service.ALLOWED_USERS == {}
+    assert user_service.ADMINS == frozenset()
+
+def test_partial_failure_is_reported_per_sheet(user_service, monkeypatch):
+    users = user_service.ALLOWED_USERS
+    monkeypatch.setattr(user_service, "call_sheets", sheets_returning([["2"]], failing=user_service.USERS_SHEET_NAME))
+    assert asyncio.run(user_service.refresh_allow_lists(force=True)) == (None, True)
+    assert user_service.ALLOWED_USERS is users
+    assert user_service.ADMINS == frozenset({2})
+
+def test_revoked_user_cannot_continue_dialog(user_service, monkeypatch):
+    from handlers import dialog
+
+    async def has_session(user_id):
+        return True
+
+    monkeypatch.setattr(dialog.STATE, "has_session", has_session)
+    message = SimpleNamespace(text="Привет", from_user=SimpleNamespace(id=1))
+    assert asyncio.run(dialog.in_dialog(message))
+    monkeypatch.setattr(user_service, "ALLOWED_USERS", {})
+    assert not asyncio.run(dialog.in_dialog(message))
+    message.text = "❌ Завершить диалог"
+    assert not asyncio.run(dialog.ends_dialog(message))
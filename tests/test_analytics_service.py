@@ -0,0 +1,92 @@
+"""
+Analytics service tests against a fake worksheet: the Sheets export prices prompt and completion
+tokens separately, adds every batch to the existing row found through the row index, and reloads
+the index once it is invalidated.
+"""
+
+from datetime import datetime
+import pytest
+
+for dependency in ("gspread", "dotenv"):
+    pytest.importorskip(dependency)
+
+TODAY = datetime.now().strftime('%Y-%m-%d')
+
+class FakeWorksheet:
+    def __init__(self, values):
+        self.values = [list(row) for row in values]
+        self.row_count = 1000
+        self.reads = 0
+
+    def get_all_values(self):
+        self.reads += 1
+        return [list(row) for row in self.values]
+
+    def add_rows(self, count):
+        self.row_count += count
+
+    def batch_update(self, data):
+        for update in data:
+            row = int(update["range"].split(":")[0][1:])
+            while len(self.values) < row:
+                self.values.append([])
+            self.values[row - 1] = [str(value) for value in update["values"][0]]
+
+@pytest.fixture
+def analytics_service(monkeypatch):
+    from services import analytics_service
+    worksheet = FakeWorksheet([
+        ["ФИО", "Telegram", "Дата", "GPT-3.5 Turbo", "GPT-4", "Стоимость"],
+        ["Иван", "@ivan", TODAY, "0", "1000", "0,05"],
+    ])
+    monkeypatch.setattr(analytics_service, "get_worksheet", lambda name: worksheet)
+    monkeypatch.setattr(analytics_service, "_pending", {})
+    monkeypatch.setattr(analytics_service, "_row_index", {})
+    monkeypatch.setattr(analytics_service, "_last_row", 0)
+    monkeypatch.setattr(analytics_service, "_index_loaded_at", None)
+    monkeypatch.setattr(analytics_service, "_usage_sink", None)
+    analytics_service.worksheet = worksheet
+    return analytics_service
+
+def test_prompt_and_completion_are_priced_separately(analytics_service):
+    analytics_service.record_usage("Иван", "@ivan", "GPT-4", 1000, 250)
+    analytics_service.record_usage("Петр", "@petr", "GPT-3.5 Turbo", 2000, 500)
+    analytics_service._write_batch(analytics_service._pending)
+    header, ivan, petr = analytics_service.worksheet.values
+    assert ivan[3:5] == ["0.0", "2250.0"]
+    assert float(ivan[5]) == pytest.approx(0.05 + 1000 * 0.03 / 1000 + 250 * 0.06 / 1000)
+    assert petr[:5] == ["Петр", "@petr", TODAY, "2500.0", "0.0"]
+    assert float(petr[5]) == pytest.approx(2000 * 0.003 / 1000 + 500 * 0.004 / 1000)
+
+def test_cost_accumulates_across_batches(analytics_service):
+    for _ in range(2):
+        analytics_service._pending.clear()
+        analytics_service.record_usage("Иван", "@ivan", "GPT-4", 100, 100)
+        analytics_service._write_batch(dict(analytics_service._pending))
+    ivan = analytics_service.worksheet.values[1]
+    assert float(ivan[4]) == 1400
+    assert float(ivan[5]) == pytest.approx(0.05 + 2 * (100 * 0.03 / 1000 + 100 * 0.06 / 1000))
+    assert analytics_service.worksheet.reads == 1
+
+def test_row_index_finds_existing_rows_and_appends_new_ones(analytics_service):
+    analytics_service.worksheet.values.append(["Мария", "@maria", "2023-01-01", "10", "0", "0"])
+    analytics_service.record_usage(" Иван ", "@ivan", "GPT-3.5 Turbo", 10, 10)
+    analytics_service.record_usage("Мария", "@maria", "GPT-4", 10, 10)
+    analytics_service._write_batch(analytics_service._pending)
+    rows = analytics_service.worksheet.values
+    assert len(rows) == 4
+    assert rows[1][3] == "20.0"
+    assert rows[2][:3] == ["Мария", "@maria", "2023-01-01"]
+    assert rows[3][:5] == ["Мария", "@maria", TODAY, "0.0", "20.0"]
+    assert analytics_service._row_index[("Мария", TODAY)][0] == 4
+    assert analytics_service._last_row == 4
+
+def test_invalidated_index_is_reloaded(analytics_service):
+    analytics_service.record_usage("Иван", "@ivan", "GPT-4", 10, 0)
+    analytics_service._write_batch(dict(analytics_service._pending))
+    # Другая реплика или человек изменили таблицу
+    analytics_service.worksheet.values[1][4] = "5000"
+    analytics_service.invalidate_row_index()
+    analytics_service._write_batch(dict(analytics_service._pending))
+    assert analytics_service.worksheet.reads == 2
+    assert float(analytics_service.worksheet.values[1][4]) == 5010
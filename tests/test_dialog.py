@@ -0,0 +1,91 @@
+"""
+Dialog handler tests against a fake Telegram bot: answers replace the typing placeholder and
+streamed answers roll over into new messages.
+"""
+
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+for dependency in ("aiogram", "openai", "gspread", "tiktoken", "dotenv"):
+    pytest.importorskip(dependency)
+
+class FakeMessage:
+    def __init__(self, bot, text):
+        self.bot = bot
+        self.text = text
+        self.deleted = False
+
+    async def edit_text(self, text):
+        self.text = text
+        self.bot.edits += 1
+
+    async def delete(self):
+        self.deleted = True
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+        self.edits = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        message = FakeMessage(self, text)
+        self.messages.append(message)
+        return message
+
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+@pytest.fixture
+def dialog(monkeypatch):
+    from handlers import dialog
+    bot = FakeBot()
+    monkeypatch.setattr(dialog, "dp", SimpleNamespace(bot=bot))
+    dialog.bot = bot
+    return dialog
+
+def test_empty_answer_removes_placeholder(dialog, monkeypatch):
+    async def ask_openai(model_name, messages, info=None):
+        return "", 0
+
+    monkeypatch.setattr(dialog, "STREAM_RESPONSES", False)
+    monkeypatch.setattr(dialog, "TYPING_PLACEHOLDER", True)
+    monkeypatch.setattr(dialog, "ask_openai", ask_openai)
+    message = SimpleNamespace(from_user=SimpleNamespace(id=101), chat=SimpleNamespace(id=101))
+
+    async def scenario():
+        await dialog.STATE.save_session(101, dialog.new_session("GPT-4"))
+        try:
+            await dialog.answer_user(message, "Привет")
+        finally:
+            await dialog.STATE.delete_session(101)
+
+    asyncio.run(scenario())
+    (placeholder,) = dialog.bot.messages
+    assert placeholder.deleted
+
+async def chunks_of(text, size):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+def test_long_stream_rolls_over_into_new_messages(dialog, monkeypatch):
+    monkeypatch.setattr(dialog, "STREAM_EDIT_INTERVAL", 0)
+    text = "".join(letter * 900 for letter in "abcdefghij")
+    full_text, tokens_used = asyncio.run(dialog.stream_message(101, chunks_of(text, 900), None))
+    assert full_text == text
+    assert tokens_used == 10
+    assert [message.text for message in dialog.bot.messages] == [text[:4000], text[4000:8000], text[8000:]]
+
+def test_cancelled_stream_reports_received_text(dialog, monkeypatch):
+    monkeypatch.setattr(dialog, "STREAM_EDIT_INTERVAL", 3600)
+    reply = {}
+
+    async def chunks():
+        yield "a" * 4500
+        yield "b" * 100
+        raise asyncio.CancelledError
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(dialog.stream_message(101, chunks(), None, reply=reply))
+    assert reply == {"text": "a" * 4500 + "b" * 100, "tokens_used": 2}
+    assert [message.text for message in dialog.bot.messages] == ["a" * 4000]
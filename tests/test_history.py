@@ -0,0 +1,38 @@
+"""
+Tokenizer tests: token counting never loads the encoding on the event loop.
+"""
+
+import pytest
+
+tiktoken = pytest.importorskip("tiktoken")
+
+from services import history
+
+@pytest.fixture
+def encoding_state(monkeypatch):
+    monkeypatch.setattr(history, "_encoding", None)
+    return monkeypatch
+
+def test_count_tokens_estimates_until_loaded(encoding_state):
+    def fail(name):
+        raise AssertionError("count_tokens must not load the encoding")
+
+    encoding_state.setattr(tiktoken, "get_encoding", fail)
+    assert history.count_tokens("Привет") == len("Привет".encode("utf-8")) // 3 + 1
+
+def test_load_encoding_failure_falls_back_to_estimate(encoding_state):
+    def fail(name):
+        raise OSError("no network")
+
+    encoding_state.setattr(tiktoken, "get_encoding", fail)
+    assert history.load_encoding() is False
+    assert history.count_tokens("abcdef") == 3
+
+def test_count_tokens_uses_loaded_encoding(encoding_state):
+    class Encoding:
+        def encode(self, text):
+            return text.split()
+
+    encoding_state.setattr(tiktoken, "get_encoding", lambda name: Encoding())
+    assert history.load_encoding() is True
+    assert history.count_tokens("one two three") == 3
@@ -0,0 +1,45 @@
+"""
+Model scheduler tests: a failing queue notification does not fail the queued request.
+"""
+
+import asyncio
+import pytest
+
+for dependency in ("aiogram", "dotenv"):
+    pytest.importorskip(dependency)
+
+@pytest.fixture
+def model_scheduler():
+    from services import model_scheduler
+    return model_scheduler
+
+def test_failing_on_queued_keeps_request_waiting(model_scheduler):
+    async def scenario():
+        tier = model_scheduler.ModelTier(concurrency=1, rpm=600, tpm=100000)
+        await tier.acquire(1, 10)
+
+        async def on_queued(position):
+            raise RuntimeError("Telegram is unavailable")
+
+        waiter = asyncio.get_event_loop().create_task(tier.acquire(2, 10, on_queued))
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and tier.queue_length() == 1
+        tier.release()
+        await asyncio.wait_for(waiter, 1)
+        assert tier.active == 1
+
+    asyncio.run(scenario())
+
+def test_tpm_reserves_completion_and_reconciles(model_scheduler):
+    async def scenario():
+        tier = model_scheduler.ModelTier(concurrency=10, rpm=600, tpm=3500, completion_reserve=1000)
+        await tier.acquire(1, 1000)
+        # Запрос и резерв ответа заняли 2000 из 3500 токенов: второй такой же запрос ждет
+        assert tier._wait_time(1000) > 0
+        tier.release(completion_tokens=100)
+        assert tier._wait_time(1000) == 0
+        await tier.acquire(2, 1000)
+        tier.release(completion_tokens=2500)
+        assert tier._tokens.tokens < 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,53 @@
+"""
+OpenAI service tests: a streamed answer is limited by the pause between chunks, not by its total length.
+"""
+
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+for dependency in ("aiogram", "openai", "dotenv"):
+    pytest.importorskip(dependency)
+
+@pytest.fixture
+def openai_service(monkeypatch):
+    from services import openai_service
+    return openai_service
+
+def chunk(text):
+    return SimpleNamespace(choices=[{"delta": {"content": text}}])
+
+def fake_stream(monkeypatch, openai_service, pauses):
+    calls = []
+
+    async def stream():
+        for index, pause in enumerate(pauses):
+            await asyncio.sleep(pause)
+            yield chunk(f"{index} ")
+
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        return stream()
+
+    monkeypatch.setattr(openai_service.openai.ChatCompletion, "acreate", acreate)
+    return calls
+
+def collect(openai_service):
+    async def main():
+        try:
+            return [delta async for delta in openai_service.ask_openai_stream("gpt-4", [])]
+        finally:
+            await openai_service.close_session()
+    return asyncio.run(main())
+
+def test_long_stream_is_not_cut_by_total_timeout(openai_service, monkeypatch):
+    monkeypatch.setattr(openai_service, "OPENAI_REQUEST_TIMEOUT", 0.2)
+    monkeypatch.setattr(openai_service, "OPENAI_STREAM_READ_TIMEOUT", 0.2)
+    calls = fake_stream(monkeypatch, openai_service, [0.05] * 8)
+    assert collect(openai_service) == [f"{index} " for index in range(8)]
+    assert calls[0]["request_timeout"] == (0.2, None)
+
+def test_stalled_stream_ends_with_error(openai_service, monkeypatch):
+    monkeypatch.setattr(openai_service, "OPENAI_STREAM_READ_TIMEOUT", 0.1)
+    fake_stream(monkeypatch, openai_service, [0, 0, 1])
+    assert collect(openai_service) == ["0 ", "1 ", openai_service.OPENAI_ERROR_TEXT]
@@ -0,0 +1,61 @@
+"""
+Response cache tests: keys ignore whitespace differences, entries expire after the TTL, the memory
+cap evicts the least recently used answers, and only first turns are cached when configured.
+"""
+
+import time
+import pytest
+
+for dependency in ("cachetools", "dotenv"):
+    pytest.importorskip(dependency)
+
+ENTRY = 1000
+
+@pytest.fixture
+def response_cache():
+    from services import response_cache
+    return response_cache
+
+def ask(text):
+    return [{"role": "user", "content": text}]
+
+def make_cache(response_cache, ttl=60, entries=3, first_turn_only=True):
+    max_bytes = entries * (ENTRY + response_cache.ENTRY_OVERHEAD)
+    return response_cache.ResponseCache(True, ttl, max_bytes, first_turn_only)
+
+def test_hit_ignores_whitespace_and_depends_on_model(response_cache):
+    cache = make_cache(response_cache)
+    cache.put("gpt-4", ask("Что такое  ITC?"), "Ответ")
+    assert cache.get("gpt-4", ask(" Что такое ITC? ")) == "Ответ"
+    assert cache.get("gpt-3.5-turbo-16k", ask("Что такое ITC?")) is None
+    assert cache.hit_ratio == 0.5
+
+def test_entries_expire_after_ttl(response_cache):
+    cache = make_cache(response_cache, ttl=0.05)
+    cache.put("gpt-4", ask("Привет"), "Ответ")
+    time.sleep(0.1)
+    assert cache.get("gpt-4", ask("Привет")) is None
+
+def test_memory_cap_evicts_least_recently_used(response_cache):
+    cache = make_cache(response_cache)
+    for index in range(3):
+        cache.put("gpt-4", ask(str(index)), str(index) * ENTRY)
+    assert cache.get("gpt-4", ask("0")) is not None
+    cache.put("gpt-4", ask("3"), "3" * ENTRY)
+    assert cache.get("gpt-4", ask("1")) is None
+    assert cache.get("gpt-4", ask("0")) is not None
+    assert cache.size_bytes <= 3 * (ENTRY + response_cache.ENTRY_OVERHEAD)
+
+def test_answer_larger_than_cache_is_skipped(response_cache):
+    cache = make_cache(response_cache, entries=1)
+    cache.put("gpt-4", ask("Привет"), "x" * (2 * ENTRY))
+    assert cache.get("gpt-4", ask("Привет")) is None
+    assert cache.size_bytes == 0
+
+def test_only_first_turns_are_cacheable(response_cache):
+    dialog = ask("Привет") + [{"role": "assistant", "content": "Здравствуйте"}] + ask("Как дела?")
+    assert make_cache(response_cache).is_cacheable(ask("Привет"))
+    assert not make_cache(response_cache).is_cacheable(dialog)
+    assert make_cache(response_cache, first_turn_only=False).is_cacheable(dialog)
+    disabled = response_cache.ResponseCache(False, 60, 10000, False)
+    assert not disabled.is_cacheable(ask("Привет"))
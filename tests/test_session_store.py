@@ -0,0 +1,77 @@
+"""
+Session store tests: dialogs survive a restart with their identity, and a dialog ended while it
+was being saved does not come back.
+"""
+
+import asyncio
+import sqlite3
+import threading
+import pytest
+
+pytest.importorskip("tiktoken")
+
+from services.history import DialogHistory
+from services.session_store import Session, SessionStore
+
+def make_session(text):
+    history = DialogHistory(1000)
+    history.append("user", text)
+    return Session("GPT-4", history)
+
+def test_session_restored_with_dialog_id(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SessionStore(path)
+    store.open()
+    session = make_session("Привет")
+    store[1] = session
+    asyncio.run(store.flush())
+    store.close()
+
+    restored = SessionStore(path)
+    restored.open()
+    assert restored[1].dialog_id == session.dialog_id
+    assert restored[1].history.to_turns() == session.history.to_turns()
+    restored.close()
+
+def test_database_without_dialog_id_is_migrated(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE sessions (user_id INTEGER PRIMARY KEY, model TEXT NOT NULL, "
+            "history TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("INSERT INTO sessions VALUES (1, 'GPT-4', '[]', 0)")
+    conn.close()
+    store = SessionStore(path)
+    store.open()
+    assert store[1].dialog_id
+    store.close()
+
+def test_dialog_ended_during_flush_is_not_restored(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.db"))
+    store.open()
+    writing, proceed = threading.Event(), threading.Event()
+    write = store._write
+
+    def slow_write(upserts, deletes):
+        writing.set()
+        proceed.wait()
+        write(upserts, deletes)
+
+    store._write = slow_write
+
+    async def scenario():
+        loop = asyncio.get_event_loop()
+        store[1] = make_session("Привет")
+        flush = loop.create_task(store.flush())
+        await loop.run_in_executor(None, writing.wait)
+        del store[1]
+        proceed.set()
+        await flush
+        assert 1 not in store
+        await store.flush()
+
+    asyncio.run(scenario())
+    assert 1 not in store
+    assert store.get(1) is None
+    store.close()
@@ -0,0 +1,39 @@
+"""
+Startup smoke tests: every module imports, and no module-level import shadows another.
+"""
+
+import ast
+import importlib
+import pathlib
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+MODULES = ["config", "loader"] + [
+    f"{package}.{path.stem}"
+    for package in ("services", "handlers")
+    for path in sorted((ROOT / package).glob("*.py"))
+    if path.stem != "__init__"
+] + ["app"]
+SOURCES = sorted(ROOT.glob("*.py")) + sorted(ROOT.glob("services/*.py")) + sorted(ROOT.glob("handlers/*.py"))
+
+def _imported_names(tree):
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield node.lineno, alias.asname or alias.name.split(".")[0]
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                yield node.lineno, alias.asname or alias.name
+
+@pytest.mark.parametrize("path", SOURCES, ids=lambda path: str(path.relative_to(ROOT)))
+def test_imports_do_not_shadow_each_other(path):
+    seen = {}
+    for lineno, name in _imported_names(ast.parse(path.read_text(encoding="utf-8"))):
+        assert name not in seen, f"{name} imported on line {seen[name]} is redefined on line {lineno}"
+        seen[name] = lineno
+
+@pytest.mark.parametrize("module", MODULES)
+def test_module_imports(module):
+    for dependency in ("aiogram", "openai", "gspread", "tiktoken", "redis", "dotenv"):
+        pytest.importorskip(dependency)
+    importlib.import_module(module)
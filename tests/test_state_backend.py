@@ -0,0 +1,196 @@
+"""
+Parity tests for the state backends: the in-memory backend and the Redis backend against a
+local fakeredis server must behave the same way.
+"""
+
+import asyncio
+import pytest
+
+for dependency in ("redis", "fakeredis", "tiktoken", "dotenv"):
+    pytest.importorskip(dependency)
+
+import fakeredis
+
+@pytest.fixture
+def modules():
+    from services import state_backend, session_store
+    return state_backend, session_store
+
+@pytest.fixture(params=["memory", "redis"])
+def make_backend(request, modules, tmp_path):
+    state_backend, session_store = modules
+    server = fakeredis.FakeServer()
+
+    def make():
+        if request.param == "memory":
+            sessions = session_store.SessionStore(str(tmp_path / "sessions.db"))
+            return state_backend.MemoryBackend(sessions, {}, 3600, 3600, 7)
+        client = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+        return state_backend.RedisBackend("", client=client)
+
+    make.kind = request.param
+    make.server = server
+    return make
+
+def run(make_backend, scenario):
+    async def main():
+        backend = make_backend()
+        await backend.open()
+        try:
+            await scenario(backend)
+        finally:
+            await backend.close()
+    asyncio.run(main())
+
+def test_session_roundtrip(make_backend, modules):
+    state_backend, _ = modules
+
+    async def scenario(backend):
+        session = state_backend.new_session("GPT-4")
+        session.history.append("user", "Привет")
+        await backend.save_session(1, session)
+        assert await backend.has_session(1)
+        loaded = await backend.get_session(1)
+        assert (loaded.model, loaded.dialog_id) == ("GPT-4", session.dialog_id)
+        assert loaded.history.to_turns() == session.history.to_turns()
+        await backend.delete_session(1)
+        assert not await backend.has_session(1)
+        assert await backend.get_session(1) is None
+
+    run(make_backend, scenario)
+
+def test_update_session_checks_dialog(make_backend, modules):
+    state_backend, _ = modules
+
+    async def scenario(backend):
+        session = state_backend.new_session("GPT-3.5 Turbo")
+        await backend.save_session(1, session)
+        updated = await backend.update_session(1, session.dialog_id, lambda s: s.history.append("user", "a"))
+        assert [turn[1] for turn in updated.history.to_turns()] == ["a"]
+        assert await backend.update_session(1, "other", lambda s: s.history.append("user", "b")) is None
+        assert await backend.update_session(1, session.dialog_id, lambda s: False) is None
+        await backend.save_session(1, state_backend.new_session("GPT-4"))
+        assert await backend.update_session(1, session.dialog_id, lambda s: s.history.append("user", "c")) is None
+        assert (await backend.get_session(1)).history.to_turns() == []
+
+    run(make_backend, scenario)
+
+def test_update_session_retries_on_concurrent_write(make_backend, modules):
+    state_backend, _ = modules
+    if make_backend.kind != "redis":
+        pytest.skip("only the shared backend has concurrent writers")
+
+    async def scenario(backend):
+        session = state_backend.new_session("GPT-4")
+        await backend.save_session(1, session)
+        key = backend._key("session", 1)
+        other = fakeredis.FakeRedis(server=make_backend.server, decode_responses=True)
+        calls = []
+
+        def append(current):
+            if not calls:
+                # Другая реплика записывает реплику между чтением и записью сессии
+                concurrent = backend._decode_session(other.hgetall(key))
+                concurrent.history.append("user", "question")
+                other.hset(key, mapping=backend._encode_session(concurrent))
+            calls.append(current)
+            current.history.append("assistant", "answer")
+
+        await backend.update_session(1, session.dialog_id, append)
+        turns = [turn[1] for turn in (await backend.get_session(1)).history.to_turns()]
+        assert turns == ["question", "answer"]
+        assert len(calls) == 2
+
+    run(make_backend, scenario)
+
+def test_incr_usage(make_backend):
+    async def scenario(backend):
+        assert await backend.incr_usage(1, "2024-01-01", "GPT-4", 10) == 10
+        assert await backend.incr_usage(1, "2024-01-01", "GPT-4", 5) == 15
+        assert await backend.incr_usage(1, "2024-01-01", "GPT-3.5 Turbo", 1) == 1
+
+    run(make_backend, scenario)
+
+def test_cancel_generation_reaches_handler(make_backend):
+    async def scenario(backend):
+        cancelled = []
+        backend.set_cancel_handler(cancelled.append)
+        await backend.cancel_generation(7)
+        await asyncio.sleep(0.05)
+        # Своя реплика прерывает генерацию сразу и не получает повторную отмену из канала
+        assert cancelled == [7]
+
+    run(make_backend, scenario)
+
+def test_share_usage_has_single_writer(make_backend):
+    async def scenario(backend):
+        batch = {("Иван", "@ivan", "2024-01-01", "GPT-4"): 10}
+        if make_backend.kind == "memory":
+            assert await backend.share_usage(batch) == batch
+            return
+        other = make_backend()
+        await other.open()
+        assert await backend.share_usage(batch) == batch
+        assert await other.share_usage(batch) is None
+        assert await backend.share_usage(batch) == {("Иван", "@ivan", "2024-01-01", "GPT-4"): 20}
+        await other.close()
+
+    run(make_backend, scenario)
+
+def test_user_lock_serializes_turns(make_backend):
+    if make_backend.kind != "redis":
+        pytest.skip("in one process turns are serialized by the dialog handlers")
+
+    async def scenario(backend):
+        other = make_backend()
+        await other.open()
+        order = []
+
+        async def turn(owner, name):
+            async with owner.user_lock(1):
+                order.append(f"{name} start")
+                await asyncio.sleep(0.2)
+                order.append(f"{name} end")
+
+        await asyncio.gather(turn(backend, "a"), turn(other, "b"))
+        await other.close()
+        assert order in (["a start", "a end", "b start", "b end"], ["b start", "b end", "a start", "a end"])
+
+    run(make_backend, scenario)
+
+def test_user_lock_is_renewed_while_held(make_backend, modules, monkeypatch):
+    state_backend, _ = modules
+    if make_backend.kind != "redis":
+        pytest.skip("only the shared backend has lock expiry")
+    monkeypatch.setattr(state_backend, "USER_LOCK_TTL", 0.3)
+    monkeypatch.setattr(state_backend, "USER_LOCK_RENEW_INTERVAL", 0.1)
+
+    async def scenario(backend):
+        other = make_backend()
+        await other.open()
+        order = []
+
+        async def turn(owner, name, duration):
+            async with owner.user_lock(1):
+                order.append(f"{name} start")
+                await asyncio.sleep(duration)
+                order.append(f"{name} end")
+
+        first = asyncio.get_event_loop().create_task(turn(backend, "a", 1.0))
+        await asyncio.sleep(0.05)
+        await turn(other, "b", 0)
+        await first
+        await other.close()
+        assert order == ["a start", "a end", "b start", "b end"]
+
+    run(make_backend, scenario)
+
+def test_backend_without_required_methods_cannot_be_created(modules):
+    state_backend, _ = modules
+
+    class IncompleteBackend(state_backend.StateBackend):
+        async def has_session(self, user_id):
+            return False
+
+    with pytest.raises(TypeError):
+        IncompleteBackend()
@@ -0,0 +1,80 @@
+"""
+Summarizer tests: old turns of a long dialog are replaced by a summary, while a dialog that was
+ended during summarization or a failed summary leave the history untouched.
+"""
+
+import asyncio
+import pytest
+
+for dependency in ("aiogram", "openai", "gspread", "tiktoken", "dotenv"):
+    pytest.importorskip(dependency)
+
+USER_ID = 301
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    from services import summarizer
+    events = []
+    monkeypatch.setattr(summarizer, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(summarizer, "SUMMARY_THRESHOLD", 0.5)
+    monkeypatch.setattr(summarizer, "SUMMARY_KEEP_TURNS", 2)
+    monkeypatch.setattr(summarizer.usage_store, "record_event", lambda *args: events.append(args))
+    summarizer.events = events
+    return summarizer
+
+def long_session():
+    from services.history import DialogHistory
+    from services.session_store import Session
+    history = DialogHistory(600)
+    for index in range(3):
+        history.append("user", f"Вопрос {index}: " + "подробности " * 10)
+        history.append("assistant", f"Ответ {index}: " + "объяснение " * 10)
+    return Session("GPT-4", history)
+
+def compact(summarizer, monkeypatch, summary, during=None):
+    async def ask_openai(model_name, messages, info=None):
+        if during is not None:
+            await during()
+        return summary, 7
+
+    monkeypatch.setattr(summarizer, "ask_openai", ask_openai)
+    session = long_session()
+
+    async def scenario():
+        await summarizer.STATE.save_session(USER_ID, session)
+        try:
+            summarizer.maybe_compact(USER_ID, session)
+            while USER_ID in summarizer._compacting:
+                await asyncio.sleep(0.01)
+            return await summarizer.STATE.get_session(USER_ID)
+        finally:
+            await summarizer.STATE.delete_session(USER_ID)
+
+    return asyncio.run(scenario())
+
+def test_old_turns_are_replaced_by_summary(summarizer, monkeypatch):
+    before = long_session()
+    after = compact(summarizer, monkeypatch, "Пользователь задал три вопроса")
+    turns = after.history.to_turns()
+    assert len(turns) == 3
+    assert turns[0][:2] == ["system", summarizer.SUMMARY_PREFIX + "Пользователь задал три вопроса"]
+    assert turns[1:] == before.history.to_turns()[-2:]
+    assert after.history.total_tokens < before.history.total_tokens
+    (event,) = summarizer.events
+    assert event[3] == summarizer.SUMMARY_MODEL and event[5] == 7
+
+def test_failed_summary_keeps_history(summarizer, monkeypatch):
+    before = long_session()
+    after = compact(summarizer, monkeypatch, summarizer.OPENAI_ERROR_TEXT)
+    assert after.history.to_turns() == before.history.to_turns()
+    assert summarizer.events == []
+
+def test_dialog_restarted_during_summary_is_not_compacted(summarizer, monkeypatch):
+    restarted = long_session()
+
+    async def restart():
+        await summarizer.STATE.save_session(USER_ID, restarted)
+
+    after = compact(summarizer, monkeypatch, "Сводка", during=restart)
+    assert after.dialog_id == restarted.dialog_id
+    assert after.history.to_turns() == restarted.history.to_turns()
@@ -0,0 +1,77 @@
+"""
+Send scheduler tests: a flood-control error blocks only its chat and the request is retried,
+and queued requests are sent in priority order.
+"""
+
+import asyncio
+import time
+import pytest
+
+for dependency in ("aiogram", "dotenv"):
+    pytest.importorskip(dependency)
+
+from aiogram.utils.exceptions import RetryAfter
+
+@pytest.fixture
+def telegram_sender():
+    from services import telegram_sender
+    return telegram_sender
+
+def test_retry_after_blocks_only_its_chat(telegram_sender):
+    scheduler = telegram_sender.SendScheduler(100, 100)
+    sent = []
+    attempts = []
+
+    def call(chat_id, fail=False):
+        async def request():
+            attempts.append(chat_id)
+            if fail and attempts.count(chat_id) == 1:
+                raise RetryAfter(1)
+            sent.append((chat_id, time.monotonic()))
+            return chat_id
+        return request
+
+    async def main():
+        start = time.monotonic()
+        flooded = asyncio.ensure_future(scheduler.submit(1, telegram_sender.PRIORITY_FIRST, call(1, fail=True)))
+        await asyncio.sleep(0.05)
+        assert await scheduler.submit(2, telegram_sender.PRIORITY_FIRST, call(2)) == 2
+        assert not flooded.done()
+        assert await flooded == 1
+        return start
+
+    start = asyncio.run(main())
+    assert attempts == [1, 2, 1]
+    assert [chat_id for chat_id, _ in sent] == [2, 1]
+    assert sent[0][1] - start < 0.5
+    assert sent[1][1] - start >= 1
+
+def test_errors_other_than_retry_after_are_raised(telegram_sender):
+    scheduler = telegram_sender.SendScheduler(100, 100)
+
+    async def request():
+        raise ValueError("Bad Request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.submit(1, telegram_sender.PRIORITY_FIRST, request))
+
+def test_queued_requests_are_sent_by_priority(telegram_sender):
+    scheduler = telegram_sender.SendScheduler(100, 5)
+    sent = []
+
+    def call(name):
+        async def request():
+            sent.append(name)
+        return request
+
+    async def main():
+        await scheduler.submit(1, telegram_sender.PRIORITY_FIRST, call("first"))
+        # Ведро чата пусто: следующие запросы ждут в очереди и выполняются по приоритету
+        await asyncio.gather(
+            scheduler.submit(1, telegram_sender.PRIORITY_EDIT, call("edit")),
+            scheduler.submit(1, telegram_sender.PRIORITY_CONTINUATION, call("continuation")),
+            scheduler.submit(1, telegram_sender.PRIORITY_FIRST, call("answer")),
+        )
+
+    asyncio.run(main())
+    assert sent == ["first", "answer", "continuation", "edit"]
@@ -0,0 +1,58 @@
+"""
+Usage store tests: report costs match the Sheets export, rendering is thread-safe and the
+plotting libraries are imported only when a report is built.
+"""
+
+import asyncio
+import pathlib
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+for dependency in ("pandas", "matplotlib", "gspread", "dotenv"):
+    pytest.importorskip(dependency)
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+@pytest.fixture
+def modules():
+    from services import analytics_service, usage_store
+    return analytics_service, usage_store
+
+@pytest.fixture
+def store(modules, monkeypatch, tmp_path):
+    analytics_service, usage_store = modules
+    exported = []
+    monkeypatch.setattr(usage_store, "ANALYTICS_SHEETS_EXPORT", True)
+    monkeypatch.setattr(usage_store, "record_usage", lambda *args: exported.append(args))
+    store = usage_store.UsageStore(str(tmp_path / "usage.db"))
+    store.exported = exported
+    store.open()
+    yield store
+    store.close()
+
+def test_cost_basis_matches_sheets_export(store, modules):
+    analytics_service, _ = modules
+    store.record_event(1, "Иван", "@ivan", "GPT-4", 1000, 250, 1.5)
+    asyncio.run(store.flush())
+    (cost,) = store._conn.execute("SELECT cost FROM daily").fetchone()
+    (_, _, model, prompt_tokens, completion_tokens), = store.exported
+    assert (prompt_tokens, completion_tokens) == (1000, 250)
+    assert cost == pytest.approx(analytics_service.usage_cost(model, prompt_tokens, completion_tokens))
+    assert cost == pytest.approx(1000 * 0.03 / 1000 + 250 * 0.06 / 1000)
+
+def test_reports_render_concurrently(store):
+    for user_id in range(5):
+        store.record_event(user_id, f"user {user_id}", "@user", "GPT-3.5 Turbo", 100, 50, 0.5 + user_id)
+    asyncio.run(store.flush())
+    with ThreadPoolExecutor(4) as pool:
+        reports = list(pool.map(store._render_report, [7] * 8))
+    for text, image in reports:
+        assert text.startswith("Использование за 7 дн.")
+        assert image.startswith(b"\x89PNG")
+
+def test_import_does_not_load_plotting_libraries():
+    code = "import sys, services.usage_store; print('pandas' in sys.modules or 'matplotlib' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    assert result.stdout.strip() == "False", result.stderr
@@ -0,0 +1,67 @@
+"""
+Worker pool tests: crash redelivery is capped and allow lists are pushed to every worker.
+The worker processes are replaced with stubs, so no process is spawned.
+"""
+
+import queue
+import pytest
+
+for dependency in ("aiogram", "gspread", "tiktoken", "dotenv"):
+    pytest.importorskip(dependency)
+
+class FakeProcess:
+    def __init__(self, target, args, name):
+        self.name = name
+
+    def start(self):
+        pass
+
+class FakeContext:
+    Queue = queue.Queue
+    Process = FakeProcess
+
+@pytest.fixture
+def modules(monkeypatch):
+    from services import user_service, worker_pool
+    monkeypatch.setattr(worker_pool.multiprocessing, "get_context", lambda method: FakeContext())
+    monkeypatch.setattr(user_service, "ALLOWED_USERS", {1: {"full_name": "Иван", "telegram_handle": "@ivan"}})
+    monkeypatch.setattr(user_service, "ADMINS", frozenset({1}))
+    return user_service, worker_pool
+
+@pytest.fixture
+def pool(modules):
+    user_service, worker_pool = modules
+    pool = worker_pool.WorkerPool(1, None, None)
+    pool._allow_lists = (user_service.ALLOWED_USERS, user_service.ADMINS)
+    pool._start_worker(0)
+    return pool
+
+def drain(inbox):
+    messages = []
+    while not inbox.empty():
+        messages.append(inbox.get_nowait())
+    return messages
+
+def test_crashing_update_is_dropped_after_redeliveries(pool, modules):
+    _, worker_pool = modules
+    update = {"update_id": 10, "message": {"from": {"id": 1}}}
+    pool.dispatch(update)
+    for _ in range(worker_pool.MAX_REDELIVERIES):
+        pool._start_worker(0)
+        assert update in drain(pool._inboxes[0])
+    pool._start_worker(0)
+    assert update not in drain(pool._inboxes[0])
+    assert not pool._in_flight[0] and not pool._redeliveries
+
+def test_started_worker_receives_allow_lists(pool, modules):
+    user_service, _ = modules
+    assert drain(pool._inboxes[0]) == [("allow_lists", user_service.ALLOWED_USERS, user_service.ADMINS)]
+
+def test_changed_allow_lists_are_broadcast(pool, modules, monkeypatch):
+    user_service, _ = modules
+    drain(pool._inboxes[0])
+    pool._share_allow_lists()
+    assert drain(pool._inboxes[0]) == []
+    monkeypatch.setattr(user_service, "ALLOWED_USERS", {})
+    pool._share_allow_lists()
+    assert drain(pool._inboxes[0]) == [("allow_lists", {}, user_service.ADMINS)]